@@ -20,7 +20,8 @@ class BoardAdmin(admin.ModelAdmin):
     save_on_top = True
     list_select_related = True
     fieldsets = (
-        (None, {'fields': (('db_key', ), 'db_lock_storage', 'db_expiry_maxposts', 'db_expiry_duration')}),
+        (None, {'fields': (('db_key', ), 'db_lock_storage', 'db_expiry_maxposts', 'db_expiry_duration',
+                           'db_truncate', 'db_archive_days')}),
         )
 
     def save_model(self, request, obj, form, change):
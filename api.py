@@ -0,0 +1,346 @@
+"""
+A JSON API for the boards, for web clients and bridges to other services.
+
+Every response carries an ETag and Last-Modified header worked out from the version
+counters in paxboards.caches, without looking at any posts.  A client which sends the
+ETag back in If-None-Match (or the date in If-Modified-Since) gets an empty 304 response
+if nothing it would see has changed, so polling is cheap.
+
+- boards/api/ lists the boards the user can read, with unread and total counts.
+- boards/api/<board id>/ gives a page of a board's threads; pass the 'next' or
+  'previous' cursor from a page as ?after= or ?before= to get the pages around it.
+- boards/api/<board id>/<post id>/ gives a post with a page of its replies, paged the
+  same way.
+- boards/api/events/ streams new posts, replies, pins and unpins on the boards the user
+  can read as they happen, as server-sent events (see paxboards.events).
+- boards/api/events/poll/?since=<event id> does the same by long polling, for clients
+  which can't use server-sent events.  It returns as soon as there are events since the
+  one given, or after about POLL_SECONDS if there aren't any.  Leave out 'since' to get
+  the ID to start from.
+
+No more than events.MAX_CLIENTS clients may wait for events at once; any more are sent a
+503 response, with a Retry-After header saying when to try again.
+
+Reading posts through the API doesn't mark them read.
+
+"""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from boards import DefaultBoard
+from managers import expiry_date, start_of_day
+from models import Post
+from profiling import profiled_view
+import caches
+import events
+
+THREADS_PER_PAGE = getattr(settings, "PAXBOARDS_THREADS_PER_PAGE", 25)
+REPLIES_PER_PAGE = getattr(settings, "PAXBOARDS_REPLIES_PER_PAGE", 20)
+
+# How long an event stream is kept open before the client is made to reconnect, and how
+# long a long poll waits for events, in seconds.  Each waiting client holds one of the
+# webserver's threads meanwhile, so these are kept short, and under the usual 60 second
+# timeouts of proxies.
+STREAM_SECONDS = getattr(settings, "PAXBOARDS_EVENT_STREAM_SECONDS", 55)
+POLL_SECONDS = getattr(settings, "PAXBOARDS_EVENT_POLL_SECONDS", 25)
+
+# How long a client should wait before reconnecting to an event stream, in milliseconds.
+STREAM_RETRY = 3000
+
+# How long a client turned away because too many are waiting should wait before trying
+# again, in seconds.
+BUSY_RETRY = 10
+
+
+def _error(status, message):
+    return JsonResponse({"error": message}, status=status)
+
+
+def _etag(*parts):
+    return quote_etag(hashlib.md5(repr((caches.EPOCH,) + parts)).hexdigest())
+
+
+def _not_modified(request, etag, last_modified):
+    """
+    Returns a 304 response if the client's copy is still current, or None.
+
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        matched = "*" in tags or etag in tags or ("W/" + etag) in tags
+    else:
+        since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        matched = since is not None and int(last_modified) <= since
+
+    if not matched:
+        return None
+
+    response = HttpResponse(status=304)
+    _set_validators(response, etag, last_modified)
+    return response
+
+
+def _set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # The content depends on who is asking.
+    response['Cache-Control'] = "private, no-cache"
+    response['Vary'] = "Cookie"
+    return response
+
+
+def _readable_board(request, board_id):
+    try:
+        board = DefaultBoard.objects.get(pk=board_id)
+    except DefaultBoard.DoesNotExist:
+        return None
+
+    if not board.access(request.user, access_type="read", default=False):
+        return None
+
+    return board
+
+
+def _date(date):
+    return date.isoformat() if date else None
+
+
+def _thread_json(post):
+    return {"id": post.id, "subject": post.db_subject, "poster": post.db_poster_name,
+            "date": _date(post.db_date_created), "pinned": post.db_pinned, "excerpt": post.excerpt,
+            "replies": post.db_reply_count, "last_post_on": _date(post.last_post_on),
+            "last_poster": post.last_poster, "unread": post.is_unread}
+
+
+def _post_json(post):
+    return {"id": post.id, "subject": post.db_subject, "poster": post.db_poster_name,
+            "date": _date(post.db_date_created), "pinned": post.db_pinned, "text": post.plaintext,
+            "html": post.html}
+
+
+def _authenticated(request):
+    return request.user.is_authenticated and request.user.username != ""
+
+
+@profiled_view
+def api_boards(request):
+    if not _authenticated(request):
+        return _error(403, "You must be logged in.")
+
+    # Boards with a duration limit lose posts at the start of each day, without any
+    # counter changing, so the day is part of the tag.
+    account = request.user
+    etag = _etag("boards", account.id, caches.global_version(), caches.account_read_version(account.id),
+                 caches.account_token(account), start_of_day(0).date().isoformat())
+    last_modified = caches.last_changed(account.id)
+
+    response = _not_modified(request, etag, last_modified)
+    if response:
+        return response
+
+    boards = []
+    for board in DefaultBoard.objects.get_all_visible_boards(account):
+        last_post = getattr(board, "last_post", None)
+        boards.append({"id": board.id, "name": board.name, "unread": board.unread_count,
+                       "total": board.total_count, "subscribed": board.subscribed,
+                       "last_post": _thread_json(last_post) if last_post else None})
+
+    return _set_validators(JsonResponse({"boards": boards}), etag, last_modified)
+
+
+@profiled_view
+def api_board(request, board_id):
+    if not _authenticated(request):
+        return _error(403, "You must be logged in.")
+
+    board = _readable_board(request, board_id)
+    if not board:
+        return _error(404, "No such board.")
+
+    account = request.user
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    etag = _etag("board", board.id, account.id, caches.board_version(board.id),
+                 caches.read_version(account.id, board.id), expiry_date(board), after, before)
+    last_modified = caches.last_changed(account.id, board.id)
+
+    response = _not_modified(request, etag, last_modified)
+    if response:
+        return response
+
+    page = Post.objects.thread_page(board, account, after=after, before=before, limit=THREADS_PER_PAGE)
+    data = {"board": {"id": board.id, "name": board.name},
+            "threads": [_thread_json(t) for t in page.items],
+            "next": page.next_cursor, "previous": page.prev_cursor}
+
+    return _set_validators(JsonResponse(data), etag, last_modified)
+
+
+@profiled_view
+def api_post(request, board_id, post_id):
+    if not _authenticated(request):
+        return _error(403, "You must be logged in.")
+
+    board = _readable_board(request, board_id)
+    if not board:
+        return _error(404, "No such board.")
+
+    account = request.user
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    etag = _etag("post", board.id, post_id, account.id, caches.board_version(board.id),
+                 caches.read_version(account.id, board.id), after, before)
+    last_modified = caches.last_changed(account.id, board.id)
+
+    response = _not_modified(request, etag, last_modified)
+    if response:
+        return response
+
+    try:
+        post = Post.objects.get(pk=post_id, db_board=board)
+    except Post.DoesNotExist:
+        return _error(404, "No such post.")
+
+    page = Post.objects.reply_page(post, after=after, before=before, limit=REPLIES_PER_PAGE)
+    data = _post_json(post)
+    data.update({"board": {"id": board.id, "name": board.name},
+                 "replies": [_post_json(r) for r in page.items],
+                 "next": page.next_cursor, "previous": page.prev_cursor})
+
+    return _set_validators(JsonResponse(data), etag, last_modified)
+
+
+def _sse(event, event_id, data):
+    return "id: %s\nevent: %s\ndata: %s\n\n" % (event_id, event, json.dumps(data))
+
+
+def _stream(account, number):
+    yield "retry: %d\n\n" % STREAM_RETRY
+
+    deadline = time.time() + STREAM_SECONDS
+    while True:
+        found = events.events_after(number)
+        if found is None:
+            # The events since the client last heard are gone; it has to reload.
+            number = events.last_id()
+            yield _sse("reset", events.make_id(number), {})
+        elif found:
+            readable = events.readable_boards(account)
+            for event in found:
+                if event.board_id in readable:
+                    yield _sse(event.event, event.id, event.data)
+            number = found[-1].number
+        else:
+            yield ": keepalive\n\n"
+
+        if time.time() >= deadline:
+            return
+
+        events.wait(number)
+
+
+class _Stream(object):
+    """
+    The body of an event stream.  The webserver closes it when the stream ends or the
+    client goes away, which gives up the client's place (see events.join).
+
+    """
+    def __init__(self, account, number):
+        self._events = _stream(account, number)
+        self._closed = False
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._events.close()
+            events.leave()
+
+
+def _busy():
+    response = _error(503, "Too many clients are waiting for events.  Try again shortly.")
+    response['Retry-After'] = str(BUSY_RETRY)
+    return response
+
+
+def _start_from(event_id):
+    if event_id is None:
+        return events.last_id()
+
+    # An ID from before a restart, or from too long ago, gets the client a reset.
+    number = events.parse_id(event_id)
+    return -1 if number is None else number
+
+
+def _poll(account, number):
+    # Waits for events the account may see, for up to POLL_SECONDS.  Returns them, or
+    # None if the client has to reload, and the number of the last event seen.
+    found = []
+    deadline = time.time() + POLL_SECONDS
+    while True:
+        new = events.events_after(number)
+        if new is None:
+            return None, number
+
+        if new:
+            readable = events.readable_boards(account)
+            found = [e for e in new if e.board_id in readable]
+            number = new[-1].number
+
+        if found or time.time() >= deadline:
+            return found, number
+
+        events.wait(number)
+
+
+# The event views spend most of their time waiting, so aren't profiled.
+
+def api_events(request):
+    if not _authenticated(request):
+        return _error(403, "You must be logged in.")
+
+    if not events.join():
+        return _busy()
+
+    event_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id')
+    response = StreamingHttpResponse(_Stream(request.user, _start_from(event_id)),
+                                     content_type="text/event-stream")
+    response['Cache-Control'] = "no-cache"
+    # Stop proxies such as nginx from holding events back.
+    response['X-Accel-Buffering'] = "no"
+    return response
+
+
+def api_poll_events(request):
+    if not _authenticated(request):
+        return _error(403, "You must be logged in.")
+
+    number = _start_from(request.GET.get('since'))
+    if number == -1:
+        return JsonResponse({"reset": True, "events": [], "last": events.make_id(events.last_id())})
+
+    found = []
+    if 'since' in request.GET:
+        if not events.join():
+            return _busy()
+
+        try:
+            found, number = _poll(request.user, number)
+        finally:
+            events.leave()
+
+        if found is None:
+            return JsonResponse({"reset": True, "events": [], "last": events.make_id(events.last_id())})
+
+    data = {"reset": False, "last": events.make_id(number),
+            "events": [dict(e.data, event=e.event, event_id=e.id) for e in found]}
+    return JsonResponse(data)
+
@@ -0,0 +1,416 @@
+"""
+Benchmarks for the board system.
+
+This builds a reproducible synthetic dataset -- boards with a mix of expiry settings,
+threads of varying length, and accounts which have read most but not all of what's on
+each board -- and then times the paths players hit most, reporting percentiles of each.
+Results can be saved as JSON and compared against an earlier run, so a change can be
+checked for regressions.
+
+It is normally run through the management command:
+
+    evennia paxboards_benchmark --posts 20000 --output before.json
+    evennia paxboards_benchmark --posts 20000 --output after.json --compare before.json
+
+The dataset is written to whatever database the game is configured to use, so run it
+against a copy of the game, not the live one.  Everything it creates is named with a
+prefix ("bench" by default) and removed again afterwards, unless asked to keep it.
+
+"""
+import json
+import random
+import sys
+import timeit
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.test import RequestFactory
+from django.utils import timezone
+from evennia.accounts.models import AccountDB
+
+from paxboards import receipts, search
+from paxboards.boards import DefaultBoard
+from paxboards.models import Post, ReadState, _format_id_set
+from paxboards.transfer import create_posts
+from paxboards import views
+
+# Expiry settings given to the generated boards in turn: (max posts, max days).
+EXPIRY_CONFIGS = [(None, None), (100, None), (None, 30), (250, 45)]
+
+BATCH_SIZE = 500
+
+PERCENTILES = [50, 90, 99]
+
+_WORDS = ("the of and to in is was for on that with as his they be at one have this from "
+          "by hot word but what some we can out other were all there when up use your how "
+          "said an each she which do their time if will way about many then them write would "
+          "like so these her long make thing see him two has look more day could go come did "
+          "sword ship tavern council harbor storm guild lantern market treaty rumor festival "
+          "raid caravan tower archive shrine ember glass river frost banner oath").split()
+
+_COLORS = ["|r", "|g", "|y", "|b", "|m", "|c", "|w", "|555"]
+
+
+def _sentence(rng, length):
+    words = [rng.choice(_WORDS) for _ in range(length)]
+    if rng.random() < 0.2:
+        i = rng.randrange(len(words))
+        words[i] = rng.choice(_COLORS) + words[i] + "|n"
+    return " ".join(words)
+
+
+def _text(rng):
+    return "\n\n".join(_sentence(rng, rng.randint(8, 40)) + "." for _ in range(rng.randint(1, 5)))
+
+
+def generate(prefix="bench", seed=1, boards=4, posts=2000, accounts=50, days=60, reply_ratio=0.7,
+             read_ratio=0.85):
+    """
+    Builds a synthetic dataset, using bulk inserts.  The same arguments always build the
+    same dataset.
+
+    Args:
+        prefix (str): What to start the names of the generated boards and accounts with.
+        seed (int): The random seed.
+        boards (int): How many boards to make.
+        posts (int): How many posts to make, spread across the boards.
+        accounts (int): How many accounts to make.
+        days (int): How many days back the posts go.
+        reply_ratio (float): Roughly what fraction of posts are replies.
+        read_ratio (float): Roughly what fraction of each board each account has read.
+
+    Returns:
+        A dataset dictionary; see load.
+
+    """
+    if DefaultBoard.objects.filter(db_key__startswith=prefix + "-").exists():
+        raise ValueError("A dataset named '" + prefix + "' already exists.")
+
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    with transaction.atomic():
+        AccountDB.objects.bulk_create([AccountDB(username="%s_account_%d" % (prefix, i),
+                                                 db_typeclass_path=settings.BASE_ACCOUNT_TYPECLASS)
+                                       for i in range(accounts)])
+        account_list = list(AccountDB.objects.filter(username__startswith=prefix + "_account_").order_by('id'))
+
+        board_list = []
+        for i in range(boards):
+            maxposts, maxdays = EXPIRY_CONFIGS[i % len(EXPIRY_CONFIGS)]
+            board = DefaultBoard(db_key="%s-%d" % (prefix, i))
+            board.db_expiry_maxposts = maxposts
+            board.db_expiry_duration = maxdays
+            board.save()
+            board_list.append(board)
+
+    for board in board_list:
+        _generate_posts(rng, board, posts // boards, account_list, now, days, reply_ratio)
+        Post.objects.rebuild_threads(board)
+        search.rebuild(board)
+        board.db_subscriptions.add(*[a for a in account_list if rng.random() < 0.5])
+
+    _generate_read_states(rng, board_list, account_list, read_ratio)
+
+    return load(prefix)
+
+
+def _generate_posts(rng, board, count, accounts, now, days, reply_ratio):
+    start = now - timedelta(days=days)
+    step = timedelta(days=days) / max(count, 1)
+
+    roots = []
+    batch = []
+    with transaction.atomic():
+        for sequence in range(1, count + 1):
+            author = rng.choice(accounts)
+            date = start + step * sequence
+            parent_id = None
+            if roots and rng.random() < reply_ratio:
+                # Most replies go to recent threads, as they do on a real game.
+                parent_id = roots[-1 - min(int(rng.expovariate(0.3)), len(roots) - 1)]
+
+            post = Post(db_poster_player=author, db_poster_name=author.username, db_board=board,
+                        db_subject=_sentence(rng, rng.randint(2, 5))[:40], db_text=_text(rng),
+                        db_date_created=date, db_pinned=rng.random() < 0.01, db_parent_id=parent_id,
+                        db_sequence=sequence, db_last_post_on=date, db_last_poster_name=author.username)
+            post.update_renditions()
+            batch.append(post)
+
+            if len(batch) >= BATCH_SIZE or sequence == count:
+                create_posts(batch)
+                # Only threads from earlier batches can be replied to, as only they have ids.
+                roots.extend(p.id for p in batch if p.db_parent_id is None)
+                batch = []
+
+        DefaultBoard.objects.filter(pk=board.pk).update(db_last_sequence=count)
+        board.db_last_sequence = count
+
+
+def _generate_read_states(rng, boards, accounts, read_ratio):
+    states = []
+    for board in boards:
+        ids = list(Post.objects.filter(db_board=board).order_by('id').values_list('id', flat=True))
+        if not ids:
+            continue
+
+        for account in accounts:
+            if rng.random() < 0.1:
+                # Some accounts have never read the board at all.
+                continue
+
+            ratio = min(1.0, max(0.0, rng.gauss(read_ratio, 0.1)))
+            through = int(len(ids) * ratio)
+            below, above = ids[:through], ids[through:]
+            read_above = rng.sample(above, min(len(above), rng.randint(0, 5)))
+            unread_below = rng.sample(below, min(len(below), rng.randint(0, 3)))
+            states.append(ReadState(db_account=account, db_board=board, db_read_through=below[-1] if below else 0,
+                                    db_read_above=_format_id_set(read_above),
+                                    db_unread_below=_format_id_set(unread_below)))
+
+    with transaction.atomic():
+        ReadState.objects.bulk_create(states, batch_size=BATCH_SIZE)
+
+
+def load(prefix="bench"):
+    """
+    Looks up a dataset made by generate.
+
+    Args:
+        prefix (str): The prefix the dataset was generated with.
+
+    Returns:
+        A dictionary with the dataset's 'boards', 'accounts' and 'threads' (the first posts
+        of each thread), each a list.
+
+    """
+    boards = list(DefaultBoard.objects.filter(db_key__startswith=prefix + "-").order_by('id'))
+    accounts = list(AccountDB.objects.filter(username__startswith=prefix + "_account_").order_by('id'))
+    threads = list(Post.objects.filter(db_board__in=boards, db_parent__isnull=True).order_by('id'))
+
+    return {"boards": boards, "accounts": accounts, "threads": threads}
+
+
+def cleanup(prefix="bench"):
+    """
+    Deletes a dataset made by generate, along with any posts made while benchmarking it.
+
+    Args:
+        prefix (str): The prefix the dataset was generated with.
+
+    """
+    with transaction.atomic():
+        boards = DefaultBoard.objects.filter(db_key__startswith=prefix + "-")
+        ReadState.objects.filter(db_board__in=boards).delete()
+        Post.objects.filter(db_board__in=boards).update(db_last_reply=None)
+        Post.objects.filter(db_board__in=boards, db_parent__isnull=False).delete()
+        Post.objects.filter(db_board__in=boards).delete()
+        for board in boards:
+            board.delete()
+        AccountDB.objects.filter(username__startswith=prefix + "_account_").delete()
+
+
+def percentile(samples, pct):
+    """
+    Returns a percentile of a sorted list of samples, by the nearest-rank method.
+
+    """
+    if not samples:
+        return 0.0
+
+    rank = int(round(pct / 100.0 * len(samples) + 0.5)) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+def summarize(samples):
+    """
+    Summarizes a list of timings, in seconds, as milliseconds.
+
+    Returns:
+        A dictionary of the count, mean, minimum, maximum and percentiles.
+
+    """
+    samples = sorted(samples)
+    summary = {"count": len(samples),
+               "mean": 1000.0 * sum(samples) / len(samples) if samples else 0.0,
+               "min": 1000.0 * samples[0] if samples else 0.0,
+               "max": 1000.0 * samples[-1] if samples else 0.0}
+    for pct in PERCENTILES:
+        summary["p" + str(pct)] = 1000.0 * percentile(samples, pct)
+
+    return summary
+
+
+def _time(func, repeat, prepare=None):
+    samples = []
+    for i in range(repeat):
+        undo = prepare(i) if prepare else None
+        start = timeit.default_timer()
+        func(i)
+        samples.append(timeit.default_timer() - start)
+        if undo:
+            undo()
+
+    return summarize(samples)
+
+
+def _request(path, account):
+    request = RequestFactory().get(path)
+    request.user = account
+    return request
+
+
+def benchmarks(dataset, seed=1):
+    """
+    Builds the list of benchmarks to run against a dataset.
+
+    Args:
+        dataset (dict): The dataset, from generate or load.
+        seed (int): The random seed, for choosing which boards, posts and accounts each
+            repetition uses.
+
+    Returns:
+        A list of (name, function) or (name, function, prepare) tuples.  Each function
+        takes the repetition number.  A prepare function is called with the repetition
+        number before the function, untimed, and returns a function which undoes
+        whatever the benchmark changed, so later repetitions and benchmarks start from
+        the same data.
+
+    """
+    rng = random.Random(seed)
+    boards = dataset["boards"]
+    accounts = dataset["accounts"]
+    threads = dataset["threads"]
+
+    def pick(items, i):
+        return items[(i * 7919 + seed) % len(items)]
+
+    queries = [" ".join(rng.sample(_WORDS, rng.randint(1, 2))) for _ in range(20)] + ['"the council"', "tav*"]
+
+    def create_post(i):
+        board = pick(boards, i)
+        author = pick(accounts, i)
+        parent = pick(threads, i) if i % 3 else None
+        if parent and parent.db_board_id != board.id:
+            board = DefaultBoard.objects.get(pk=parent.db_board_id)
+        board.create_post(_sentence(rng, 3)[:40], _text(rng), author_name=author.username, author_player=author,
+                          parent=parent)
+
+    def keep_read_state(i):
+        board, account = pick(boards, i), pick(accounts, i)
+        receipts.flush()
+        state = ReadState.objects.state_for(account, board)
+        saved = (state.pk, state.db_read_through, state.db_read_above, state.db_unread_below)
+
+        def undo():
+            receipts.flush()
+            if saved[0] is None:
+                ReadState.objects.filter(db_account=account, db_board=board).delete()
+            else:
+                state.db_read_through, state.db_read_above, state.db_unread_below = saved[1:]
+                state.save()
+
+        return undo
+
+    return [
+        ("get_all_visible_boards",
+         lambda i: list(DefaultBoard.objects.get_all_visible_boards(pick(accounts, i)))),
+        ("by_board_for_player",
+         lambda i: list(Post.objects.by_board_for_player(pick(boards, i), pick(accounts, i)))),
+        ("by_board_threaded_player",
+         lambda i: list(Post.objects.by_board_threaded_player(pick(boards, i), pick(accounts, i)))),
+        ("post_num",
+         lambda i: pick(threads, i).post_num),
+        ("search",
+         lambda i: Post.objects.search(pick(queries, i), player=pick(accounts, i))),
+        ("mark_all_read",
+         lambda i: pick(boards, i).mark_all_read(pick(accounts, i)), keep_read_state),
+        ("create_post", create_post),
+        ("view:show_boardlist",
+         lambda i: views.show_boardlist(_request("/", pick(accounts, i)))),
+        ("view:show_board",
+         lambda i: views.show_board(_request("/", pick(accounts, i)), pick(boards, i).id)),
+        ("view:show_thread",
+         lambda i: views.show_thread(_request("/", pick(accounts, i)), pick(threads, i).db_board_id,
+                                     pick(threads, i).id)),
+    ]
+
+
+def run(dataset, repeat=100, seed=1, only=None, out=sys.stdout):
+    """
+    Runs every benchmark against a dataset.
+
+    Args:
+        dataset (dict): The dataset, from generate or load.
+        repeat (int): How many times to run each benchmark.
+        seed (int): The random seed.
+        only (list): The names of the benchmarks to run, or None for all of them.
+        out (file): Where to write progress to.
+
+    Returns:
+        A dictionary mapping benchmark names to their summaries.
+
+    """
+    results = {}
+    for benchmark in benchmarks(dataset, seed=seed):
+        name, func, prepare = (benchmark + (None,))[:3]
+        if only and name not in only:
+            continue
+
+        try:
+            results[name] = _time(func, repeat, prepare)
+        except Exception as e:
+            results[name] = {"error": str(e)}
+
+        out.write(format_result(name, results[name]) + "\n")
+
+    return results
+
+
+def format_result(name, summary, previous=None):
+    """
+    Formats a single benchmark's summary as a line of text, optionally compared with an
+    earlier summary of the same benchmark.
+
+    """
+    if "error" in summary:
+        return "%-26s error: %s" % (name, summary["error"])
+
+    line = "%-26s p50 %8.2fms  p90 %8.2fms  p99 %8.2fms  max %8.2fms" % \
+           (name, summary["p50"], summary["p90"], summary["p99"], summary["max"])
+
+    if previous and "error" not in previous and previous.get("p50"):
+        line += "  (p50 %+.0f%%)" % (100.0 * (summary["p50"] - previous["p50"]) / previous["p50"])
+
+    return line
+
+
+def report(params, results):
+    """
+    Builds the JSON-serializable report of a run.
+
+    """
+    return {"created": timezone.now().isoformat(), "python": sys.version.split()[0],
+            "params": params, "results": results}
+
+
+def save(path, report_data):
+    with open(path, "w") as f:
+        json.dump(report_data, f, indent=2, sort_keys=True)
+
+
+def compare(previous, results):
+    """
+    Formats a comparison of a run's results with an earlier report.
+
+    Args:
+        previous (dict): The earlier report, as saved by save.
+        results (dict): The results of this run.
+
+    Returns:
+        A list of lines of text.
+
+    """
+    old = previous.get("results", {})
+    return [format_result(name, results[name], old.get(name)) for name in sorted(results)]
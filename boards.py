@@ -1,9 +1,14 @@
 from evennia.typeclasses.models import TypeclassBase
-from paxboards.models import Post, BoardDB
-from paxboards.managers import BoardManager
+from paxboards.models import Post, BoardDB, ReadState
+from paxboards import search
+from paxboards import caches
+from paxboards import metrics
+from paxboards import notifications
+from paxboards.managers import BoardManager, chunked
 from future.utils import with_metaclass
 from server.conf import settings
 from django.utils import timezone
+from django.db import transaction
 
 
 class DefaultBoard(with_metaclass(TypeclassBase, BoardDB)):
@@ -29,6 +34,35 @@ class DefaultBoard(with_metaclass(TypeclassBase, BoardDB)):
     def at_board_creation(self):
         pass
 
+    def access(self, accessing_obj, access_type='read', default=False, no_superuser_bypass=False, **kwargs):
+        """
+        Checks whether an account or object passes one of this board's locks.  The result is
+        remembered, keyed on the board's locks and the accessor's permissions, so repeated
+        checks don't have to run the lock functions again; see paxboards.caches.
+
+        Args:
+            accessing_obj (AccountDB or ObjectDB): The account or object to check.
+            access_type (str): The lock type to check.
+            default (bool): The result if the board has no lock of this type.
+            no_superuser_bypass (bool): If set, superusers are checked like anyone else.
+
+        Returns:
+            True or False
+
+        """
+        if kwargs or not accessing_obj or not hasattr(accessing_obj, "permissions"):
+            return super(DefaultBoard, self).access(accessing_obj, access_type=access_type, default=default,
+                                                    no_superuser_bypass=no_superuser_bypass, **kwargs)
+
+        token = caches.account_token(accessing_obj)
+        result = caches.get_access(token, self, access_type, default, no_superuser_bypass)
+        if result is None:
+            result = super(DefaultBoard, self).access(accessing_obj, access_type=access_type, default=default,
+                                                      no_superuser_bypass=no_superuser_bypass)
+            caches.set_access(token, self, access_type, default, no_superuser_bypass, result)
+
+        return result
+
     def posts(self, player=None):
         """
         Convenience function, pulls all the posts for a given player's viewpoint.
@@ -91,18 +125,66 @@ class DefaultBoard(with_metaclass(TypeclassBase, BoardDB)):
             caller: The player for whom these posts should be marked read.
 
         Returns:
-            None
+            The number of posts which were marked read.
 
         """
         if not self.access(caller, access_type="read", default=True):
-            return
+            return 0
+
+        return ReadState.objects.catch_up(caller, [self])
+
+    def delete_post(self, post):
+        """
+        Deletes a post from this board.  Any replies to it are moved up to its own parent,
+        and the running totals of the affected threads are updated to match.
+
+        Args:
+            post (Post): The post to delete.
 
-        posts = self.posts(caller)
-        for p in posts:
-            if p.is_unread:
-                p.mark_read(caller, True)
+        Returns:
+            None
+
+        """
+        with transaction.atomic():
+            parent = post.db_parent
+            replies = list(Post.objects.filter(db_parent=post))
+            for r in replies:
+                r.db_parent = parent
+                r.save()
+
+            post.delete()
+
+            if parent:
+                parent.update_thread_stats()
+            else:
+                for r in replies:
+                    r.update_thread_stats()
+
+    def delete_posts(self, posts):
+        """
+        Deletes several posts from this board at once.  Unlike delete_post, replies to
+        the posts aren't moved up to take their place, so this should be given whole
+        threads, or replies nobody has replied to; anything else replying to one of the
+        posts is deleted along with it.  The running totals of the threads which lose
+        replies are updated to match.
+
+        Args:
+            posts (list): The posts to delete.
+
+        Returns:
+            None
+
+        """
+        ids = set(p.id for p in posts)
+        parents = set(p.db_parent_id for p in posts if p.db_parent_id and p.db_parent_id not in ids)
 
-        return
+        with transaction.atomic():
+            for chunk in chunked(ids):
+                Post.objects.filter(pk__in=chunk).delete()
+
+            for chunk in chunked(parents):
+                for parent in Post.objects.filter(pk__in=chunk):
+                    parent.update_thread_stats()
 
     def is_unread(self):
         if hasattr(self, 'unread_count'):
@@ -136,34 +218,39 @@ class DefaultBoard(with_metaclass(TypeclassBase, BoardDB)):
         if not text or len(text) == 0:
             return False
 
-        p = Post(db_poster_player=author_player,
-                 db_poster_object=author_object,
-                 db_date_created=timezone.now(),
-                 db_subject=subject,
-                 db_board=self,
-                 db_text=text,
-                 db_poster_name=author_name,
-                 db_pinned=False,
-                 db_parent=parent)
-        p.save()
+        with transaction.atomic():
+            if parent:
+                # Lock the thread, so concurrent replies update its totals one at a time.
+                list(Post.objects.select_for_update().filter(pk=parent.pk))
+
+            now = timezone.now()
+            p = Post(db_poster_player=author_player,
+                     db_poster_object=author_object,
+                     db_date_created=now,
+                     db_subject=subject,
+                     db_board=self,
+                     db_text=text,
+                     db_poster_name=author_name,
+                     db_pinned=False,
+                     db_parent=parent,
+                     db_sequence=DefaultBoard.objects.allocate_sequence(self),
+                     db_last_post_on=now,
+                     db_last_poster_name=author_name)
+            p.update_renditions()
+            p.save()
+
+            if parent:
+                parent.update_thread_stats()
+
+            search.index_post(p)
 
         # If we are a player, mark our own post read.
         if author_player:
-            p.db_readers.add(author_player)
-
-        p.save()
-
-        postnum = p.post_num or None
-
-        # Give up
-        if not postnum:
-            return p
+            p.mark_read(author_player, True)
 
-        announcement = "|/New post by |555" + p.db_poster_name + ":|n (" + self.name + "/" + \
-                       str(postnum) + ") |555" + p.db_subject + "|n|/"
+        metrics.inc("paxboards_posts_created_total", board=self.name)
 
-        subs = self.subscribers()
-        for s in subs:
-            s.msg(announcement)
+        # Subscribers are told about the post once it's committed, off the posting path.
+        transaction.on_commit(lambda: notifications.post_created(p))
 
         return p
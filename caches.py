@@ -0,0 +1,401 @@
+"""
+In-process caches for the board system.
+
+Rather than trying to work out exactly which cached values a change affects, every cache
+here is keyed on version counters, which are bumped whenever something they depend on
+changes:
+
+- Each board has a version, bumped whenever a post on it is made, deleted or changed, or
+  the board itself is changed (locks, expiry settings, subscriptions).
+- A global version is bumped whenever any board or post is created, deleted or changed.
+- A registry version is bumped only when a board itself is created, deleted or changed
+  (renamed, relocked, resubscribed), since that can change which boards a player sees,
+  what they're called and in what order.  See paxboards.registry.
+- Each (account, board) pair has a read version, bumped whenever that account's read
+  state on that board changes.
+- Each account has a version, which can be bumped to drop anything cached about what
+  that account is allowed to do.
+
+The counters are bumped by the signal handlers in paxboards.models, so changes made
+through the admin interface or the ORM are seen as well as those made through commands.
+Stale entries simply stop matching and are replaced the next time they are looked up.
+
+Formatted posts are cached the same way, keyed on revision numbers stored on the posts
+themselves, and kept within a rough memory limit by dropping the least recently read.
+
+These caches live in the memory of a single process.  Evennia runs its webserver in the
+same process as the game, so on a standard install both see the same caches.
+
+"""
+import time
+from collections import defaultdict, OrderedDict
+
+from django.conf import settings
+
+from paxboards import metrics
+
+# How long, in seconds, an access check is trusted for.  Lock functions can depend on
+# things no counter tracks, such as attributes on the accessing object, so they have to
+# be looked at again now and then regardless.
+ACCESS_TTL = getattr(settings, "PAXBOARDS_ACCESS_CACHE_TTL", 60)
+ACCESS_MAX_ENTRIES = 50000
+
+# Roughly how many characters of rendered posts to keep, in total.
+RENDER_CACHE_SIZE = getattr(settings, "PAXBOARDS_RENDER_CACHE_SIZE", 4000000)
+
+# Counters start again from zero whenever the server restarts, so anything handed out
+# which is based on them, such as ETags, should include this too.
+EPOCH = int(time.time())
+
+_board_versions = defaultdict(int)
+_read_versions = defaultdict(int)
+_account_read_versions = defaultdict(int)
+_account_versions = defaultdict(int)
+_global_version = [0]
+_registry_version = [0]
+
+# When each counter was last bumped, for Last-Modified headers.
+_board_times = {}
+_read_times = {}
+_global_time = [EPOCH]
+
+# account id -> (registry version, account token, [board ids], time worked out)
+_readable = {}
+
+# (account id, board id) -> ((board version, read version, oldest date), summary)
+_summaries = {}
+
+# board id -> ((board version, max posts, oldest date), (cutoff,))
+_cutoffs = {}
+
+# (account token, board id, lock storage, access type, default, no superuser bypass)
+#    -> (result, time checked)
+_access = {}
+
+# (post id, revision, thread revision, post number, pinned, board name) -> rendered text,
+# least recently used first; and post id -> the keys cached for that post.
+_renders = OrderedDict()
+_render_keys = defaultdict(set)
+_render_size = [0]
+
+
+def _count(cache, hit):
+    metrics.inc("paxboards_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+def board_version(board_id):
+    """
+    Returns the current version of a board.
+
+    """
+    return _board_versions[board_id]
+
+
+def global_version():
+    """
+    Returns the current version of the set of boards as a whole.
+
+    """
+    return _global_version[0]
+
+
+def registry_version():
+    """
+    Returns the current version of the boards themselves, not counting their posts.
+
+    """
+    return _registry_version[0]
+
+
+def read_version(account_id, board_id):
+    """
+    Returns the current version of an account's read state on a board.
+
+    """
+    return _read_versions[(account_id, board_id)]
+
+
+def bump_board(board_id):
+    """
+    Records that a board, or the posts on it, have changed.
+
+    """
+    _board_versions[board_id] += 1
+    _global_version[0] += 1
+    _board_times[board_id] = _global_time[0] = time.time()
+
+
+def bump_registry():
+    """
+    Records that a board has been created, deleted, renamed or otherwise changed itself.
+
+    """
+    _registry_version[0] += 1
+
+
+def bump_reads(account_id, board_id):
+    """
+    Records that an account's read state on a board has changed.
+
+    """
+    _read_versions[(account_id, board_id)] += 1
+    _account_read_versions[account_id] += 1
+    _read_times[(account_id, board_id)] = _read_times[account_id] = time.time()
+
+
+def account_read_version(account_id):
+    """
+    Returns a version which changes whenever an account's read state on any board does.
+
+    """
+    return _account_read_versions[account_id]
+
+
+def last_changed(account_id, board_id=None):
+    """
+    Returns when anything an account sees of a board, or of the boards as a whole,
+    last changed, as a timestamp.
+
+    Args:
+        account_id (int): The account looking.
+        board_id (int): The board, or None for all of them.
+
+    Returns:
+        A timestamp.
+
+    """
+    if board_id is None:
+        return max(_global_time[0], _read_times.get(account_id, EPOCH))
+
+    return max(_board_times.get(board_id, EPOCH), _read_times.get((account_id, board_id), EPOCH))
+
+
+def invalidate_account(account_id):
+    """
+    Drops everything cached for an account.  The caches notice changes to an account's
+    permissions by themselves, but this can be called when anything else affecting what
+    an account may see has changed.
+
+    """
+    _account_versions[account_id] += 1
+    _readable.pop(account_id, None)
+    for key in [k for k in _summaries if k[0] == account_id]:
+        del _summaries[key]
+
+
+def account_token(accessor):
+    """
+    Builds a value identifying an accessing account or object together with everything
+    about it lock checks usually depend on: its permissions, its superuser status, and
+    the permissions of the account behind it, if it is a puppet.  If any of these change,
+    so does the token.
+
+    Args:
+        accessor (AccountDB or ObjectDB): The account or object checking access.
+
+    Returns:
+        A hashable tuple.
+
+    """
+    token = [accessor.__dbclass__.__name__, accessor.id, _account_versions[accessor.id],
+             tuple(sorted(accessor.permissions.all())), bool(getattr(accessor, "is_superuser", False))]
+
+    account = getattr(accessor, "account", None)
+    if account and account is not accessor:
+        token.extend([account.id, _account_versions[account.id], tuple(sorted(account.permissions.all())),
+                      bool(account.is_superuser)])
+
+    return tuple(token)
+
+
+def get_access(token, board, access_type, default, no_superuser_bypass):
+    """
+    Returns a cached access check, or None if it isn't cached or has gone stale.  Since
+    the board's lock string is part of the key, changing a board's locks means its old
+    checks no longer match.
+
+    """
+    entry = _access.get((token, board.id, board.db_lock_storage, access_type, default, no_superuser_bypass))
+    if entry and time.time() - entry[1] < ACCESS_TTL:
+        _count("access", True)
+        return entry[0]
+
+    _count("access", False)
+    return None
+
+
+def set_access(token, board, access_type, default, no_superuser_bypass, result):
+    """
+    Caches the result of an access check.
+
+    """
+    if len(_access) >= ACCESS_MAX_ENTRIES:
+        _access.clear()
+
+    _access[(token, board.id, board.db_lock_storage, access_type, default, no_superuser_bypass)] = \
+        (result, time.time())
+
+
+def invalidate_access(board_id):
+    """
+    Drops every cached access check for a board.
+
+    """
+    for key in [k for k in _access if k[1] == board_id]:
+        del _access[key]
+
+
+def get_readable(account_id, token):
+    """
+    Returns the cached ids of the boards an account can read, or None if they aren't
+    cached or are out of date.  Like access checks, these are looked at again after
+    ACCESS_TTL seconds even if nothing seems to have changed.
+
+    """
+    entry = _readable.get(account_id)
+    if entry and entry[0] == _registry_version[0] and entry[1] == token and \
+            time.time() - entry[3] < ACCESS_TTL:
+        _count("readable", True)
+        return entry[2]
+
+    _count("readable", False)
+    return None
+
+
+def set_readable(account_id, version, token, board_ids):
+    """
+    Caches the ids of the boards an account can read.
+
+    Args:
+        account_id (int): The account the list is for.
+        version (int): The registry version from before the list was worked out.
+        token (tuple): The account's token, from account_token.
+        board_ids (list): The ids of the readable boards, in order.
+
+    """
+    _readable[account_id] = (version, token, list(board_ids), time.time())
+
+
+def summary_versions(account_id, board_id, oldest):
+    """
+    Returns the versions a summary of a board for an account depends on.  These should be
+    taken before working the summary out, so a change made meanwhile isn't missed.
+
+    Args:
+        account_id (int): The account the summary is for.
+        board_id (int): The board the summary is of.
+        oldest (datetime): The oldest date the board's duration limit lets it show, as
+            that changes what's visible from day to day.
+
+    Returns:
+        A tuple.
+
+    """
+    return _board_versions[board_id], _read_versions[(account_id, board_id)], oldest
+
+
+def get_summary(account_id, board_id, versions):
+    """
+    Returns the cached summary of a board for an account, or None if it isn't cached or
+    is out of date.
+
+    """
+    entry = _summaries.get((account_id, board_id))
+    if entry and entry[0] == versions:
+        _count("summary", True)
+        return entry[1]
+
+    _count("summary", False)
+    return None
+
+
+def set_summary(account_id, board_id, versions, summary):
+    """
+    Caches the summary of a board for an account.
+
+    """
+    _summaries[(account_id, board_id)] = (versions, summary)
+
+
+def get_cutoff(board_id, versions):
+    """
+    Returns a board's cached visible-window cutoff, wrapped in a tuple, or None if it
+    isn't cached or is out of date.
+
+    """
+    entry = _cutoffs.get(board_id)
+    if entry and entry[0] == versions:
+        _count("cutoff", True)
+        return entry[1]
+
+    _count("cutoff", False)
+    return None
+
+
+def set_cutoff(board_id, versions, cutoff):
+    """
+    Caches a board's visible-window cutoff.
+
+    """
+    _cutoffs[board_id] = (versions, cutoff)
+
+
+def get_render(key):
+    """
+    Returns a cached rendering of a post, or None if it isn't cached.  The key includes
+    the post's revisions, so an edited post, or a thread with new replies, no longer
+    matches its old rendering.
+
+    """
+    text = _renders.pop(key, None)
+    if text is not None:
+        _renders[key] = text
+
+    _count("render", text is not None)
+    return text
+
+
+def set_render(key, text):
+    """
+    Caches a rendering of a post, dropping the least recently used renderings if the
+    cache has grown past RENDER_CACHE_SIZE.
+
+    Args:
+        key (tuple): The rendering's key, starting with the post's id.
+        text (str): The rendered post.
+
+    """
+    if len(text) > RENDER_CACHE_SIZE:
+        return
+
+    _drop_render(key)
+    _renders[key] = text
+    _render_keys[key[0]].add(key)
+    _render_size[0] += len(text)
+
+    while _render_size[0] > RENDER_CACHE_SIZE:
+        _drop_render(next(iter(_renders)))
+
+
+def _drop_render(key):
+    text = _renders.pop(key, None)
+    if text is None:
+        return
+
+    _render_size[0] -= len(text)
+    keys = _render_keys.get(key[0])
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del _render_keys[key[0]]
+
+
+def forget_render(post_id):
+    """
+    Drops every cached rendering of a post.  Renderings are normally replaced by their
+    keys changing; this catches changes which don't bump a revision, such as edits made
+    through the admin interface.
+
+    """
+    for key in list(_render_keys.get(post_id, ())):
+        _drop_render(key)
@@ -1,13 +1,25 @@
+import os
+
 from evennia import default_cmds
 from evennia.locks.lockhandler import LockException
 from evennia import CmdSet
 from evennia.utils import evtable
+from twisted.internet import task
 from typeclasses.characters import Character
 from typeclasses.objects import Object
 
 from board_utils import *
 from boards import DefaultBoard
-from models import Post
+from models import Post, ReadState, ArchivedPost
+import caches
+import notifications
+import profiling
+import scripts
+import search
+import transfer
+
+# How many archived posts bboard/archive lists at a time.
+ARCHIVE_PAGE_SIZE = 50
 
 def is_positive_int(string):
     """
@@ -31,6 +43,14 @@ class BoardAdminCmd(default_cmds.MuxCommand):
     """
     bbadmin/create <name>
     bbadmin/lock <board>[=lock]
+    bbadmin/maxdays <board>[=days]
+    bbadmin/maxposts <board>[=posts]
+    bbadmin/truncate <board>[=on or off]
+    bbadmin/archive <board>[=days]
+    bbadmin/rebuild <board or "all">
+    bbadmin/stats [on, off or reset]
+    bbadmin/import <file>[=restart]
+    bbadmin/export[/reads] <board or "all">=<file>
 
     The first form of the command will create a new board.  The name must be unique,
     and cannot be solely an integer string.
@@ -46,12 +66,46 @@ class BoardAdminCmd(default_cmds.MuxCommand):
 
     Wizards and Immortals have all permissions by default.
 
+    The maxdays and maxposts forms set how long posts remain visible on a board, and
+    how many posts it shows at most.  Leaving off the value clears the limit.
+
+    Expired posts are normally just hidden.  The truncate form sets a board to delete
+    them for real instead, a batch at a time in the background, which keeps very busy
+    boards small.  Without a value, it shows whether the board truncates.
+
+    The archive form sets an age in days after which threads nobody has posted in are
+    moved out to a board's archive, replies and all, in the background, where they can
+    still be read with bboard/archive.
+    Leaving off the value stops archiving.  If the board also truncates, its expired
+    posts are archived rather than deleted.
+
+    The rebuild form recalculates the stored data derived from a board's posts, such
+    as their sequence numbers, thread totals, plain text and HTML versions, and search
+    index, and converts the record of who has read what kept by older versions into
+    read states.  This is only needed for boards with posts made by an older version of
+    the board system.
+
+    The stats form shows which bboard and bbadmin switches and board web pages have
+    taken the most time, with how many database queries and rows each needed, while
+    profiling is on.  It can also turn profiling on or off, or reset the figures.
+
+    The import form imports boards, posts and read states from a JSON Lines file in the
+    game's server/paxboards directory; see paxboards.transfer for the format.  It runs
+    in the background, a batch at a time.  An interrupted import picks up where it left
+    off when run again, unless given '=restart'.
+
+    The export form writes a board, or all of them, to a file in the same directory, in
+    the format import reads.  With /reads, everyone's read states are included too.  If
+    the file name ends in .gz, it is gzipped, and if it ends in .mbox (or .mbox.gz), the
+    posts are written as an mbox mailbox instead.
+
     """
     key = "bbadmin"
     aliases = ["@bbadmin", "forumadmin", "@forumadmin"]
     locks = "cmd:perm(Wizards) OR perm(bbadmin)"
     help_category = "Forum"
 
+    @profiling.profiled_command
     def func(self):
         if "create" in self.switches:
             testboard = DefaultBoard.objects.get_board_exact(self.args)
@@ -97,6 +151,8 @@ class BoardAdminCmd(default_cmds.MuxCommand):
             except LockException, err:
                 self.msg(err)
                 return
+            finally:
+                caches.invalidate_access(board.id)
 
             self.msg("Lock(s) applied.")
             string = "Current locks on %s: %s" % (board.name, board.locks)
@@ -159,6 +215,180 @@ class BoardAdminCmd(default_cmds.MuxCommand):
             board.save()
             return
 
+        if "truncate" in self.switches:
+            if not self.lhs:
+                self.msg("You must provide a bboard name!")
+                return
+
+            board = DefaultBoard.objects.get_board(self.lhs)
+            if not board:
+                self.msg("No board matches '" + self.lhs + "'")
+                return
+
+            if not self.rhs:
+                self.msg(board.name + (" deletes" if board.db_truncate else " hides") + " expired posts.")
+                return
+
+            if self.rhs.lower() not in ("on", "off"):
+                self.msg("You must set truncation 'on' or 'off'.")
+                return
+
+            board.db_truncate = self.rhs.lower() == "on"
+            board.save()
+
+            if board.db_truncate:
+                scripts.ensure_sweeper()
+                self.msg("Expired posts on " + board.name + " will now be deleted.")
+            else:
+                self.msg("Expired posts on " + board.name + " will now be hidden, but kept.")
+            return
+
+        if "archive" in self.switches:
+            if not self.lhs:
+                self.msg("You must provide a bboard name!")
+                return
+
+            if self.rhs and not is_positive_int(self.rhs):
+                self.msg("Your archive age must be a positive integer.")
+                return
+
+            board = DefaultBoard.objects.get_board(self.lhs)
+            if not board:
+                self.msg("No board matches '" + self.lhs + "'")
+                return
+
+            if not self.rhs:
+                board.db_archive_days = None
+                self.msg("Posts on " + board.name + " will no longer be archived.")
+            else:
+                board.db_archive_days = int(self.rhs)
+                scripts.ensure_sweeper()
+                self.msg("Posts on " + board.name + " will be archived after " + str(board.db_archive_days) +
+                         " days.")
+
+            board.save()
+            return
+
+        if "rebuild" in self.switches:
+            if not self.args:
+                self.msg("You must provide a bboard name, or 'all'!")
+                return
+
+            if self.args == "all":
+                boards = DefaultBoard.objects.get_all_boards()
+            else:
+                board = DefaultBoard.objects.get_board(self.args)
+                if not board:
+                    self.msg("No board matches '" + self.args + "'")
+                    return
+                boards = [board]
+
+            for board in boards:
+                count = Post.objects.renumber(board)
+                threads = Post.objects.rebuild_threads(board)
+                Post.objects.rebuild_renditions(board)
+                search.rebuild(board)
+                readers = ReadState.objects.convert_readers(board)
+                self.msg("Rebuilt " + board.name + ": " + str(count) + " posts, " + str(threads) + " threads" +
+                         (", " + str(readers) + " players' old read posts converted." if readers else "."))
+            return
+
+        if "import" in self.switches:
+            if not self.lhs:
+                self.msg("You must provide a file to import!")
+                return
+
+            path = transfer.transfer_path(self.lhs)
+            if not path or not os.path.isfile(path):
+                self.msg("There is no file named '" + self.lhs + "' in " + transfer.TRANSFER_DIR + ".")
+                return
+
+            importer = transfer.Importer(path, restart=(self.rhs == "restart"))
+            caller = self.caller
+
+            def _done(result):
+                counts = importer.counts
+                caller.msg("Import of " + self.lhs + " finished: " + str(counts["boards"]) + " boards, " +
+                           str(counts["posts"]) + " posts, " + str(counts["reads"]) + " read states; " +
+                           str(counts["skipped"]) + " posts already imported, " + str(counts["orphans"]) +
+                           " replies without threads, " + str(counts["errors"]) + " bad records.")
+
+            def _failed(failure):
+                caller.msg("Import of " + self.lhs + " failed at line " + str(importer.line) + ": " +
+                           failure.getErrorMessage() + "  Run it again to resume.")
+
+            task.cooperate(importer.run()).whenDone().addCallbacks(_done, _failed)
+            self.msg("Importing " + self.lhs + " in the background.")
+            return
+
+        if "export" in self.switches:
+            if not self.lhs or not self.rhs:
+                self.msg("You must provide a board, or 'all', and a file to export to!")
+                return
+
+            if self.lhs == "all":
+                boards = list(DefaultBoard.objects.get_all_boards())
+            else:
+                board = DefaultBoard.objects.get_board(self.lhs)
+                if not board:
+                    self.msg("No board matches '" + self.lhs + "'")
+                    return
+                boards = [board]
+
+            path = transfer.transfer_path(self.rhs)
+            if not path:
+                self.msg("You can only export to files in " + transfer.TRANSFER_DIR + ".")
+                return
+
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            exporter = transfer.Exporter(path, boards, read_receipts=("reads" in self.switches))
+            caller = self.caller
+
+            def _exported(result):
+                caller.msg("Export to " + self.rhs + " finished: " + str(exporter.lines) + " records.")
+
+            def _export_failed(failure):
+                caller.msg("Export to " + self.rhs + " failed: " + failure.getErrorMessage())
+
+            task.cooperate(exporter.run()).whenDone().addCallbacks(_exported, _export_failed)
+            self.msg("Exporting to " + self.rhs + " in the background.")
+            return
+
+        if "stats" in self.switches:
+            if self.args == "on" or self.args == "off":
+                profiling.enable(self.args == "on")
+                self.msg("Profiling is now " + self.args + ".")
+                return
+
+            if self.args == "reset":
+                profiling.reset()
+                self.msg("Profiling figures reset.")
+                return
+
+            if self.args:
+                self.msg("You must give 'on', 'off' or 'reset', or nothing to see the figures.")
+                return
+
+            stats = profiling.stats()
+            if not stats:
+                self.msg("No profiling figures have been recorded.  Profiling is " +
+                         ("on." if profiling.enabled[0] else "off; turn it on with " + self.cmdstring + "/stats on."))
+                return
+
+            table = evtable.EvTable("Name", "Calls", "Total ms", "p50 ms", "p95 ms", "Max ms", "Queries", "DB ms",
+                                    "Rows")
+            for name, s in stats[:20]:
+                table.add_row(name, s.calls, "%.0f" % (s.wall * 1000), "%.1f" % (s.percentile(50) * 1000),
+                              "%.1f" % (s.percentile(95) * 1000), "%.1f" % (s.wall_max * 1000),
+                              "%.1f" % (float(s.queries) / s.calls), "%.1f" % (s.db_time * 1000 / s.calls),
+                              "%.0f" % (float(s.rows) / s.calls))
+            self.msg(table)
+            self.msg("Queries, DB time and rows are per call.  Profiling is " +
+                     ("on." if profiling.enabled[0] else "off."))
+            return
+
         self.msg("Unknown switch.  Please see {555help " + self.cmdstring + "{n for help.")
 
 
@@ -177,6 +407,7 @@ class BoardCmd(default_cmds.MuxCommand):
     bboard/search [board/]<search>
     bboard/reply <board>/<post>=<reply>
     bboard/thread <board>/<post>
+    bboard/archive <board>[/<post>][=<page>]
 
     The first and second forms of this command will read the bboards.  If no
     parameters are provided, it list all available bboards.  If a single
@@ -195,10 +426,16 @@ class BoardCmd(default_cmds.MuxCommand):
     the next unread post on the given board, or globally, and the ninth will mark all
     posts read on the given board (or 'all').
 
-    The tenth will search bboards for posts containing a given term.
+    The tenth will search bboards for posts containing all the given words, in their
+    subject, poster or text.  Put words in "quotes" to search for an exact phrase, or
+    end a word with * to match any word starting with it.  The best matches are listed
+    first.
 
     The eleventh will reply to an existing post, creating a thread, while the twelfth
     will show all posts in a given thread.
+
+    The last will list the old posts which have been moved to a board's archive, a
+    page at a time, or read one of them.
     """
     key = "bboard"
     aliases = ["@bb", "@bboard", "forum", "@forum", "@bbread", "@bbnew"]
@@ -253,23 +490,24 @@ class BoardCmd(default_cmds.MuxCommand):
 
     # This is overly long, and could potentially use a refactor to split the switches out
     # into their own functions.
+    @profiling.profiled_command
     def func(self):
         caller = self.account
 
-        boards = DefaultBoard.objects.get_all_visible_boards(caller)
         shortcut = False
         if self.cmdstring in ["@bbread", "@bbnew"]:
             shortcut = True
 
         if "read" in self.switches or "thread" in self.switches or self.cmdstring == "@bbread" or (len(self.switches) == 0 and not shortcut):
             if not self.lhs:
+                boards = DefaultBoard.objects.get_all_visible_boards(caller)
                 table = evtable.EvTable("#", "Name", "Unread", "Total", "Sub'd")
                 counter = 0
                 for board in boards:
                     counter += 1
 
                     subbed = " "
-                    if board.subscribers().filter(pk=caller.pk).exists():
+                    if board.subscribed:
                         subbed = "Yes"
 
                     table.add_row(counter, board.name, board.unread_count, board.total_count, subbed)
@@ -313,8 +551,7 @@ class BoardCmd(default_cmds.MuxCommand):
                             post = post.db_parent
 
                     post.display_post(caller, show_replies=("thread" in self.switches))
-                    post.db_readers.add(caller)
-                    post.save()
+                    post.mark_read(caller, True)
 
                     return
 
@@ -337,6 +574,7 @@ class BoardCmd(default_cmds.MuxCommand):
             pinvalue = "pin" in self.switches
             post.db_pinned = pinvalue
             post.save()
+            notifications.post_pinned(post)
 
             self.msg("Pinned.") if pinvalue else self.msg("Unpinned.")
             return
@@ -345,11 +583,12 @@ class BoardCmd(default_cmds.MuxCommand):
             table = evtable.EvTable("#", "Name", "Unread", "Total", "Sub'd")
             counter = 0
             has_unread = False
+            boards = DefaultBoard.objects.get_all_visible_boards(caller)
             for board in boards:
                 counter += 1
 
                 subbed = " "
-                if board.subscribers().filter(pk=caller.pk).exists():
+                if board.subscribed:
                     subbed = "Yes"
 
                 if board.unread_count > 0:
@@ -364,9 +603,10 @@ class BoardCmd(default_cmds.MuxCommand):
 
         if "new" in self.switches or self.cmdstring == "@bbnew":
             if not self.lhs:
+                boards = DefaultBoard.objects.get_all_visible_boards(caller)
                 for b in boards:
 
-                    if b.subscribers().filter(pk=caller.pk).exists():
+                    if b.subscribed and b.unread_count > 0:
                         posts = b.posts(caller)
                         for p in posts:
                             if p.is_unread:
@@ -401,21 +641,19 @@ class BoardCmd(default_cmds.MuxCommand):
                 return
 
             if self.lhs == "all":
-                boards = DefaultBoard.objects.get_all_visible_boards(caller)
-                for b in boards:
-                    b.mark_all_read(caller)
+                boards = DefaultBoard.objects.get_readable_boards(caller)
+                count = ReadState.objects.catch_up(caller, boards)
 
-                self.msg("All boards marked read.")
+                self.msg("All boards marked read (" + str(count) + " posts).")
                 return
 
             result = self.resolve_id(self.lhs)
-            board = result["board"]
-            if not board:
-                self.msg("Unable to find a board matching '" + self.lhs+ "'!")
+            if not result:
                 return
 
-            board.mark_all_read(caller)
-            self.msg("All posts on " + board.name + " marked read.")
+            board = result["board"]
+            count = board.mark_all_read(caller)
+            self.msg("All posts on " + board.name + " marked read (" + str(count) + " posts).")
             return
 
         if "post" in self.switches:
@@ -559,7 +797,7 @@ class BoardCmd(default_cmds.MuxCommand):
                     self.msg("Unable to find a unique board batching '" + boardname + "'")
                     return
 
-            posts = Post.objects.search(searchterm, board)
+            posts = Post.objects.search(searchterm, board, player=caller)
             if len(posts) == 0:
                 self.msg("No posts matching search term.")
                 return
@@ -585,6 +823,61 @@ class BoardCmd(default_cmds.MuxCommand):
             self.msg(table)
             return
 
+        if "archive" in self.switches:
+            if not self.lhs:
+                self.msg("You must provide a board whose archive you want to read.")
+                return
+
+            readargs = self.lhs.split('/', 1)
+            board = DefaultBoard.objects.get_visible_board(caller, readargs[0])
+            if not board:
+                self.msg("Unable to find a board matching '" + readargs[0] + "'!")
+                return
+
+            archived = ArchivedPost.objects.by_board(board)
+
+            if len(readargs) == 2:
+                if not is_positive_int(readargs[1]):
+                    self.msg("The post identifier '" + readargs[1] + "' must be a positive integer!")
+                    return
+
+                found = archived[int(readargs[1]) - 1:int(readargs[1])]
+                if not found:
+                    self.msg("There's no archived post by that number.")
+                    return
+
+                found[0].display_post(caller)
+                return
+
+            if self.rhs and not is_positive_int(self.rhs):
+                self.msg("The page number must be a positive integer!")
+                return
+
+            page = int(self.rhs) if self.rhs else 1
+            start = (page - 1) * ARCHIVE_PAGE_SIZE
+            rows = list(archived.values_list('db_poster_name', 'db_subject',
+                                             'db_date_created')[start:start + ARCHIVE_PAGE_SIZE + 1])
+            if not rows:
+                self.msg("No archived posts on " + board.name + ("" if page == 1 else " on that page."))
+                return
+
+            more = len(rows) > ARCHIVE_PAGE_SIZE
+            table = evtable.EvTable("", "Poster", "Subject", "Date")
+            counter = start
+            for poster, subject, date in rows[:ARCHIVE_PAGE_SIZE]:
+                counter += 1
+
+                datestring = str(date.year) + "/"
+                datestring += str(date.month).rjust(2, '0') + "/"
+                datestring += str(date.day).rjust(2, '0')
+
+                table.add_row(board.name + "/" + str(counter), poster, subject, datestring)
+
+            self.msg(table)
+            if more:
+                self.msg("For more, use bboard/archive " + board.name + "=" + str(page + 1))
+            return
+
         if "edit" in self.switches:
             result = self.resolve_id(self.lhs)
 
@@ -603,8 +896,8 @@ class BoardCmd(default_cmds.MuxCommand):
                 self.msg("You can't edit that post!")
                 return
 
-            post.db_text = self.rhs
-            post.save()
+            post.edit(self.rhs)
+            search.index_post(post)
             self.msg("Post updated.")
             return
 
@@ -627,12 +920,7 @@ class BoardCmd(default_cmds.MuxCommand):
                 return
 
             # TODO: Should we delete this or just unlink it?
-            replies = Post.objects.filter(db_parent=post)
-            for r in replies:
-                r.db_parent = post.db_parent
-                r.save()
-
-            post.delete()
+            result["board"].delete_post(post)
             self.msg("Post deleted.")
             return
 
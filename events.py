@@ -0,0 +1,214 @@
+"""
+A live feed of board events for web clients.
+
+Every new post, reply, pin and unpin is kept, briefly, in a single ring buffer of the
+last BUFFER_SIZE events, fed by a listener registered with paxboards.notifications -- the
+same announcements the game sends to subscribers.  Web clients waiting for events (see
+the event stream and long-poll views in paxboards.api) all wait on this one buffer, and
+are woken when something is added to it, so a client which is waiting costs a webserver
+thread but no database queries.  So that they can't take every thread, no more than
+MAX_CLIENTS may wait at once.  Each client only gets the events of boards it can read.
+
+Events are numbered in order, and a client which reconnects can pass the number of the
+last event it saw to pick up where it left off.  If it was away long enough for the
+events it missed to have left the buffer, or the server has restarted meanwhile, it is
+told to start again by reloading instead.  As with paxboards.caches, this relies on the
+game and the webserver sharing one process, as they do on a standard install.
+
+"""
+import threading
+from collections import deque
+
+from django.conf import settings
+from twisted.internet import reactor
+
+from paxboards import caches, notifications
+
+BUFFER_SIZE = getattr(settings, "PAXBOARDS_EVENT_BUFFER_SIZE", 500)
+
+# How many clients may wait for events at once.  Each holds a webserver thread while it
+# waits, so by default they may take up to half of the threads, leaving the rest for
+# everything else.
+MAX_CLIENTS = getattr(settings, "PAXBOARDS_EVENT_MAX_CLIENTS",
+                      max(1, getattr(settings, "WEBSERVER_THREADPOOL_LIMITS", (1, 20))[1] // 2))
+
+# How often waiting clients are woken even if nothing has happened, in seconds, so
+# they can send keepalives and notice when they've waited long enough.
+HEARTBEAT = 15
+
+_DefaultBoard = None
+
+_buffer = deque(maxlen=BUFFER_SIZE)
+_last_id = [0]
+_condition = threading.Condition()
+_heartbeat = [None]
+_clients = [0]
+
+
+class Event(object):
+    """
+    A board event, as sent to web clients.
+
+    Args:
+        number (int): The event's place in the order of events.
+        event (str): One of "post", "reply", "pin" or "unpin".
+        post (Post): The post the event is about.
+
+    """
+    def __init__(self, number, event, post):
+        self.number = number
+        self.event = event
+        self.board_id = post.db_board_id
+        self.data = {"board": {"id": post.db_board_id, "name": post.db_board.name},
+                     "id": post.id, "parent": post.db_parent_id, "subject": post.db_subject,
+                     "poster": post.db_poster_name, "pinned": post.db_pinned, "excerpt": post.excerpt,
+                     "date": post.db_date_created.isoformat() if post.db_date_created else None}
+
+    @property
+    def id(self):
+        return make_id(self.number)
+
+
+def make_id(number):
+    """
+    Builds the ID a client is given for an event, which includes when the server started,
+    as event numbers start again from one with every restart.
+
+    """
+    return "%d-%d" % (caches.EPOCH, number)
+
+
+def parse_id(event_id):
+    """
+    Works out which event an ID given by a client refers to.
+
+    Args:
+        event_id (str): The ID.
+
+    Returns:
+        The event's number, or None if the ID isn't one this server gave out.
+
+    """
+    try:
+        epoch, number = event_id.split("-")
+        epoch, number = int(epoch), int(number)
+    except (AttributeError, ValueError):
+        return None
+
+    if epoch != caches.EPOCH or number < 0 or number > _last_id[0]:
+        return None
+
+    return number
+
+
+def last_id():
+    """
+    Returns the number of the most recent event, or 0 if there hasn't been one.
+
+    """
+    return _last_id[0]
+
+
+def _add(event, post):
+    with _condition:
+        _last_id[0] += 1
+        _buffer.append(Event(_last_id[0], event, post))
+        _condition.notify_all()
+
+
+def events_after(number):
+    """
+    Returns the events since a given one.
+
+    Args:
+        number (int): The number of the last event the caller has seen.
+
+    Returns:
+        A list of Events, oldest first, or None if some of the events since then are no
+        longer kept.
+
+    """
+    with _condition:
+        if number >= _last_id[0]:
+            return []
+
+        if not _buffer or _buffer[0].number > number + 1:
+            return None
+
+        return list(_buffer)[number + 1 - _buffer[0].number:]
+
+
+def wait(number):
+    """
+    Waits until there are events since a given one, or until the next heartbeat.  This
+    blocks, so must not be called from the reactor.
+
+    Args:
+        number (int): The number of the last event the caller has seen.
+
+    """
+    with _condition:
+        _start_heartbeat()
+        if _last_id[0] > number:
+            return
+
+        if reactor.running:
+            _condition.wait()
+        else:
+            _condition.wait(HEARTBEAT)
+
+
+def join():
+    """
+    Takes one of the places for clients waiting for events, if any are free.  Call leave
+    once the client is done.
+
+    Returns:
+        True if the client may wait for events, False if too many already are.
+
+    """
+    with _condition:
+        if _clients[0] >= MAX_CLIENTS:
+            return False
+
+        _clients[0] += 1
+        return True
+
+
+def leave():
+    """
+    Gives up a place taken by join.
+
+    """
+    with _condition:
+        _clients[0] = max(0, _clients[0] - 1)
+
+
+def _wake():
+    with _condition:
+        _condition.notify_all()
+
+
+def _start_heartbeat():
+    if _heartbeat[0] or not reactor.running:
+        return
+
+    from twisted.internet.task import LoopingCall
+    _heartbeat[0] = LoopingCall(_wake)
+    reactor.callFromThread(_heartbeat[0].start, HEARTBEAT, now=False)
+
+
+def readable_boards(account):
+    """
+    Returns the IDs of the boards an account can read, to filter its events by.  This is
+    cached, and only looked up again when boards or the account's permissions change.
+
+    """
+    global _DefaultBoard
+    if not _DefaultBoard:
+        from paxboards.boards import DefaultBoard as _DefaultBoard
+
+    return set(b.id for b in _DefaultBoard.objects.get_readable_boards(account))
+
+
+notifications.add_listener(_add)
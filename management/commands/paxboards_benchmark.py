@@ -0,0 +1,74 @@
+"""
+Runs the board system's benchmarks; see paxboards.benchmark.
+
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paxboards import benchmark
+
+
+class Command(BaseCommand):
+    help = "Generates a synthetic board dataset and times the board system's hot paths against it."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--prefix", default="bench", help="Name prefix for the generated boards and accounts.")
+        parser.add_argument("--seed", type=int, default=1, help="Random seed.")
+        parser.add_argument("--boards", type=int, default=4, help="Number of boards to generate.")
+        parser.add_argument("--posts", type=int, default=2000, help="Number of posts to generate.")
+        parser.add_argument("--accounts", type=int, default=50, help="Number of accounts to generate.")
+        parser.add_argument("--days", type=int, default=60, help="How many days back the posts go.")
+        parser.add_argument("--reply-ratio", type=float, default=0.7, help="Fraction of posts which are replies.")
+        parser.add_argument("--read-ratio", type=float, default=0.85,
+                            help="Fraction of each board each account has read.")
+        parser.add_argument("--repeat", type=int, default=100, help="How many times to run each benchmark.")
+        parser.add_argument("--only", action="append", help="Only run the named benchmark; may be repeated.")
+        parser.add_argument("--output", help="Save the results as JSON to this file.")
+        parser.add_argument("--compare", help="Compare the results with an earlier JSON file.")
+        parser.add_argument("--keep", action="store_true", help="Keep the dataset afterwards.")
+        parser.add_argument("--reuse", action="store_true", help="Use a dataset kept from an earlier run.")
+        parser.add_argument("--cleanup", action="store_true", help="Just delete a kept dataset, and exit.")
+
+    def handle(self, *args, **options):
+        prefix = options["prefix"]
+
+        if options["cleanup"]:
+            benchmark.cleanup(prefix)
+            self.stdout.write("Deleted dataset '" + prefix + "'.")
+            return
+
+        params = dict((k, options[k]) for k in ("prefix", "seed", "boards", "posts", "accounts", "days",
+                                                "reply_ratio", "read_ratio", "repeat"))
+
+        if options["reuse"]:
+            dataset = benchmark.load(prefix)
+            if not dataset["boards"]:
+                raise CommandError("There is no kept dataset named '" + prefix + "'.")
+        else:
+            self.stdout.write("Generating dataset...")
+            try:
+                dataset = benchmark.generate(prefix=prefix, seed=options["seed"], boards=options["boards"],
+                                             posts=options["posts"], accounts=options["accounts"],
+                                             days=options["days"], reply_ratio=options["reply_ratio"],
+                                             read_ratio=options["read_ratio"])
+            except ValueError as e:
+                raise CommandError(str(e) + "  Use --reuse to benchmark it, or --cleanup to delete it.")
+
+        try:
+            results = benchmark.run(dataset, repeat=options["repeat"], seed=options["seed"], only=options["only"],
+                                    out=self.stdout)
+        finally:
+            if not options["keep"] and not options["reuse"]:
+                benchmark.cleanup(prefix)
+
+        if options["output"]:
+            benchmark.save(options["output"], benchmark.report(params, results))
+            self.stdout.write("Saved results to " + options["output"])
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                previous = json.load(f)
+            self.stdout.write("Compared with " + options["compare"] + ":")
+            for line in benchmark.compare(previous, results):
+                self.stdout.write(line)
@@ -0,0 +1,37 @@
+"""
+Exports boards to a JSON Lines file or mbox mailbox; see paxboards.transfer.
+
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from paxboards import transfer
+from paxboards.boards import DefaultBoard
+
+
+class Command(BaseCommand):
+    help = "Exports boards to a JSON Lines file (or an mbox mailbox, if the name ends in .mbox), gzipped if " \
+           "the name ends in .gz."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The file to write.")
+        parser.add_argument("--board", action="append", help="A board to export; may be repeated.  Defaults to all.")
+        parser.add_argument("--reads", action="store_true", help="Include everyone's read states.")
+
+    def handle(self, *args, **options):
+        if options["board"]:
+            boards = []
+            for key in options["board"]:
+                board = DefaultBoard.objects.get_board_exact(key)
+                if not board:
+                    raise CommandError("No board is named '" + key + "'.")
+                boards.append(board)
+        else:
+            boards = list(DefaultBoard.objects.get_all_boards())
+
+        exporter = transfer.Exporter(options["path"], boards, read_receipts=options["reads"])
+        try:
+            lines = exporter.export_all()
+        except IOError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("Exported %d boards to %s: %d records." % (len(boards), options["path"], lines))
@@ -0,0 +1,39 @@
+"""
+Imports board data from a JSON Lines file; see paxboards.transfer.
+
+This runs in a process of its own, so can't update the caches kept by a running game
+server.  New boards can be found by name in the game within a minute or so, but board
+counts and unread posts there may be out of date until the server is reloaded.
+
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from paxboards import transfer
+
+
+class Command(BaseCommand):
+    help = "Imports boards, posts and read states from a JSON Lines file (optionally gzipped).  If the game " \
+           "is running, @reload it afterwards, as its cached board counts and unread posts won't include " \
+           "what was imported until then."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The file to import.")
+        parser.add_argument("--batch-size", type=int, help="How many posts or read states to write at once.")
+        parser.add_argument("--restart", action="store_true",
+                            help="Start from the top, even if the file was partly imported before.")
+
+    def handle(self, *args, **options):
+        importer = transfer.Importer(options["path"], batch_size=options["batch_size"], restart=options["restart"])
+
+        try:
+            for counts in importer.run():
+                self.stdout.write("Line %d: %d posts imported." % (importer.line, counts["posts"]))
+        except IOError as e:
+            raise CommandError(str(e))
+
+        counts = importer.counts
+        self.stdout.write("Imported %d boards, %d posts and %d read states.  Skipped %d posts already imported; "
+                          "%d replies had no thread; %d records were bad." %
+                          (counts["boards"], counts["posts"], counts["reads"], counts["skipped"], counts["orphans"],
+                           counts["errors"]))
+        self.stdout.write("If the game is running, @reload it so it sees what was imported.")
@@ -1,17 +1,39 @@
 from __future__ import print_function
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Q, F, Max
+from collections import defaultdict
 from itertools import chain
-from datetime import datetime
+from datetime import datetime, timedelta
+from django.conf import settings
 from evennia.typeclasses.managers import (TypedObjectManager, TypeclassManager)
+from evennia.utils.idmapper.manager import SharedMemoryManager
+from django.utils import timezone
+from paxboards import caches as _CACHES
+from paxboards import receipts as _RECEIPTS
+from paxboards import registry as _REGISTRY
+from paxboards.slowlog import watched
 
 _GA = object.__getattribute__
 _AccountDB = None
 _ObjectDB = None
 _BoardDB = None
+_ReadState = None
+_Post = None
+_SEARCH = None
+_PAGING = None
 _SESSIONS = None
 
+# The boards whose threads have been through PostManager.fill_last_post_on.
+_filled_boards = set()
+
+# The order threads and replies are listed in, as (field, descending) pairs.  These
+# match the indexes on Post, so a page is one bounded query however deep it is.
+# Threads made by older versions have no db_last_post_on, so it is filled in before a
+# board is first paged; see PostManager.fill_last_post_on.
+THREAD_ORDERING = [("db_pinned", True), ("db_last_post_on", True), ("id", True)]
+REPLY_ORDERING = [("db_date_created", False), ("id", False)]
+
 
 def sort_date(post):
     result_time = 0
@@ -27,6 +49,59 @@ def sort_date(post):
     return result_pinned, result_time
 
 
+def expiry_date(board):
+    """
+    Works out the oldest date a board's duration limit lets it show, or None if it has no
+    limit.  This only moves forward at the start of each day.
+
+    Args:
+        board (Board): The BoardDB object to use.
+
+    Returns:
+        A datetime, or None.
+
+    """
+    if not board.db_expiry_duration:
+        return None
+
+    return start_of_day(board.db_expiry_duration)
+
+
+def start_of_day(days_ago):
+    """
+    Returns the start of the day a given number of days ago, in local time.
+
+    Args:
+        days_ago (int): The number of days back to go.
+
+    Returns:
+        A datetime.
+
+    """
+    today = timezone.localtime(timezone.now()) if settings.USE_TZ else timezone.now()
+    today = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=days_ago)
+
+
+def chunked(items, size=500):
+    """
+    Splits a list into chunks, to keep 'IN' clauses within database parameter limits.
+    Anything else given is made into a list first, so this is no way to walk a large
+    queryset or generator a chunk at a time.
+
+    Args:
+        items (list): The list to split.
+        size (int): The largest chunk to return.
+
+    Returns:
+        A generator of lists.
+
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def is_positive_int(string):
     """
     Tests whether the given string is a plain, positive integer.
@@ -72,31 +147,111 @@ class PostQuerySet(models.query.QuerySet):
             A list of Post objects.
 
         """
-        try:
-            if board.db_expiry_duration:
-                oldest = datetime.now() - timedelta(days=board.db_expiry_duration)
-                posts = self.filter(db_board=board).filter(Q(db_date_created__gte=oldest) | Q(db_pinned=True))\
-                    .order_by('-db_pinned', 'db_date_created')
-            else:
-                posts = self.filter(db_board=board).order_by('-db_pinned', 'db_date_created')
+        posts = self.filter(db_board=board)
 
-            # This is a little unfortunate
-            if board.db_expiry_maxposts and (board.db_expiry_maxposts > 0) and \
-                    (board.db_expiry_maxposts <= posts.count()):
-                pinned_count = self.filter(db_board=board, db_pinned=True).count()
-                max_normal = board.db_expiry_maxposts - (pinned_count + 1)
+        oldest = expiry_date(board)
+        cutoff = self.visible_cutoff(board, oldest)
+        if oldest is None and cutoff is None:
+            return posts.order_by('-db_pinned', 'db_sequence')
 
-                firstpost = posts[::-1][max_normal]
+        normal = Q()
+        if oldest is not None:
+            normal &= Q(db_date_created__gte=oldest)
+        if cutoff is not None:
+            normal &= Q(db_sequence__gte=cutoff)
 
-                posts = self.filter(Q(db_board=board) & (Q(db_pinned=True) | (Q(pk__gte=firstpost.id)))) \
-                        .order_by('-db_pinned','db_date_created')
+        return posts.filter(Q(db_pinned=True) | normal).order_by('-db_pinned', 'db_sequence')
 
+    def archivable_on_board(self, board):
+        """
+        Returns the unpinned posts starting threads on a board which have had nothing
+        posted in them for long enough to be moved to its archive.  Their replies should
+        be archived along with them.
 
-            return posts
+        Args:
+            board (Board): The BoardDB object to use.
 
-        except self.model.DoesNotExist:
-            return []
+        Returns:
+            A QuerySet of Post objects.
+
+        """
+        if not board.db_archive_days:
+            return self.none()
+
+        # Threads made by older versions may not have a last post date yet.
+        cutoff = start_of_day(board.db_archive_days)
+        inactive = Q(db_last_post_on__lt=cutoff) | Q(db_last_post_on__isnull=True, db_date_created__lt=cutoff)
+        return self.filter(db_board=board, db_parent__isnull=True, db_pinned=False).filter(inactive)
+
+    def expired_on_board(self, board):
+        """
+        Returns the posts on a board which have expired and are no longer shown, and can
+        be removed without leaving replies behind: expired replies, and expired posts
+        whose replies have all expired too.
+
+        Args:
+            board (Board): The BoardDB object to use.
+
+        Returns:
+            A QuerySet of Post objects.
+
+        """
+        oldest = expiry_date(board)
+        cutoff = self.visible_cutoff(board, oldest)
+        if oldest is None and cutoff is None:
+            return self.none()
+
+        expired = Q()
+        if oldest is not None:
+            expired |= Q(db_date_created__lt=oldest)
+        if cutoff is not None:
+            expired |= Q(db_sequence__lt=cutoff)
+
+        posts = self.filter(db_board=board)
+        live_replies = posts.filter(db_parent__isnull=False).exclude(Q(db_pinned=False) & expired)
+        return posts.filter(db_pinned=False).filter(expired).exclude(pk__in=live_replies.values('db_parent_id'))
+
+    @watched
+    def visible_cutoff(self, board, oldest):
+        """
+        Works out the sequence number of the oldest unpinned post a board's maximum post
+        count lets it show.  This is a single indexed query, and the result is cached until
+        a post is added, deleted or pinned, the board's settings change, or the day changes.
+
+        Args:
+            board (Board): The BoardDB object to use.
+            oldest (datetime): The oldest date the board's duration limit lets it show.
+
+        Returns:
+            A sequence number, or None if the board shows every unexpired post.
 
+        """
+        if not board.db_expiry_maxposts or board.db_expiry_maxposts <= 0:
+            return None
+
+        versions = (_CACHES.board_version(board.id), board.db_expiry_maxposts, oldest)
+        cached = _CACHES.get_cutoff(board.id, versions)
+        if cached is not None:
+            return cached[0]
+
+        cutoff = None
+        slots = board.db_expiry_maxposts - self.filter(db_board=board, db_pinned=True).count()
+        if slots <= 0:
+            # The pinned posts use up every slot.
+            cutoff = (board.db_last_sequence or 0) + 1
+        else:
+            normal = self.filter(db_board=board, db_pinned=False)
+            if oldest is not None:
+                normal = normal.filter(db_date_created__gte=oldest)
+
+            found = normal.order_by('-db_sequence').values_list('db_sequence', flat=True)[slots - 1:slots]
+            if found:
+                cutoff = found[0]
+
+        _CACHES.set_cutoff(board.id, versions, (cutoff,))
+        return cutoff
+
+    @watched
     def by_board_for_player(self, board, player):
         """
         Returns all the active posts on a board, with an 'unread' field based on the current user's
@@ -111,17 +266,40 @@ class PostQuerySet(models.query.QuerySet):
 
         """
         posts = self.by_board(board)
+        return self.annotate_unread(posts, board, player)
+
+    def annotate_unread(self, posts, board, player):
+        """
+        Annotates an entire window of posts with an 'unread' field, using a single lookup
+        of the player's read state for the board rather than one query per post.
+
+        Args:
+            posts (QuerySet): The posts to annotate; this will be evaluated.
+            board (BoardDB): The board the posts are on.
+            player (AccountDB): The player whose read/unread status should be used.
+
+        Returns:
+            The same posts, evaluated and annotated.
+
+        """
+        if not posts:
+            return posts
+
+        global _ReadState
+        if not _ReadState:
+            from paxboards.models import ReadState as _ReadState
+
+        state = _ReadState.objects.state_for(player, board)
         for p in posts:
-            if player.read_posts.filter(pk=p.id).exists():
-                setattr(p, "unread", False)
-            else:
-                setattr(p, "unread", True)
+            setattr(p, "unread", not state.is_read(p.id))
 
         return posts
 
+    @watched
     def by_board_threaded_player(self, board, player):
         """
-        Return just all the threads.
+        Return just all the threads, most recently active first, using the running totals
+        kept on each thread's first post.
 
         Args:
             board: The board to get threads for
@@ -131,20 +309,37 @@ class PostQuerySet(models.query.QuerySet):
             A list of Post objects
 
         """
-        posts = self.filter(db_board=board).filter(db_parent__isnull=True)
-        for p in posts:
-            lr = p.last_reply
-            setattr(p, "last_post_on", lr.db_date_created)
-            setattr(p, "last_poster", lr.db_poster_name)
-            replies = self.filter(db_parent=p)
-            setattr(p, "total_posts", replies.count() + 1)
-            if player:
-                if player.read_posts.filter(pk=lr.id).exists():
-                    setattr(p, "unread", False)
-                else:
-                    setattr(p, "unread", True)
+        posts = self.filter(db_board=board, db_parent__isnull=True)\
+            .order_by(*[("-" if descending else "") + field for field, descending in THREAD_ORDERING])
+
+        return self.annotate_threads_unread(posts, board, player)
 
-        return sorted(posts, key=lambda p: (p.db_pinned, p.date_for_sort), reverse=True)
+    def annotate_threads_unread(self, threads, board, player):
+        """
+        Annotates a list of threads with an 'unread' field, based on whether the player has
+        read the most recent post in each.
+
+        Args:
+            threads (list): The first posts of the threads to annotate.
+            board (BoardDB): The board the threads are on.
+            player (AccountDB): The player whose read/unread status should be used.
+
+        Returns:
+            The same threads, annotated.
+
+        """
+        if not player or not threads:
+            return threads
+
+        global _ReadState
+        if not _ReadState:
+            from paxboards.models import ReadState as _ReadState
+
+        state = _ReadState.objects.state_for(player, board)
+        for p in threads:
+            setattr(p, "unread", not state.is_read(p.db_last_reply_id or p.id))
+
+        return threads
 
 
 class PostManager(TypedObjectManager):
@@ -184,14 +379,449 @@ class PostManager(TypedObjectManager):
         """
         return self.get_queryset().by_board_threaded_player(board, player)
 
-    def search(self, searchstring, board=None):
+    @watched
+    def thread_page(self, board, player=None, after=None, before=None, limit=25):
+        """
+        Returns a single page of the threads on a board, most recently active first.
+
+        Args:
+            board (BoardDB): The board to get threads for.
+            player (AccountDB): The player whose unread states should be used, or None.
+            after (str): A cursor; if given, returns the page following it.
+            before (str): A cursor; if given, returns the page preceding it.
+            limit (int): The number of threads on a page.
+
+        Returns:
+            A paxboards.paging.Page of Post objects.
+
+        """
+        global _PAGING
+        if not _PAGING:
+            from paxboards import paging as _PAGING
+
+        if board.id not in _filled_boards:
+            self.fill_last_post_on(board)
+            _filled_boards.add(board.id)
+
+        threads = self.filter(db_board=board, db_parent__isnull=True)
+        page = _PAGING.keyset_page(threads, THREAD_ORDERING, after=after, before=before, limit=limit)
+        self.get_queryset().annotate_threads_unread(page.items, board, player)
+        return page
+
+    @watched
+    def reply_page(self, post, after=None, before=None, limit=25):
+        """
+        Returns a single page of the replies to a post, oldest first.
+
+        Args:
+            post (Post): The post whose replies should be returned.
+            after (str): A cursor; if given, returns the page following it.
+            before (str): A cursor; if given, returns the page preceding it.
+            limit (int): The number of replies on a page.
+
+        Returns:
+            A paxboards.paging.Page of Post objects.
+
+        """
+        global _PAGING
+        if not _PAGING:
+            from paxboards import paging as _PAGING
+
+        replies = self.filter(db_parent=post)
+        return _PAGING.keyset_page(replies, REPLY_ORDERING, after=after, before=before, limit=limit)
+
+    @watched
+    def visible_number(self, post):
+        """
+        Works out the number a post currently has in its board's visible list, by counting
+        the visible posts ahead of it rather than loading the whole board.
+
+        Args:
+            post (Post): The post to number.
+
+        Returns:
+            An integer, or None if the post isn't visible.
+
+        """
+        visible = self.get_queryset().by_board(post.db_board)
+        if not visible.filter(pk=post.pk).exists():
+            return None
+
+        if post.db_sequence is None:
+            # Not yet numbered; fall back to the creation date.
+            earlier = Q(db_date_created__lt=post.db_date_created)
+        else:
+            earlier = Q(db_sequence__lt=post.db_sequence)
+
+        if post.db_pinned:
+            return visible.filter(Q(db_pinned=True) & earlier).count() + 1
+
+        return visible.filter(Q(db_pinned=True) | earlier).count() + 1
+
+    def renumber(self, board):
+        """
+        Reassigns sequence numbers to every post on a board in the order they were made,
+        and resets the board's sequence counter to match.  This is only needed for posts
+        made before sequence numbers existed.
+
+        Args:
+            board (BoardDB): The board to renumber.
+
+        Returns:
+            The number of posts renumbered.
+
+        """
+        with transaction.atomic():
+            board_model = board.__class__
+            list(board_model.objects.select_for_update().filter(pk=board.pk))
+
+            sequence = 0
+            for pk in self.filter(db_board=board).order_by('db_date_created', 'id').values_list('id', flat=True):
+                sequence += 1
+                self.filter(pk=pk).update(db_sequence=sequence)
+
+                cached = self.model.get_cached_instance(pk)
+                if cached:
+                    cached.db_sequence = sequence
+
+            board_model.objects.filter(pk=board.pk).update(db_last_sequence=sequence)
+            board.db_last_sequence = sequence
+
+        return sequence
+
+    def fill_last_post_on(self, board):
+        """
+        Fills in when each thread on a board was last posted in, for threads made before
+        that was kept, which threads are sorted and paged on.  Threads which already have
+        it are left alone, so this is cheap once it has been done.
+
+        Args:
+            board (BoardDB): The board whose threads should be filled in.
+
+        Returns:
+            The number of threads filled in.
+
+        """
+        ids = list(self.filter(db_board=board, db_parent__isnull=True, db_last_post_on__isnull=True)
+                   .values_list('id', flat=True))
+        for chunk in chunked(ids):
+            with transaction.atomic():
+                last = dict(self.filter(db_parent_id__in=chunk).values_list('db_parent_id')
+                            .annotate(last=Max('db_date_created')))
+                for pk, date in last.items():
+                    self.filter(pk=pk).update(db_last_post_on=date)
+                self.filter(pk__in=[pk for pk in chunk if pk not in last])\
+                    .update(db_last_post_on=F('db_date_created'))
+
+            for pk in chunk:
+                cached = self.model.get_cached_instance(pk)
+                if cached:
+                    cached.db_last_post_on = last.get(pk) or cached.db_date_created
+
+        return len(ids)
+
+    def rebuild_threads(self, board):
+        """
+        Recalculates the running thread totals for every thread on a board.  This is only
+        needed for threads started before those totals existed.
+
+        Args:
+            board (BoardDB): The board whose threads should be rebuilt.
+
+        Returns:
+            The number of threads rebuilt.
+
+        """
+        count = 0
+        with transaction.atomic():
+            for p in self.filter(db_board=board, db_parent__isnull=True):
+                p.update_thread_stats()
+                count += 1
+
+        return count
+
+    def rebuild_renditions(self, board, batch_size=500):
+        """
+        Remakes the stored plain text, HTML and excerpt versions of every post on a board,
+        a batch at a time.  This is only needed for posts made before those were stored.
+
+        Args:
+            board (BoardDB): The board whose posts should be rebuilt.
+            batch_size (int): How many posts to load and save at once.
+
+        Returns:
+            The number of posts rebuilt.
+
+        """
+        count = 0
+        ids = list(self.filter(db_board=board).order_by('id').values_list('id', flat=True))
+        for chunk in chunked(ids, batch_size):
+            with transaction.atomic():
+                for p in self.filter(pk__in=chunk):
+                    p.update_renditions()
+                    p.save(update_fields=["db_plaintext", "db_html", "db_excerpt"])
+                    count += 1
+
+        return count
+
+    @watched
+    def search(self, searchstring, board=None, player=None):
+        """
+        Searches posts using the full-text index, best match first.  Only posts the player
+        can currently see -- on boards they can read, and not expired -- are returned.
+
+        Args:
+            searchstring (str): The search string; see paxboards.search for its format.
+            board (BoardDB): A board to restrict the search to, or None for every board.
+            player (AccountDB): The player whose read access should be used, or None to
+                search every board regardless of access.
+
+        Returns:
+            A list of Post objects.
+
+        """
+        global _BoardDB, _SEARCH
+        if not _BoardDB:
+            from paxboards.models import BoardDB as _BoardDB
+        if not _SEARCH:
+            from paxboards import search as _SEARCH
+
         if board:
-            result = self.get_queryset().by_board(board).filter(db_text__icontains=searchstring).\
-                order_by('db_date_created')
+            boards = [board]
         else:
-            result = self.get_queryset().filter(db_text__icontains=searchstring).order_by('db_date_created')
+            boards = [b for b in _BoardDB.objects.all()
+                      if not player or b.access(player, access_type='read', default=True)]
+
+        ranked = _SEARCH.search(searchstring, boards)
+        if not ranked:
+            return []
+
+        # Check expiry a whole board at a time, rather than post by post.
+        by_board = {}
+        for chunk in chunked(i for i, score in ranked):
+            for post_id, board_id in self.filter(pk__in=chunk).values_list('id', 'db_board_id'):
+                by_board.setdefault(board_id, []).append(post_id)
+
+        visible = {}
+        queryset = self.get_queryset()
+        for b in boards:
+            for chunk in chunked(by_board.get(b.id, [])):
+                for p in queryset.by_board(b).filter(pk__in=chunk):
+                    visible[p.id] = p
+
+        return [visible[i] for i, score in ranked if i in visible]
+
+
+class ReadStateManager(SharedMemoryManager):
+    """
+    This manager looks up the per-player, per-board read states which track which posts
+    a player has read.
+
+    """
+
+    @watched
+    def state_for(self, player, board):
+        """
+        Returns the read state of a player on a board, including any changes still waiting
+        to be written.  If the player has never read anything there, an unsaved blank state
+        is returned, which will be created the first time it is written.
+
+        Args:
+            player (AccountDB): The player whose read state should be returned.
+            board (BoardDB): The board to return the read state for.
+
+        Returns:
+            A ReadState object.
+
+        """
+        state = _RECEIPTS.pending(player.id, board.id)
+        if state:
+            return state
+
+        try:
+            return self.get(db_account=player, db_board=board)
+        except self.model.DoesNotExist:
+            return self.model(db_account=player, db_board=board)
+
+    @watched
+    def states_for(self, player, boards):
+        """
+        Returns the read states of a player on several boards at once.
+
+        Args:
+            player (AccountDB): The player whose read states should be returned.
+            boards (list): The boards to return read states for.
+
+        Returns:
+            A dictionary mapping board ids to ReadState objects.
+
+        """
+        states = dict((s.db_board_id, s) for s in self.filter(db_account=player, db_board__in=boards))
+        for b in boards:
+            state = _RECEIPTS.pending(player.id, b.id)
+            if state:
+                states[b.id] = state
+            elif b.id not in states:
+                states[b.id] = self.model(db_account=player, db_board=b)
+
+        return states
+
+    @watched
+    def catch_up(self, player, boards):
+        """
+        Marks every visible post on one or more boards read for a player, with at most a
+        single write per board.
+
+        Args:
+            player (AccountDB): The player catching up.
+            boards (list): The boards to catch up.
+
+        Returns:
+            The number of posts which were unread and are now read.
+
+        """
+        global _Post
+        if not _Post:
+            from paxboards.models import Post as _Post
+
+        changed = 0
+        states = self.states_for(player, boards)
+        for b in boards:
+            state = states[b.id]
+            count, above = self.count_unread(state, _Post.objects.by_board(b))
+            if count:
+                state.catch_up(max(above) if above else state.db_read_through)
+                changed += count
+
+        return changed
+
+    @watched
+    def count_unread(self, state, posts):
+        """
+        Counts the unread posts among a set of posts, without loading them.
+
+        Args:
+            state (ReadState): The read state to count against.
+            posts (QuerySet): The posts to count.
+
+        Returns:
+            A tuple of the number of unread posts, and the set of ids of all the posts
+            above the read state's watermark.
+
+        """
+        above = set(posts.filter(pk__gt=state.db_read_through).values_list('id', flat=True))
+        unread_below = 0
+        for chunk in chunked(state.unread_below):
+            unread_below += posts.filter(pk__in=chunk).count()
+
+        return len(above - state.read_above) + unread_below, above
+
+    def convert_readers(self, board):
+        """
+        Turns the readers older versions of the board system recorded on each of a
+        board's posts into read states, merged with any read states players have gained
+        since, and then clears them.
+
+        Args:
+            board (BoardDB): The board to convert.
+
+        Returns:
+            The number of players whose read states were converted.
+
+        """
+        global _Post
+        if not _Post:
+            from paxboards.models import Post as _Post
+
+        readers = _Post.db_readers.through.objects.filter(post__db_board=board)
+        read = defaultdict(set)
+        for account_id, post_id in readers.values_list('accountdb_id', 'post_id').iterator():
+            read[account_id].add(post_id)
+
+        if not read:
+            return 0
+
+        # Anything still waiting to be written has to be in the database to be merged.
+        _RECEIPTS.flush()
+
+        post_ids = list(_Post.objects.filter(db_board=board).values_list('id', flat=True))
+        with transaction.atomic():
+            states = {}
+            for chunk in chunked(list(read)):
+                states.update((s.db_account_id, s) for s in self.filter(db_board=board, db_account_id__in=chunk))
+
+            for account_id, read_ids in read.items():
+                state = states.get(account_id)
+                if state:
+                    read_ids |= set(i for i in post_ids if state.is_read(i))
+                else:
+                    state = self.model(db_account_id=account_id, db_board=board)
+                state.set_read_posts(post_ids, read_ids)
+                state.save()
+
+            readers.delete()
+
+        return len(read)
+
+
+class ArchivedPostManager(models.Manager):
+    """
+    This manager looks up and creates the archived posts of boards.
 
-        return result
+    """
+
+    def by_board(self, board):
+        """
+        Returns the archived posts of a board, oldest first.  Their text is not unpacked
+        until it is read.
+
+        Args:
+            board (BoardDB): The board whose archive should be returned.
+
+        Returns:
+            A QuerySet of ArchivedPost objects.
+
+        """
+        return self.filter(db_board=board).order_by('db_date_created', 'id')
+
+    def archive(self, board, posts):
+        """
+        Moves posts from a board into its archive.  The archived copies are written in one
+        batch, and the originals are then deleted by DefaultBoard.delete_posts, so this
+        should be given whole threads, or replies nobody has replied to.
+
+        Args:
+            board (DefaultBoard): The board the posts are on.
+            posts (list): The Post objects to archive.
+
+        Returns:
+            The number of posts archived.
+
+        """
+        posts = list(posts)
+        if not posts:
+            return 0
+
+        by_id = dict((p.id, p) for p in posts)
+
+        def thread_of(post):
+            while post.db_parent_id:
+                post = by_id.get(post.db_parent_id) or post.db_parent
+            return post.id
+
+        with transaction.atomic():
+            self.bulk_create([self.model(db_board_id=board.id,
+                                         db_original_id=p.id,
+                                         db_thread_id=thread_of(p),
+                                         db_sequence=p.db_sequence,
+                                         db_poster_name=p.db_poster_name,
+                                         db_subject=p.db_subject,
+                                         db_date_created=p.db_date_created,
+                                         db_data=self.model.pack(p)) for p in posts])
+
+            board.delete_posts(posts)
+
+        return len(posts)
 
 
 class BoardDBManager(TypedObjectManager):
@@ -216,9 +846,59 @@ class BoardDBManager(TypedObjectManager):
     def get_board_id(self, id):
         return self.get(pk=id)
 
+    def get_boards_by_id(self, board_ids):
+        """
+        Returns boards by their ids, taking those already in memory from the idmapper
+        cache, and loading any others with a single query.  Boards which no longer exist
+        are left out.
+
+        Args:
+            board_ids (list): The ids of the boards to return.
+
+        Returns:
+            A list of DefaultBoard objects, in the order of their ids in board_ids.
+        """
+        boards = {}
+        for i in board_ids:
+            cached = self.model.get_cached_instance(i)
+            if cached:
+                boards[i] = cached
+
+        missing = [i for i in board_ids if i not in boards]
+        if missing:
+            boards.update((b.id, b) for b in self.filter(pk__in=missing))
+
+        return [boards[i] for i in board_ids if i in boards]
+
+    def _get_board_by_id(self, board_id):
+        boards = self.get_boards_by_id([board_id])
+        return boards[0] if boards else None
+
+    def allocate_sequence(self, board, count=1):
+        """
+        Reserves one or more consecutive post sequence numbers on a board.  The counter is
+        incremented in the database, so concurrent posters never receive the same number.
+
+        Args:
+            board (BoardDB): The board to allocate numbers on.
+            count (int): How many numbers to reserve.
+
+        Returns:
+            The first sequence number reserved.
+
+        """
+        with transaction.atomic():
+            self.filter(pk=board.pk).update(db_last_sequence=F('db_last_sequence') + count)
+            last = self.filter(pk=board.pk).values_list('db_last_sequence', flat=True)[0]
+
+        board.db_last_sequence = last
+        return last - count + 1
+
+    @watched
     def get_board(self, key):
         """
-        Returns a specific board beginning with the key.
+        Returns a specific board beginning with the key.  Names are looked up in the
+        board registry, without querying the database.
 
         Args:
             key (str): A string to match against board names.
@@ -230,19 +910,17 @@ class BoardDBManager(TypedObjectManager):
         if board:
             return board
 
-        try:
-            boards = self.filter(db_key__istartswith=key)
-            if boards:
-                if len(boards) == 1:
-                    return boards[0]
+        board_ids = _REGISTRY.starting_with(key)
+        if len(board_ids) == 1:
+            return self._get_board_by_id(board_ids[0])
 
-            return None
-        except self.model.DoesNotExist:
-            return None
+        return None
 
+    @watched
     def get_board_exact(self, key):
         """
-        Returns a specific board matching the key.
+        Returns a specific board matching the key.  If more than one board has the
+        same name, the oldest is returned.
 
         Args:
             key (str): A string to match against board names.
@@ -250,15 +928,38 @@ class BoardDBManager(TypedObjectManager):
         Returns:
             A DefaultBoard object, or None
         """
-        try:
-            board = self.get(db_key__iexact=key)
-            if board:
-                return board
+        board_ids = _REGISTRY.exact(key)
+        if board_ids:
+            return self._get_board_by_id(board_ids[0])
 
-            return None
-        except self.model.DoesNotExist:
-            return None
+        return None
+
+    @watched
+    def get_readable_boards(self, caller):
+        """
+        This function returns all the boards a given viewer can read, without looking at
+        their posts.
+
+        Args:
+            caller (Player): The player whose visibility of boards should be checked.
 
+        Returns:
+            A list of DefaultBoard objects.
+        """
+        if not caller:
+            return []
+
+        token = _CACHES.account_token(caller)
+        board_ids = _CACHES.get_readable(caller.id, token)
+        if board_ids is None:
+            version = _CACHES.registry_version()
+            boards = [b for b in self.all().order_by('id') if b.access(caller, access_type='read', default=True)]
+            _CACHES.set_readable(caller.id, version, token, [b.id for b in boards])
+            return boards
+
+        return self.get_boards_by_id(board_ids)
+
+    @watched
     def get_all_visible_boards(self, caller):
         """
         This function returns all the boards visible to a given viewer.
@@ -269,29 +970,62 @@ class BoardDBManager(TypedObjectManager):
         Returns:
             A list of DefaultBoard objects.
         """
-        filtered = []
-        if caller:
-            filtered = [b for b in self.all() if b.access(caller, access_type='read', default=True)]
-
+        filtered = self.get_readable_boards(caller)
         for b in filtered:
-            all_posts = b.posts(caller)
-            unread = 0
-            for p in all_posts:
-                if p.is_unread:
-                    unread = unread + 1
+            self.annotate_summary(b, caller)
 
-            setattr(b, "unread_count", unread)
-            setattr(b, "total_count", len(all_posts))
+        return filtered
 
-            if all_posts:
-                last_post = list(all_posts)[-1]
-                setattr(b, "last_post", last_post)
+    @watched
+    def annotate_summary(self, board, caller):
+        """
+        Annotates a board with 'unread_count', 'total_count', 'subscribed' and 'last_post'
+        fields for the given viewer.  These are cached, and only worked out again once the
+        board, its posts, or the viewer's read state on it have changed.
 
-        return filtered
+        Args:
+            board (DefaultBoard): The board to annotate.
+            caller (Player): The player whose read state should be used.
 
+        Returns:
+            The same board.
+        """
+        global _Post, _ReadState
+        if not _Post:
+            from paxboards.models import Post as _Post
+        if not _ReadState:
+            from paxboards.models import ReadState as _ReadState
+
+        versions = _CACHES.summary_versions(caller.id, board.id, expiry_date(board))
+        summary = _CACHES.get_summary(caller.id, board.id, versions)
+        if summary is None:
+            visible = _Post.objects.by_board(board)
+            state = _ReadState.objects.state_for(caller, board)
+            last_post = visible.order_by('db_pinned', '-db_sequence').values_list('id', flat=True).first()
+
+            summary = {"unread_count": _ReadState.objects.count_unread(state, visible)[0],
+                       "total_count": visible.count(),
+                       "subscribed": board.db_subscriptions.filter(pk=caller.pk).exists(),
+                       "last_post_id": last_post}
+            _CACHES.set_summary(caller.id, board.id, versions, summary)
+
+        setattr(board, "unread_count", summary["unread_count"])
+        setattr(board, "total_count", summary["total_count"])
+        setattr(board, "subscribed", summary["subscribed"])
+        if summary["last_post_id"]:
+            setattr(board, "last_post", _Post.objects.get(pk=summary["last_post_id"]))
+        elif hasattr(board, "last_post"):
+            delattr(board, "last_post")
+
+        return board
+
+    @watched
     def get_visible_board(self, viewer, key):
         """
         This function returns a single board matching the key, provided it's unique.
+        The key can also be a board's number in the viewer's list of boards.  Both are
+        worked out from cached lists, without looking at posts, so the board returned
+        isn't annotated with a summary; see annotate_summary.
 
         Args:
             viewer (Player): The player whose visibility of boards should be checked.
@@ -300,30 +1034,19 @@ class BoardDBManager(TypedObjectManager):
         Returns:
             A DefaultBoard object, or None.
         """
+        boards = self.get_readable_boards(viewer)
+
         if is_positive_int(key):
-            boards = self.get_all_visible_boards(viewer)
             boardnum = int(key)
             if 0 < boardnum <= len(boards):
                 return boards[boardnum - 1]
 
             return None
 
-        boards = self.filter(db_key__istartswith=key)
-        if boards:
-            filtered = [b for b in boards if b.access(viewer, access_type='read', default=True)]
-            if len(filtered) == 1:
-                b = filtered[0]
-
-                all_posts = b.posts(viewer)
-                unread = 0
-                for p in all_posts:
-                    if p.is_unread:
-                        unread = unread + 1
-
-                setattr(b, "unread_count", unread)
-                setattr(b, "total_count", len(all_posts))
-
-                return b
+        readable = set(b.id for b in boards)
+        board_ids = [i for i in _REGISTRY.starting_with(key) if i in readable]
+        if len(board_ids) == 1:
+            return self._get_board_by_id(board_ids[0])
 
         return None
 
@@ -340,7 +1063,7 @@ class BoardDBManager(TypedObjectManager):
         """
         clsname = subscriber.__dbclass__.__name__
         if clsname == "AccountDB":
-            return subscriber.board_subscriptions_set.all()
+            return subscriber.board_subscriptions.all()
 
         return []
 
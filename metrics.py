@@ -0,0 +1,257 @@
+"""
+Health metrics for the board system, in the Prometheus text format.
+
+The board system counts posts made, read states written, cache hits and misses,
+notification fan-out, expiry sweeper progress and web page latency as it goes, and
+serves the totals from the metrics page (see paxboards.urls) for a local collector to
+scrape.
+
+Counting has to be cheap, since it happens on every read and post, and safe from the
+webserver's threads.  Rather than lock a shared table, each thread counts into its own
+dictionary, and the dictionaries are only added together when the metrics are read.
+
+So that the figures cover every process running the board system -- the game server,
+and a separate webserver if there is one -- each process also writes its totals to a
+snapshot file every SNAPSHOT_INTERVAL seconds.  The metrics page adds the recent
+snapshots of the other processes to its own live totals.
+
+"""
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from evennia.utils import logger
+from twisted.internet import reactor
+
+SNAPSHOT_DIR = getattr(settings, "PAXBOARDS_METRICS_DIR",
+                       os.path.join(getattr(settings, "GAME_DIR", "."), "server", "logs", "paxboards-metrics"))
+SNAPSHOT_INTERVAL = getattr(settings, "PAXBOARDS_METRICS_INTERVAL", 15)
+
+# Snapshots older than this many intervals are from processes which have stopped.
+SNAPSHOT_MAX_AGE = 4
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the notification fan-out histogram buckets, in accounts.
+FANOUT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# name -> (type, help)
+_described = {}
+
+# Each thread's own counts: (series name, labels) -> value.  Gauges are kept apart, as
+# they are set rather than added to.
+_local = threading.local()
+_thread_counts = []
+_gauges = {}
+
+_snapshots = [None]
+_snapshots_lock = threading.Lock()
+
+
+def describe(name, metric_type, help_text):
+    """
+    Records the type and description of a metric, for the metrics page.
+
+    """
+    _described[name] = (metric_type, help_text)
+
+
+def _counts():
+    counts = getattr(_local, "counts", None)
+    if counts is None:
+        counts = _local.counts = {}
+        _thread_counts.append(counts)
+        _start_snapshots()
+    return counts
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """
+    Adds to a counter.
+
+    Args:
+        name (str): The counter's name.
+        amount (number): How much to add.
+        labels: Labels distinguishing this series of the counter, such as board="Announcements".
+
+    """
+    counts = _counts()
+    key = (name, _labels(labels))
+    counts[key] = counts.get(key, 0) + amount
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Adds a measurement to a histogram.
+
+    Args:
+        name (str): The histogram's name.
+        value (number): The measurement.
+        buckets (tuple): The upper bounds of the histogram's buckets.
+        labels: Labels distinguishing this series of the histogram.
+
+    """
+    counts = _counts()
+    labels = _labels(labels)
+    for bound in buckets:
+        if value <= bound:
+            key = (name + "_bucket", labels + (("le", repr(float(bound))),))
+            counts[key] = counts.get(key, 0) + 1
+    for key, amount in (((name + "_bucket", labels + (("le", "+Inf"),)), 1),
+                        ((name + "_count", labels), 1),
+                        ((name + "_sum", labels), value)):
+        counts[key] = counts.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    """
+    Sets a gauge.  Across processes, gauges are added together, so a gauge should only be
+    set by the process which owns whatever it measures.
+
+    """
+    _gauges[(name, _labels(labels))] = value
+    _start_snapshots()
+
+
+def totals():
+    """
+    Adds up this process's counts, across all its threads.
+
+    Returns:
+        A dictionary mapping (series name, labels) to values.
+
+    """
+    result = dict(_gauges)
+    for counts in list(_thread_counts):
+        for key, value in counts.copy().items():
+            result[key] = result.get(key, 0) + value
+    return result
+
+
+def _snapshot_path(pid):
+    return os.path.join(SNAPSHOT_DIR, "%d.json" % pid)
+
+
+def write_snapshot():
+    """
+    Writes this process's totals to its snapshot file.
+
+    """
+    try:
+        if not os.path.isdir(SNAPSHOT_DIR):
+            os.makedirs(SNAPSHOT_DIR)
+
+        path = _snapshot_path(os.getpid())
+        with open(path + ".tmp", "w") as f:
+            json.dump([[name, labels, value] for (name, labels), value in totals().items()], f)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError):
+        logger.log_trace("Error writing board metrics snapshot.")
+
+
+def _start_snapshots():
+    # The first metric can be recorded by any thread, webserver threads included, so the
+    # check is locked and the loop is started on the reactor thread.
+    if _snapshots[0]:
+        return
+
+    with _snapshots_lock:
+        if _snapshots[0] or not reactor.running:
+            return
+
+        from twisted.internet.task import LoopingCall
+        _snapshots[0] = LoopingCall(write_snapshot)
+
+    reactor.callFromThread(_snapshots[0].start, SNAPSHOT_INTERVAL, now=False)
+
+
+def _other_processes():
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return {}
+
+    result = {}
+    own = os.path.basename(_snapshot_path(os.getpid()))
+    oldest = time.time() - SNAPSHOT_INTERVAL * SNAPSHOT_MAX_AGE
+    for filename in os.listdir(SNAPSHOT_DIR):
+        path = os.path.join(SNAPSHOT_DIR, filename)
+        if filename == own or not filename.endswith(".json"):
+            continue
+
+        try:
+            if os.path.getmtime(path) < oldest:
+                continue
+            with open(path) as f:
+                for name, labels, value in json.load(f):
+                    key = (name, tuple(tuple(l) for l in labels))
+                    result[key] = result.get(key, 0) + value
+        except (IOError, OSError, ValueError):
+            continue
+
+    return result
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _base_name(name):
+    for suffix in ("_bucket", "_count", "_sum"):
+        if name.endswith(suffix) and name[:-len(suffix)] in _described:
+            return name[:-len(suffix)]
+    return name
+
+
+def exposition():
+    """
+    Builds the metrics page: the totals of every process, in the Prometheus text format.
+
+    Returns:
+        The page, as a string.
+
+    """
+    combined = totals()
+    for key, value in _other_processes().items():
+        combined[key] = combined.get(key, 0) + value
+
+    by_metric = {}
+    for (name, labels), value in combined.items():
+        by_metric.setdefault(_base_name(name), []).append((name, labels, value))
+
+    lines = []
+    for metric in sorted(set(by_metric) | set(_described)):
+        if metric in _described:
+            metric_type, help_text = _described[metric]
+            lines.append("# HELP " + metric + " " + help_text)
+            lines.append("# TYPE " + metric + " " + metric_type)
+
+        for name, labels, value in sorted(by_metric.get(metric, [])):
+            label_string = ",".join('%s="%s"' % (k, unicode(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                    for k, v in labels)
+            lines.append(name + ("{" + label_string + "}" if label_string else "") + " " + _format_value(value))
+
+    return "\n".join(lines) + "\n"
+
+
+describe("paxboards_posts_created_total", COUNTER, "Posts made, by board.")
+describe("paxboards_read_receipts_total", COUNTER, "Changes to read states, before coalescing.")
+describe("paxboards_read_state_writes_total", COUNTER, "Read states written to the database.")
+describe("paxboards_cache_requests_total", COUNTER, "Cache lookups, by cache and result.")
+describe("paxboards_notification_fanout", HISTOGRAM, "Connected subscribers told about each new post.")
+describe("paxboards_notification_seconds", HISTOGRAM, "Time from a post being made to its announcement being sent.")
+describe("paxboards_sweeper_runs_total", COUNTER, "Expiry sweeper runs.")
+describe("paxboards_sweeper_removed_total", COUNTER, "Posts removed by the expiry sweeper, by action.")
+describe("paxboards_sweeper_pending", GAUGE, "Posts waiting to be removed by the expiry sweeper, while profiling is on.")
+describe("paxboards_view_seconds", HISTOGRAM, "Time taken by board web pages, by view.")
@@ -1,11 +1,27 @@
 from __future__ import unicode_literals
 
+import json
+import zlib
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from evennia.typeclasses.models import TypedObject
+from evennia.utils import ansi
+from evennia.utils.text2html import parse_html
 from evennia.utils.idmapper.models import SharedMemoryModel
-from managers import PostManager
+from managers import PostManager, ReadStateManager, ArchivedPostManager
+from paxboards import caches, receipts
 
-__all__ = ("Post", "BoardDB")
+__all__ = ("Post", "BoardDB", "ReadState", "SearchPosting", "ArchivedPost")
+
+EXCERPT_LENGTH = 100
+
+
+def _datestring(date):
+    datestring = unicode(str(date.year)) + u'/'
+    datestring += unicode(str(date.month)).rjust(2, '0') + u'/'
+    datestring += unicode(str(date.day)).rjust(2, '0')
+    return datestring
 
 
 class Post(SharedMemoryModel):
@@ -21,9 +37,29 @@ class Post(SharedMemoryModel):
     - db_board: The board on which this post was made.
     - db_date_created: The timestamp when this post was made.
     - db_pinned: A boolean, determining if the post should be prevented from timing out.
-    - db_readers: A list of players who have read this post.
     - db_parent: For threaded post chains, the parent to this post.
     - db_text: The actual text of the post.
+    - db_sequence: The board-local sequence number of this post, allocated when it is made.
+    - db_revision: How many times this post has been edited.
+    - db_import_key: The id this post had wherever it was imported from, if it was.
+    - db_readers: The players older versions of the board system recorded as having read
+      this post.  These are turned into read states by bbadmin/rebuild, and then cleared.
+
+    Versions of the text for places which can't show ANSI colors are made once, whenever
+    the text is set, rather than each time they are shown:
+
+    - db_plaintext: The text with ANSI codes stripped.
+    - db_html: The text as HTML, with ANSI colors as CSS classes.
+    - db_excerpt: The start of the plain text, for listings.
+
+    Posts which start a thread also keep running totals for that thread, so threads can be
+    listed without looking at their replies:
+
+    - db_reply_count: The number of replies to this post.
+    - db_last_reply: The most recent reply to this post, if any.
+    - db_last_post_on: The timestamp of the most recent post in the thread.
+    - db_last_poster_name: The byline of the most recent post in the thread.
+    - db_thread_revision: Bumped whenever a reply is made, edited or deleted.
 
     """
     db_poster_player = models.ForeignKey("accounts.AccountDB", related_name="+", null=True, blank=True,
@@ -40,11 +76,34 @@ class Post(SharedMemoryModel):
                                            auto_now_add=True, db_index=True, help_text='Date post was made.')
     db_pinned = models.BooleanField(verbose_name="pinned",
                                     help_text='Should the post remain visible even after expiration?')
-    db_readers = models.ManyToManyField("accounts.AccountDB", related_name="read_posts", null=True, blank=True,
-                                        verbose_name="readers", help_text='Players who have read this post.')
+    db_readers = models.ManyToManyField("accounts.AccountDB", related_name="read_posts", blank=True,
+                                        verbose_name="readers",
+                                        help_text='Players who read this post, under older versions.')
     db_parent = models.ForeignKey('Post', verbose_name='parent', related_name='replies', null=True, blank=True,
                                   help_text='Parent/child map for threaded replies.')
     db_text = models.TextField(verbose_name="post_text", null=True, blank=True, help_text='Text of the post.')
+    db_sequence = models.IntegerField(verbose_name="sequence", null=True, blank=True,
+                                      help_text='Board-local sequence number of this post.')
+    db_revision = models.IntegerField(verbose_name="revision", default=0,
+                                      help_text='Number of times this post has been edited.')
+    db_import_key = models.CharField(max_length=64, verbose_name="import key", null=True, blank=True, unique=True,
+                                     help_text='Id of this post in the data it was imported from.')
+    db_plaintext = models.TextField(verbose_name="plain text", blank=True, default="",
+                                    help_text='Text of the post, without ANSI codes.')
+    db_html = models.TextField(verbose_name="html", blank=True, default="",
+                               help_text='Text of the post, as HTML.')
+    db_excerpt = models.CharField(max_length=EXCERPT_LENGTH + 3, verbose_name="excerpt", blank=True, default="",
+                                  help_text='Start of the text of the post, for listings.')
+    db_reply_count = models.IntegerField(verbose_name="replies", default=0,
+                                         help_text='Number of replies to this post.')
+    db_last_reply = models.ForeignKey('Post', verbose_name='last reply', related_name='+', null=True, blank=True,
+                                      on_delete=models.SET_NULL, help_text='Most recent reply to this post.')
+    db_last_post_on = models.DateTimeField('last post on', null=True, blank=True,
+                                           help_text='Date of the most recent post in this thread.')
+    db_last_poster_name = models.CharField(max_length=40, verbose_name="last poster", blank=True, default="",
+                                           help_text='Display name of the most recent poster in this thread.')
+    db_thread_revision = models.IntegerField(verbose_name="thread revision", default=0,
+                                             help_text='Bumped whenever a reply to this post changes.')
 
     objects = PostManager()
 
@@ -52,6 +111,9 @@ class Post(SharedMemoryModel):
         "Define Django meta options"
         verbose_name = "Post"
         verbose_name_plural = "Posts"
+        index_together = [("db_board", "db_pinned", "db_sequence"),
+                          ("db_board", "db_parent", "db_pinned", "db_last_post_on"),
+                          ("db_parent", "db_date_created")]
 
     def __str__(self):
         return "<Post " + str(self.id) + " by " + self.db_poster_name + ": " + self.db_subject + \
@@ -102,11 +164,8 @@ class Post(SharedMemoryModel):
         if not player:
             return
 
-        if has_read:
-            self.db_readers.add(player)
-        else:
-            self.db_readers.remove(player)
-        self.save()
+        state = ReadState.objects.state_for(player, self.db_board)
+        state.set_read(self.id, has_read)
 
     @property
     def post_num(self):
@@ -118,8 +177,7 @@ class Post(SharedMemoryModel):
             An integer.
 
         """
-        posts = Post.objects.posts(self.db_board)
-        return list(posts).index(self) + 1 if self in posts else None
+        return Post.objects.visible_number(self)
 
     @property
     def last_reply(self):
@@ -130,11 +188,101 @@ class Post(SharedMemoryModel):
             there are none.
 
         """
-        posts = Post.objects.filter(db_parent=self).order_by('db_date_created')
-        if posts:
-            return posts.last()
+        return self.db_last_reply or self
 
-        return self
+    @property
+    def last_post_on(self):
+        return self.db_last_post_on or self.db_date_created
+
+    @property
+    def last_poster(self):
+        return self.db_last_poster_name or self.db_poster_name
+
+    @property
+    def total_posts(self):
+        return self.db_reply_count + 1
+
+    def update_thread_stats(self):
+        """
+        Recalculates the running totals this post keeps for its thread from its replies.
+        This should be called, within the same transaction, whenever a reply is added to
+        or removed from the thread.
+
+        Returns:
+            None
+
+        """
+        replies = Post.objects.filter(db_parent=self)
+        last = replies.order_by('-db_date_created', '-id').first()
+
+        self.db_reply_count = replies.count()
+        if last:
+            self.db_last_reply = last
+            self.db_last_post_on = last.db_date_created
+            self.db_last_poster_name = last.db_poster_name
+        else:
+            self.db_last_reply = None
+            self.db_last_post_on = self.db_date_created
+            self.db_last_poster_name = self.db_poster_name
+
+        self.db_thread_revision += 1
+        self.save(update_fields=["db_reply_count", "db_last_reply", "db_last_post_on", "db_last_poster_name",
+                                 "db_thread_revision"])
+
+    def update_renditions(self):
+        """
+        Remakes the plain text, HTML and excerpt versions of this post's text.  This
+        doesn't save the post.
+
+        Returns:
+            None
+
+        """
+        text = self.db_text or ""
+        self.db_plaintext = ansi.strip_ansi(text)
+        self.db_html = parse_html(text)
+
+        excerpt = " ".join(self.db_plaintext.split())
+        if len(excerpt) > EXCERPT_LENGTH:
+            excerpt = excerpt[:EXCERPT_LENGTH].rsplit(" ", 1)[0] + "..."
+        self.db_excerpt = excerpt
+
+    @property
+    def plaintext(self):
+        if not self.db_plaintext and self.db_text:
+            self.update_renditions()
+        return self.db_plaintext
+
+    @property
+    def html(self):
+        if not self.db_html and self.db_text:
+            self.update_renditions()
+        return self.db_html
+
+    @property
+    def excerpt(self):
+        if not self.db_excerpt and self.db_text:
+            self.update_renditions()
+        return self.db_excerpt
+
+    def edit(self, text):
+        """
+        Replaces the text of this post, and marks it and its thread as changed.
+
+        Args:
+            text (str): The new text of the post.
+
+        Returns:
+            None
+
+        """
+        self.db_text = text
+        self.db_revision += 1
+        self.update_renditions()
+        self.save()
+
+        if self.db_parent:
+            self.db_parent.update_thread_stats()
 
     @property
     def is_unread(self):
@@ -166,22 +314,36 @@ class Post(SharedMemoryModel):
     def poster(self):
         return self.db_poster_name
 
-    def display_post(self, player, show_replies=False):
+    def render(self, show_replies=False):
+        """
+        Builds the text of this post as shown on the game, optionally followed by its
+        replies.  The result is cached, keyed on everything that can change it, so a post
+        (or a whole thread) which hasn't changed is only built once.
+
+        Args:
+            show_replies (bool): Whether to include the replies to this post.
+
+        Returns:
+            The formatted post, as a string.
+
+        """
         post_num = self.post_num
+        key = (self.id, self.db_revision, self.db_thread_revision if show_replies else None, post_num,
+               self.db_pinned, self.db_board.name)
+
+        post_string = caches.get_render(key)
+        if post_string is not None:
+            return post_string
 
         if post_num:
             postid = self.db_board.name + " / " + str(post_num)
         else:
             postid = self.db_board.name
 
-        datestring = unicode(str(self.db_date_created.year)) + u'/'
-        datestring += unicode(str(self.db_date_created.month)).rjust(2, '0') + u'/'
-        datestring += unicode(str(self.db_date_created.day)).rjust(2, '0')
-
         header = ("===[ " + postid + " ]").ljust(75, "=")
 
         post_string = header + "\n"
-        post_string += "|555Date   :|n " + datestring + "\n"
+        post_string += "|555Date   :|n " + _datestring(self.db_date_created) + "\n"
         post_string += "|555Poster :|n " + self.db_poster_name + "\n"
         post_string += "|555Subject:|n " + self.db_subject
         if self.db_pinned:
@@ -190,21 +352,22 @@ class Post(SharedMemoryModel):
         post_string += self.db_text + "\n"
 
         if show_replies:
-            replies = Post.objects.filter(db_parent=self).order_by('db_date_created')
+            replies = Post.objects.filter(db_parent=self).order_by('db_date_created', 'id')
             for r in replies:
-                datestring = unicode(str(r.db_date_created.year)) + u'/'
-                datestring += unicode(str(r.db_date_created.month)).rjust(2, '0') + u'/'
-                datestring += unicode(str(r.db_date_created.day)).rjust(2, '0')
                 post_string += "\n---------------------------------------------------------------------------\n"
-                post_string += "|555Date   :|n " + datestring + "\n"
+                post_string += "|555Date   :|n " + _datestring(r.db_date_created) + "\n"
                 post_string += "|555Poster :|n " + r.db_poster_name + "\n"
                 post_string += "--------\n"
                 post_string += r.db_text + "\n"
 
         post_string += "==========================================================================="
 
+        caches.set_render(key, post_string)
+        return post_string
+
+    def display_post(self, player, show_replies=False):
         player.msg(" ")
-        player.msg(post_string)
+        player.msg(self.render(show_replies=show_replies))
         player.msg(" ")
 
 
@@ -218,6 +381,9 @@ class BoardDB(TypedObject):
     - db_expiry_maxposts: An optional number, of how many posts should be shown.
     - db_expiry_duration: An optional duration, in days, of how long a post should remain.
     - db_subscriptions: The players who are subscribed to the board.
+    - db_last_sequence: The sequence number most recently given to a post on this board.
+    - db_truncate: Whether expired posts should be deleted, rather than just hidden.
+    - db_archive_days: An optional age, in days, after which posts are moved to the archive.
 
     """
     db_expiry_maxposts = models.IntegerField('max_posts', blank=True, null=True,
@@ -227,6 +393,12 @@ class BoardDB(TypedObject):
     db_subscriptions = models.ManyToManyField('accounts.AccountDB', blank=True, verbose_name='subscribers',
                                               related_name='board_subscriptions',
                                               help_text='Players subscribed to this board.')
+    db_last_sequence = models.IntegerField('last_sequence', default=0,
+                                           help_text='Sequence number most recently given to a post on this board.')
+    db_truncate = models.BooleanField('truncate', default=False,
+                                      help_text='Should expired posts be deleted, rather than just hidden?')
+    db_archive_days = models.IntegerField('archive_days', blank=True, null=True,
+                                          help_text='Age in days after which posts move to the archive.')
 
     __settingclasspath__ = "paxboards.boards.DefaultBoard"
     __defaultclasspath__ = "paxboards.boards.DefaultBoard"
@@ -241,3 +413,364 @@ class BoardDB(TypedObject):
         "Echoes the text representation of the board."
         return "Board '%s' (%s)" % (self.key, self.db.desc)
 
+
+
+def _parse_id_set(string):
+    if not string:
+        return set()
+
+    return set(int(i) for i in string.split(",") if i)
+
+
+def _format_id_set(ids):
+    return ",".join(str(i) for i in sorted(ids))
+
+
+class ReadState(SharedMemoryModel):
+    """
+    The read/unread state of a single player on a single board.
+
+    Rather than recording every post a player has read, this stores a watermark -- the
+    id of the newest post the player has caught up through -- and a small set of
+    exceptions to it.  A post is read if its id is at or below the watermark and not
+    listed as unread, or if it is above the watermark and listed as read.
+
+    - db_account: The player whose read state this is.
+    - db_board: The board this read state applies to.
+    - db_read_through: All posts with an id at or below this are read, barring exceptions.
+    - db_read_above: Comma-separated ids above the watermark which have been read.
+    - db_unread_below: Comma-separated ids at or below the watermark which are unread.
+
+    Changes are not saved straight away, but queued to be written in bulk; see
+    paxboards.receipts.
+
+    """
+    db_account = models.ForeignKey("accounts.AccountDB", related_name="board_read_states", verbose_name="player",
+                                   help_text='Player this read state belongs to.')
+    db_board = models.ForeignKey("BoardDB", related_name="read_states", verbose_name="board",
+                                 help_text='Board this read state applies to.')
+    db_read_through = models.IntegerField(verbose_name="read through", default=0,
+                                          help_text='Id of the newest post this player has caught up through.')
+    db_read_above = models.TextField(verbose_name="read above", blank=True, default="",
+                                     help_text='Posts read above the watermark.')
+    db_unread_below = models.TextField(verbose_name="unread below", blank=True, default="",
+                                       help_text='Posts unread at or below the watermark.')
+
+    objects = ReadStateManager()
+
+    class Meta(object):
+        "Define Django meta options"
+        verbose_name = "Read State"
+        verbose_name_plural = "Read States"
+        unique_together = ("db_account", "db_board")
+
+    def __str__(self):
+        return "<ReadState " + str(self.db_account_id) + " on " + str(self.db_board_id) + " through " + \
+               str(self.db_read_through) + ">"
+
+    def __unicode__(self):
+        return unicode(str(self))
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def read_above(self):
+        if getattr(self, "_read_above_raw", None) != self.db_read_above:
+            self._read_above_raw = self.db_read_above
+            self._read_above = _parse_id_set(self.db_read_above)
+
+        return self._read_above
+
+    @property
+    def unread_below(self):
+        if getattr(self, "_unread_below_raw", None) != self.db_unread_below:
+            self._unread_below_raw = self.db_unread_below
+            self._unread_below = _parse_id_set(self.db_unread_below)
+
+        return self._unread_below
+
+    def is_read(self, post_id):
+        """
+        Checks whether the given post has been read.
+
+        Args:
+            post_id (int): The id of the post to check.
+
+        Returns:
+            True or False
+
+        """
+        if post_id <= self.db_read_through:
+            return post_id not in self.unread_below
+
+        return post_id in self.read_above
+
+    def set_read(self, post_id, has_read):
+        """
+        Marks a single post read or unread, queueing a write only if anything changed.
+
+        Args:
+            post_id (int): The id of the post to mark.
+            has_read (bool): Should this be marked as read
+
+        Returns:
+            None
+
+        """
+        if self.is_read(post_id) == has_read:
+            return
+
+        if post_id <= self.db_read_through:
+            unread = set(self.unread_below)
+            if has_read:
+                unread.discard(post_id)
+            else:
+                unread.add(post_id)
+            self.db_unread_below = _format_id_set(unread)
+        else:
+            read = set(self.read_above)
+            if has_read:
+                read.add(post_id)
+            else:
+                read.discard(post_id)
+            self.db_read_above = _format_id_set(read)
+
+        receipts.record(self)
+
+    def catch_up(self, through_id):
+        """
+        Marks every post with an id at or below the given one as read, with a single queued
+        write.
+
+        Args:
+            through_id (int): The id of the newest post to mark read.
+
+        Returns:
+            None
+
+        """
+        if not through_id:
+            return
+
+        self.db_read_through = max(self.db_read_through, through_id)
+        self.db_read_above = _format_id_set(i for i in self.read_above if i > self.db_read_through)
+        self.db_unread_below = _format_id_set(i for i in self.unread_below if i > through_id)
+        receipts.record(self)
+
+    def set_read_posts(self, post_ids, read_ids):
+        """
+        Sets which of a board's posts are read, all at once, choosing the watermark which
+        leaves the fewest exceptions.  This doesn't queue a write.
+
+        Args:
+            post_ids (iterable): The ids of every post on the board.
+            read_ids (set): The ids of the posts which are read.
+
+        Returns:
+            None
+
+        """
+        post_ids = sorted(post_ids)
+
+        # Moving the watermark up past a read post saves an exception, and past an unread
+        # one costs one.
+        best, best_cost, cost = 0, 0, 0
+        for post_id in post_ids:
+            cost += -1 if post_id in read_ids else 1
+            if cost < best_cost:
+                best, best_cost = post_id, cost
+
+        self.db_read_through = best
+        self.db_read_above = _format_id_set(i for i in read_ids if i > best)
+        self.db_unread_below = _format_id_set(i for i in post_ids if i <= best and i not in read_ids)
+
+    def merge(self, other):
+        """
+        Adds everything another read state of the same player on the same board has read
+        to this one, as when two were made at once.  Afterwards, a post is read if either
+        of them had read it.  This doesn't queue a write.
+
+        Args:
+            other (ReadState): The other read state.
+
+        Returns:
+            None
+
+        """
+        through = max(self.db_read_through, other.db_read_through)
+        newer, older = (self, other) if self.db_read_through >= other.db_read_through else (other, self)
+        unread = [i for i in newer.unread_below if not older.is_read(i)]
+        read = [i for i in self.read_above | other.read_above if i > through]
+
+        self.db_read_through = through
+        self.db_read_above = _format_id_set(read)
+        self.db_unread_below = _format_id_set(unread)
+
+    def forget(self, post_ids):
+        """
+        Drops posts which no longer exist from this read state's exceptions, queueing a
+        write only if anything changed.
+
+        Args:
+            post_ids (set): The ids of the posts to drop.
+
+        Returns:
+            None
+
+        """
+        if not (self.read_above & post_ids or self.unread_below & post_ids):
+            return
+
+        self.db_read_above = _format_id_set(self.read_above - post_ids)
+        self.db_unread_below = _format_id_set(self.unread_below - post_ids)
+        receipts.record(self)
+
+
+class SearchPosting(models.Model):
+    """
+    A single entry in the full-text search index: one word, as it appears in one field
+    of one post.  These are maintained by paxboards.search, and never need to be edited
+    directly.
+
+    - db_token: The lowercased word.
+    - db_post: The post the word appears in.
+    - db_board: The board that post is on, to allow searching a single board.
+    - db_field: Which part of the post the word appears in (subject, poster, or text).
+    - db_positions: Comma-separated word positions of the word within that field.
+
+    """
+    db_token = models.CharField(max_length=40, verbose_name="token", db_index=True, help_text='Indexed word.')
+    db_post = models.ForeignKey("Post", related_name="+", verbose_name="post", help_text='Post containing the word.')
+    db_board = models.ForeignKey("BoardDB", related_name="+", verbose_name="board",
+                                 help_text='Board the post is on.')
+    db_field = models.SmallIntegerField(verbose_name="field", help_text='Part of the post containing the word.')
+    db_positions = models.TextField(verbose_name="positions", help_text='Positions of the word within the field.')
+
+    class Meta(object):
+        "Define Django meta options"
+        verbose_name = "Search Posting"
+        verbose_name_plural = "Search Postings"
+        index_together = [("db_token", "db_board")]
+
+    def __str__(self):
+        return "<SearchPosting '" + self.db_token + "' in " + str(self.db_post_id) + ">"
+
+
+class ArchivedPost(models.Model):
+    """
+    A post which has been moved out of the Post table into a board's archive.  Only the
+    fields needed to list it are kept as columns; everything else, including the text,
+    is stored as a single compressed blob which is only unpacked when the post is read.
+
+    - db_board: The board the post was made on.
+    - db_original_id: The id the post had before it was archived.
+    - db_thread_id: The id of the first post of the thread it belonged to; its own id, if
+      it started the thread.
+    - db_sequence: The sequence number the post had on its board.
+    - db_poster_name: The byline of the post.
+    - db_subject: The subject of the post.
+    - db_date_created: The timestamp when the post was made.
+    - db_archived_on: The timestamp when the post was archived.
+    - db_data: The zlib-compressed JSON of everything else about the post.
+
+    """
+    db_board = models.ForeignKey("BoardDB", related_name="archived_posts", verbose_name="board",
+                                 help_text='Board this post was made on.')
+    db_original_id = models.IntegerField(verbose_name="original id", db_index=True,
+                                         help_text='Id of the post before it was archived.')
+    db_thread_id = models.IntegerField(verbose_name="thread id", null=True, blank=True,
+                                       help_text='Original id of the first post of the thread.')
+    db_sequence = models.IntegerField(verbose_name="sequence", null=True, blank=True,
+                                      help_text='Board-local sequence number of the post.')
+    db_poster_name = models.CharField(max_length=40, verbose_name="poster", help_text='Poster display name.')
+    db_subject = models.CharField(max_length=40, verbose_name="subject", help_text='Subject of post.')
+    db_date_created = models.DateTimeField('date created', help_text='Date post was made.')
+    db_archived_on = models.DateTimeField('date archived', auto_now_add=True, help_text='Date post was archived.')
+    db_data = models.BinaryField(verbose_name="data", help_text='Compressed text and details of the post.')
+
+    objects = ArchivedPostManager()
+
+    class Meta(object):
+        "Define Django meta options"
+        verbose_name = "Archived Post"
+        verbose_name_plural = "Archived Posts"
+        index_together = [("db_board", "db_date_created")]
+
+    def __str__(self):
+        return "<ArchivedPost " + str(self.db_original_id) + " by " + self.db_poster_name + ": " + \
+               self.db_subject + ">"
+
+    def __unicode__(self):
+        return unicode(str(self))
+
+    @staticmethod
+    def pack(post):
+        """
+        Compresses the parts of a post which aren't kept as columns.
+
+        Args:
+            post (Post): The post to pack.
+
+        Returns:
+            A compressed byte string.
+
+        """
+        return zlib.compress(json.dumps({"text": post.db_text,
+                                         "pinned": post.db_pinned,
+                                         "poster_player": post.db_poster_player_id,
+                                         "poster_object": post.db_poster_object_id}).encode("utf-8"))
+
+    @property
+    def data(self):
+        if not hasattr(self, "_data"):
+            self._data = json.loads(zlib.decompress(bytes(self.db_data)).decode("utf-8"))
+
+        return self._data
+
+    @property
+    def text(self):
+        return self.data.get("text") or ""
+
+    @property
+    def subject(self):
+        return self.db_subject
+
+    @property
+    def poster(self):
+        return self.db_poster_name
+
+    def display_post(self, player):
+        header = ("===[ " + self.db_board.name + " archive ]").ljust(75, "=")
+
+        post_string = header + "\n"
+        post_string += "|555Date   :|n " + _datestring(self.db_date_created) + "\n"
+        post_string += "|555Poster :|n " + self.db_poster_name + "\n"
+        post_string += "|555Subject:|n " + self.db_subject
+        post_string += "\n---------------------------------------------------------------------------\n"
+        post_string += self.text + "\n"
+        post_string += "==========================================================================="
+
+        player.msg(" ")
+        player.msg(post_string)
+        player.msg(" ")
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def _invalidate_caches(sender, instance, **kwargs):
+    """
+    Bumps the versions of anything cached about boards, posts and read states whenever
+    they are saved or deleted.  See paxboards.caches.
+
+    """
+    if isinstance(instance, Post):
+        caches.bump_board(instance.db_board_id)
+        caches.forget_render(instance.id)
+        if instance.db_parent_id:
+            caches.forget_render(instance.db_parent_id)
+    elif isinstance(instance, ReadState):
+        caches.bump_reads(instance.db_account_id, instance.db_board_id)
+    elif isinstance(instance, BoardDB):
+        caches.bump_board(instance.id)
+        caches.bump_registry()
@@ -0,0 +1,168 @@
+"""
+Delivery of new-post notifications.
+
+Posting a message shouldn't make the poster wait while every subscriber is told about
+it, so `post_created` only schedules the work and returns.  The announcement is then
+delivered from the reactor, a batch of accounts at a time, and only to subscribers who
+are actually connected.  Subscribers who were offline instead get a short summary of
+the unread posts on their subscribed boards when they next log in; see
+`at_account_login`.
+
+Other parts of the board system (or the game) can also be told about new posts, replies
+and pins, by registering a listener with `add_listener`.
+
+"""
+import time
+
+from django.conf import settings
+from evennia.utils import logger
+from twisted.internet import reactor
+
+from paxboards import metrics
+
+BATCH_SIZE = getattr(settings, "PAXBOARDS_NOTIFY_BATCH_SIZE", 50)
+
+_SESSIONS = None
+_Post = None
+_DefaultBoard = None
+
+_listeners = []
+
+
+def add_listener(listener):
+    """
+    Registers a function to be told about board events.  It will be called from the
+    reactor as listener(event, post), where event is one of "post", "reply", "pin" or
+    "unpin".
+
+    Args:
+        listener (callable): The function to call.
+
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """
+    Unregisters a function registered with add_listener.
+
+    """
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def _call_later(func, *args):
+    def _run():
+        try:
+            func(*args)
+        except Exception:
+            logger.log_trace("Error delivering board notification.")
+
+    # Posts are also made from the webserver's threads, where callLater isn't safe.
+    if reactor.running:
+        reactor.callFromThread(_run)
+    else:
+        _run()
+
+
+def _notify_listeners(event, post):
+    for listener in list(_listeners):
+        try:
+            listener(event, post)
+        except Exception:
+            logger.log_trace("Error in board notification listener %r." % listener)
+
+
+def post_created(post):
+    """
+    Announces a new post to the board's connected subscribers, and tells any listeners
+    about it.  This returns immediately; the work happens later, from the reactor.
+
+    Args:
+        post (Post): The post which was just made.
+
+    """
+    _call_later(_announce, post.id, time.time())
+
+
+def post_pinned(post):
+    """
+    Tells any listeners that a post was pinned or unpinned.
+
+    Args:
+        post (Post): The post whose pinned state just changed.
+
+    """
+    _call_later(_notify_listeners, "pin" if post.db_pinned else "unpin", post)
+
+
+def _online_subscribers(board):
+    global _SESSIONS
+    if not _SESSIONS:
+        from evennia.server.sessionhandler import SESSIONS as _SESSIONS
+
+    online = dict((a.id, a) for a in _SESSIONS.all_connected_accounts())
+    if not online:
+        return []
+
+    subscribed = board.db_subscriptions.filter(pk__in=online.keys()).values_list('id', flat=True)
+    return [online[i] for i in subscribed]
+
+
+def _announce(post_id, posted):
+    global _Post
+    if not _Post:
+        from paxboards.models import Post as _Post
+
+    try:
+        post = _Post.objects.get(pk=post_id)
+    except _Post.DoesNotExist:
+        return
+
+    _notify_listeners("reply" if post.db_parent_id else "post", post)
+
+    postnum = post.post_num
+    if not postnum:
+        return
+
+    board = post.db_board
+    announcement = "|/New post by |555" + post.db_poster_name + ":|n (" + board.name + "/" + \
+                   str(postnum) + ") |555" + post.db_subject + "|n|/"
+
+    subscribers = _online_subscribers(board)
+    metrics.observe("paxboards_notification_fanout", len(subscribers), buckets=metrics.FANOUT_BUCKETS)
+    _deliver(subscribers, announcement, posted)
+
+
+def _deliver(accounts, message, posted):
+    for account in accounts[:BATCH_SIZE]:
+        account.msg(message)
+
+    if len(accounts) > BATCH_SIZE:
+        _call_later(_deliver, accounts[BATCH_SIZE:], message, posted)
+    else:
+        metrics.observe("paxboards_notification_seconds", time.time() - posted)
+
+
+def at_account_login(account):
+    """
+    Tells a player who has just logged in how many unread posts there are on the boards
+    they're subscribed to.  Call this from your Account typeclass's at_post_login hook.
+
+    Args:
+        account (AccountDB): The account which just logged in.
+
+    """
+    global _DefaultBoard
+    if not _DefaultBoard:
+        from paxboards.boards import DefaultBoard as _DefaultBoard
+
+    notices = []
+    for board in _DefaultBoard.objects.get_all_visible_boards(account):
+        if board.subscribed and board.unread_count > 0:
+            notices.append("|555" + str(board.unread_count) + "|n new post" +
+                           ("s" if board.unread_count != 1 else "") + " on |555" + board.name + "|n")
+
+    if notices:
+        account.msg("|/Unread board posts: " + ", ".join(notices) + "|/")
@@ -0,0 +1,171 @@
+"""
+Keyset ("cursor") pagination for post listings.
+
+Rather than skipping a number of rows with OFFSET, which gets slower the deeper you page,
+each page is fetched by asking for the rows which sort after (or before) the last row the
+reader saw.  With an index on the sort columns, every page costs a single bounded query.
+
+"""
+import calendar
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+
+class Page(object):
+    """
+    A single page of results.
+
+    - items: The objects on this page, in display order.
+    - next_cursor: The cursor for the following page, or None if this is the last page.
+    - prev_cursor: The cursor for the preceding page, or None if this is the first page.
+
+    """
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+
+def _encode_value(value):
+    if isinstance(value, bool):
+        return "b1" if value else "b0"
+
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.utc)
+        return "d" + str(calendar.timegm(value.timetuple()) * 1000000 + value.microsecond)
+
+    return "i" + str(int(value))
+
+
+def _decode_value(string):
+    kind, value = string[0], string[1:]
+    if kind == "b":
+        return value == "1"
+
+    if kind == "d":
+        value = datetime.utcfromtimestamp(int(value) // 1000000).replace(microsecond=int(value) % 1000000)
+        if settings.USE_TZ:
+            value = timezone.make_aware(value, timezone.utc)
+        return value
+
+    return int(value)
+
+
+def encode_cursor(obj, ordering):
+    """
+    Builds a cursor pointing at the given object.
+
+    Args:
+        obj: The object to point at.
+        ordering (list): The ordering of the listing, as (field name, descending) tuples.
+
+    Returns:
+        A string suitable for use in a URL.
+
+    """
+    return "_".join(_encode_value(getattr(obj, field)) for field, descending in ordering)
+
+
+def decode_cursor(cursor, ordering):
+    """
+    Turns a cursor back into the sort values it points at.
+
+    Args:
+        cursor (str): A cursor from encode_cursor.
+        ordering (list): The ordering of the listing, as (field name, descending) tuples.
+
+    Returns:
+        A list of values, or None if the cursor isn't valid for this ordering.
+
+    """
+    try:
+        values = [_decode_value(v) for v in cursor.split("_")]
+    except (ValueError, IndexError, OverflowError):
+        return None
+
+    if len(values) != len(ordering):
+        return None
+
+    return values
+
+
+def _beyond(ordering, values, backwards):
+    """
+    Builds the filter matching rows that sort after the given values, or before them if
+    going backwards.
+
+    """
+    result = Q()
+    for i in reversed(range(len(ordering))):
+        field, descending = ordering[i]
+        lookup = "__lt" if descending != backwards else "__gt"
+        clause = Q(**{field + lookup: values[i]})
+        if i < len(ordering) - 1:
+            clause = clause | (Q(**{field: values[i]}) & result)
+        result = clause
+
+    return result
+
+
+def keyset_page(queryset, ordering, after=None, before=None, limit=25):
+    """
+    Fetches a single page of a listing.
+
+    Args:
+        queryset (QuerySet): The listing to page through.
+        ordering (list): The ordering of the listing, as (field name, descending) tuples.
+            The last field must be unique, so every row has a distinct position.
+        after (str): A cursor; if given, returns the page following it.
+        before (str): A cursor; if given, returns the page preceding it.
+        limit (int): The number of items on a page.
+
+    Returns:
+        A Page.
+
+    """
+    backwards = False
+    values = None
+    if before:
+        values = decode_cursor(before, ordering)
+        backwards = values is not None
+    elif after:
+        values = decode_cursor(after, ordering)
+
+    order = [("-" if descending != backwards else "") + field for field, descending in ordering]
+    queryset = queryset.order_by(*order)
+    if values:
+        queryset = queryset.filter(_beyond(ordering, values, backwards))
+
+    items = list(queryset[:limit + 1])
+    more = len(items) > limit
+    items = items[:limit]
+
+    if backwards:
+        items.reverse()
+
+    if not items:
+        return Page(items)
+
+    next_cursor = encode_cursor(items[-1], ordering) if (more if not backwards else True) else None
+    prev_cursor = encode_cursor(items[0], ordering) if (more if backwards else values is not None) else None
+
+    return Page(items, next_cursor=next_cursor, prev_cursor=prev_cursor)
@@ -0,0 +1,291 @@
+"""
+Optional profiling of board commands and web views.
+
+When enabled, every bboard and bbadmin switch and every board web view records how long
+it took, how many database queries it made, how long those queries took, and how many
+rows they returned.  The figures are kept in memory, per switch or view, and shown by
+`bbadmin/stats`.
+
+Profiling is off unless PAXBOARDS_PROFILING is set, or it is turned on with
+`bbadmin/stats on`.  While off, it costs next to nothing per command or view.
+
+Queries are counted by having Django wrap database cursors in a counting version of its
+debug cursor, for just the duration of the command or view being measured, and only on
+the database connection of the thread running it.
+
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from django.db.backends.utils import CursorDebugWrapper
+
+from paxboards import metrics
+
+enabled = [getattr(settings, "PAXBOARDS_PROFILING", False)]
+
+# How many recent timings to keep per switch or view, for percentiles, and how many
+# different switches and views to keep figures for at most.
+SAMPLES = 200
+MAX_NAMES = 200
+
+OTHER = "(other)"
+
+# name -> Stats
+_stats = {}
+
+_local = threading.local()
+
+
+class Stats(object):
+    """
+    The figures recorded for one switch or view.
+
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.wall_max = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.recent = deque(maxlen=SAMPLES)
+
+    def add(self, wall, queries, db_time, rows):
+        self.calls += 1
+        self.wall += wall
+        self.wall_max = max(self.wall_max, wall)
+        self.queries += queries
+        self.db_time += db_time
+        self.rows += rows
+        self.recent.append(wall)
+
+    def percentile(self, pct):
+        """
+        Returns a percentile of the recent timings, in seconds.
+
+        """
+        samples = sorted(self.recent)
+        if not samples:
+            return 0.0
+
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+
+class Frame(object):
+    """
+    The queries made while something is being watched; see watch.
+
+    """
+
+    def __init__(self, log=False):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.log = [] if log else None
+
+
+class _CountingCursor(CursorDebugWrapper):
+    """
+    Django's debug cursor, which also adds each query, its time and the rows fetched to
+    whatever is currently being watched on this thread.
+
+    """
+
+    def _count(self, func, sql, params):
+        start = time.time()
+        try:
+            return func(sql, params)
+        finally:
+            elapsed = time.time() - start
+            for frame in getattr(_local, "frames", ()):
+                frame.queries += 1
+                frame.db_time += elapsed
+                if frame.log is not None:
+                    frame.log.append((sql, params, elapsed, getattr(_local, "label", None)))
+
+    def execute(self, sql, params=None):
+        return self._count(super(_CountingCursor, self).execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._count(super(_CountingCursor, self).executemany, sql, param_list)
+
+    def _fetched(self, count):
+        for frame in getattr(_local, "frames", ()):
+            frame.rows += count
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self._fetched(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+
+@contextmanager
+def watch(log=False):
+    """
+    Counts the queries made on this thread for the duration of a with block, by having
+    Django wrap its cursors in a counting debug cursor until the block ends.
+
+    Args:
+        log (bool): Whether to keep each query's SQL, parameters, time and label, as well
+            as the totals.
+
+    Returns:
+        A context manager giving a Frame.
+
+    """
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        frames = _local.frames = []
+
+    if not frames:
+        _local.old_force = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        connection.make_debug_cursor = lambda cursor: _CountingCursor(cursor, connection)
+
+    frame = Frame(log=log)
+    frames.append(frame)
+    try:
+        yield frame
+    finally:
+        frames.remove(frame)
+        if not frames:
+            del connection.make_debug_cursor
+            connection.force_debug_cursor = _local.old_force
+
+
+@contextmanager
+def labelled(label):
+    """
+    Labels the queries logged on this thread for the duration of a with block.
+
+    """
+    old = getattr(_local, "label", None)
+    _local.label = label
+    try:
+        yield
+    finally:
+        _local.label = old
+
+
+def label():
+    """
+    Returns the label queries on this thread are currently being logged under, or None.
+
+    """
+    return getattr(_local, "label", None)
+
+
+def context():
+    """
+    Returns the name of the command switch or view running on this thread, or None.
+
+    """
+    return getattr(_local, "context", None)
+
+
+def _record(name, wall, frame):
+    if name not in _stats and len(_stats) >= MAX_NAMES:
+        name = OTHER
+
+    stats = _stats.get(name)
+    if not stats:
+        stats = _stats[name] = Stats()
+
+    stats.add(wall, frame.queries, frame.db_time, frame.rows)
+
+
+def _measure(name, func, *args, **kwargs):
+    old_context = context()
+    _local.context = name
+    try:
+        if not enabled[0] or old_context:
+            # Not profiling, or already measuring whatever called this.
+            return func(*args, **kwargs)
+
+        with watch() as frame:
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, time.time() - start, frame)
+    finally:
+        _local.context = old_context
+
+
+def profiled_command(func):
+    """
+    Decorates a command's func method, so it's measured under its key and switches when
+    profiling is on.
+
+    """
+    @wraps(func)
+    def wrapper(self):
+        name = self.key
+        if self.switches:
+            name += "/" + "/".join(self.switches)
+        return _measure(name, func, self)
+
+    return wrapper
+
+
+def profiled_view(func):
+    """
+    Decorates a view, so it's measured under its name when profiling is on.  Its latency
+    is always added to the metrics, either way.
+
+    """
+    name = "view:" + func.__name__
+
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        start = time.time()
+        try:
+            return _measure(name, func, request, *args, **kwargs)
+        finally:
+            metrics.observe("paxboards_view_seconds", time.time() - start, view=func.__name__)
+
+    return wrapper
+
+
+def enable(on=True):
+    """
+    Turns profiling on or off, for this process.
+
+    """
+    enabled[0] = on
+
+
+def stats():
+    """
+    Returns the recorded figures.
+
+    Returns:
+        A list of (name, Stats) tuples, those with the most total time first.
+
+    """
+    return sorted(_stats.items(), key=lambda item: item[1].wall, reverse=True)
+
+
+def reset():
+    """
+    Clears every recorded figure.
+
+    """
+    _stats.clear()
@@ -0,0 +1,177 @@
+"""
+Write-behind buffering of read receipts.
+
+Reading a post marks it read, which would otherwise mean a database write for every post
+every player reads, on the game and on the web.  Instead, changed read states are kept
+here and written out together: every FLUSH_INTERVAL seconds, as soon as FLUSH_SIZE of
+them are waiting, and when the server shuts down or reloads.
+
+Until they are written, the read state manager hands out the pending read states in
+place of what is in the database, so unread counts and markers stay correct in the
+meantime.  As with paxboards.caches, this relies on the game and the webserver sharing
+one process, as they do on a standard install.
+
+"""
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from evennia.utils import logger
+from twisted.internet import reactor, threads
+from twisted.python import threadable
+
+from paxboards import caches, metrics
+
+# How many seconds a changed read state may wait before being written, and how many may
+# wait before they are written regardless.
+FLUSH_INTERVAL = getattr(settings, "PAXBOARDS_READ_FLUSH_INTERVAL", 5)
+FLUSH_SIZE = getattr(settings, "PAXBOARDS_READ_FLUSH_SIZE", 200)
+
+# Read states are recorded from the webserver's threads as well as the reactor, so the
+# buffers are only changed with this held.
+_lock = threading.Lock()
+
+# (account id, board id) -> ReadState waiting to be written, and those being written by
+# a flush which hasn't finished yet.
+_pending = {}
+_flushing = {}
+
+# The timed flush and shutdown trigger are only touched from the reactor thread.
+_scheduled = [None]
+_shutdown_trigger = [None]
+
+
+def pending(account_id, board_id):
+    """
+    Returns the read state of an account on a board if it is waiting to be written, or
+    None if it isn't.
+
+    """
+    key = (account_id, board_id)
+    with _lock:
+        return _pending.get(key) or _flushing.get(key)
+
+
+def _in_reactor(func):
+    # Runs a function on the reactor thread, now if this is it, or soon if it isn't.
+    if not reactor.running or threadable.isInIOThread():
+        func()
+    else:
+        reactor.callFromThread(func)
+
+
+def record(state):
+    """
+    Queues a changed read state to be written.  Several changes to the same read state
+    before the next flush are written only once.  This may be called from any thread.
+
+    Args:
+        state (ReadState): The read state which changed.
+
+    """
+    with _lock:
+        _pending[(state.db_account_id, state.db_board_id)] = state
+        waiting = len(_pending)
+
+    metrics.inc("paxboards_read_receipts_total")
+    caches.bump_reads(state.db_account_id, state.db_board_id)
+
+    if waiting >= FLUSH_SIZE or not reactor.running:
+        _in_reactor(flush)
+    else:
+        _in_reactor(_schedule)
+
+
+def _schedule():
+    _install_shutdown_trigger()
+    if not _scheduled[0] or not _scheduled[0].active():
+        _scheduled[0] = reactor.callLater(FLUSH_INTERVAL, _flush_later)
+
+
+def _flush_later():
+    _scheduled[0] = None
+    flush()
+
+
+def _install_shutdown_trigger():
+    # Evennia reloads by restarting the server process, so this covers @reload too.
+    if not _shutdown_trigger[0]:
+        _shutdown_trigger[0] = reactor.addSystemEventTrigger('before', 'shutdown', flush)
+
+
+def _save(state):
+    # A player's first read state on a board is made in memory, so two threads can each
+    # make one.  Whichever is written second merges what the first one read into its own,
+    # with the row locked, and updates it.  The row is read as plain values, as the
+    # idmapper could otherwise hand back the first thread's object.
+    if state.pk is None:
+        try:
+            with transaction.atomic():
+                state.save()
+            return
+        except IntegrityError:
+            model = state.__class__
+            row = model.objects.select_for_update()\
+                .filter(db_account_id=state.db_account_id, db_board_id=state.db_board_id)\
+                .values('id', 'db_read_through', 'db_read_above', 'db_unread_below')[0]
+            state.merge(model(db_read_through=row['db_read_through'], db_read_above=row['db_read_above'],
+                              db_unread_below=row['db_unread_below']))
+            state.pk = row['id']
+
+    state.save()
+
+
+def flush():
+    """
+    Writes every waiting read state to the database, in a single transaction.  Read
+    states recorded while this is writing are kept for the next flush.
+
+    Returns:
+        The number of read states written.
+
+    """
+    global _pending
+    with _lock:
+        if not _pending:
+            return 0
+        states, _pending = _pending, {}
+        _flushing.update(states)
+
+    try:
+        with transaction.atomic():
+            for state in states.values():
+                _save(state)
+    except Exception:
+        logger.log_trace("Error writing board read states.")
+
+        # Keep them for the next flush, unless they've been changed again since.
+        with _lock:
+            for key, state in states.items():
+                _pending.setdefault(key, state)
+                _flushing.pop(key, None)
+        if reactor.running:
+            _in_reactor(_schedule)
+        return 0
+    else:
+        with _lock:
+            for key, state in states.items():
+                if _flushing.get(key) is state:
+                    del _flushing[key]
+
+    metrics.inc("paxboards_read_state_writes_total", len(states))
+    return len(states)
+
+
+def flush_and_wait():
+    """
+    Writes every waiting read state to the database before returning, from any thread.
+    Outside the reactor thread, this has the reactor do the flush and waits for it.
+
+    Returns:
+        The number of read states written.
+
+    """
+    if not reactor.running or threadable.isInIOThread():
+        return flush()
+
+    return threads.blockingCallFromThread(reactor, flush)
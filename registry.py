@@ -0,0 +1,108 @@
+"""
+An in-memory registry of board names.
+
+Commands name boards by any unambiguous prefix of their names, in any case, which would
+otherwise mean an 'istartswith' query every time a board is named.  Instead, the names
+of all the boards are kept here in a trie of their case-folded names, so finding the
+boards a prefix matches is a walk down the trie, with no queries.
+
+The registry is built from the database the first time it's needed, and again whenever
+a board has been created, deleted, renamed or otherwise changed since; see the registry
+version in paxboards.caches.  Boards changed by another process, such as the
+paxboards_import management command, don't bump that version, so the registry is also
+built again once it is REGISTRY_TTL seconds old.
+
+"""
+import time
+
+from django.conf import settings
+
+from paxboards import caches
+
+REGISTRY_TTL = getattr(settings, "PAXBOARDS_REGISTRY_TTL", 60)
+
+_BoardDB = None
+
+# (registry version, {case-folded name: [board ids]}, trie root, when it was built)
+_registry = [None]
+
+
+class _Node(object):
+    """
+    A node of the trie, holding the ids of every board whose case-folded name starts
+    with the letters leading to it.
+
+    """
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children = {}
+        self.ids = []
+
+
+def _fold(name):
+    return (name or u"").lower()
+
+
+def _build():
+    global _BoardDB
+    if not _BoardDB:
+        from paxboards.models import BoardDB as _BoardDB
+
+    version = caches.registry_version()
+    names = {}
+    root = _Node()
+    for board_id, key in _BoardDB.objects.order_by('id').values_list('id', 'db_key'):
+        folded = _fold(key)
+        names.setdefault(folded, []).append(board_id)
+
+        node = root
+        node.ids.append(board_id)
+        for letter in folded:
+            node = node.children.setdefault(letter, _Node())
+            node.ids.append(board_id)
+
+    _registry[0] = (version, names, root, time.time())
+    return _registry[0]
+
+
+def _current():
+    entry = _registry[0]
+    if entry and entry[0] == caches.registry_version() and time.time() - entry[3] < REGISTRY_TTL:
+        return entry
+
+    return _build()
+
+
+def exact(name):
+    """
+    Returns the ids of the boards with a given name, ignoring case.
+
+    Args:
+        name (str): The name to look for.
+
+    Returns:
+        A list of board ids, in the order the boards were created.
+
+    """
+    return list(_current()[1].get(_fold(name), []))
+
+
+def starting_with(prefix):
+    """
+    Returns the ids of the boards whose names start with a given prefix, ignoring case.
+
+    Args:
+        prefix (str): The start of the names to look for.
+
+    Returns:
+        A list of board ids, in the order the boards were created.
+
+    """
+    node = _current()[2]
+    for letter in _fold(prefix):
+        node = node.children.get(letter)
+        if node is None:
+            return []
+
+    return list(node.ids)
@@ -0,0 +1,191 @@
+"""
+Background scripts for the board system.
+
+Boards normally keep expired posts in the database and just stop showing them.  Boards
+set to truncate (with `bbadmin/truncate`) have their expired posts deleted for real by
+the ExpirySweeper script instead, a small batch at a time so it never holds up the game.
+Posts are removed a thread at a time: a post which starts a thread is only removed once
+its replies have expired too, and then together with them, so replies are never left
+behind as threads of their own.
+
+Boards with an archive age (set with `bbadmin/archive`) have threads nobody has posted
+in for longer than that moved into their archive by the same script, rather than
+deleted.  Expired posts on boards which both truncate and archive are archived too.
+
+"""
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from evennia import DefaultScript, create_script, search_script
+from evennia.utils import logger
+
+from paxboards import metrics, profiling, receipts
+from paxboards.boards import DefaultBoard
+from paxboards.managers import chunked
+from paxboards.models import Post, ReadState, ArchivedPost
+
+SWEEPER_KEY = "paxboards_expiry_sweeper"
+
+# How many expired posts to delete per run, and how many seconds to wait between runs.
+SWEEP_BATCH_SIZE = getattr(settings, "PAXBOARDS_SWEEP_BATCH_SIZE", 100)
+SWEEP_INTERVAL = getattr(settings, "PAXBOARDS_SWEEP_INTERVAL", 60)
+
+# Running totals of the sweeper's progress in this process.  Counting the posts still
+# waiting to be removed takes a query per board, so is only done while profiling is on.
+progress = {"runs": 0, "deleted": 0, "archived": 0, "pending": 0, "last_run": None, "last_duration": 0.0}
+
+
+def _prune_read_states(board, deleted_ids):
+    """
+    Drops deleted posts from the read/unread exceptions of everyone's read state on a board.
+
+    """
+    deleted_ids = set(deleted_ids)
+
+    # Write out waiting read states first, so they aren't pruned and then overwritten.
+    receipts.flush()
+    states = ReadState.objects.filter(db_board=board).exclude(Q(db_read_above="") & Q(db_unread_below=""))
+    for state in states:
+        state.forget(deleted_ids)
+
+
+def _sweepable(board):
+    if board.db_archive_days:
+        posts = Post.objects.archivable_on_board(board)
+        if board.db_truncate:
+            posts = posts | Post.objects.expired_on_board(board)
+        return posts
+
+    if board.db_truncate:
+        return Post.objects.expired_on_board(board)
+
+    return Post.objects.none()
+
+
+def _sweeping_boards():
+    return DefaultBoard.objects.filter(Q(db_truncate=True) | Q(db_archive_days__isnull=False)).order_by('id')
+
+
+def _with_replies(posts):
+    # Adds the replies to any of the posts which start threads, so they go together.
+    result = list(posts)
+    ids = set(p.id for p in result)
+    parents = [p.id for p in result]
+    while parents:
+        replies = [r for chunk in chunked(parents) for r in Post.objects.filter(db_parent__in=chunk)
+                   if r.id not in ids]
+        result.extend(replies)
+        ids.update(r.id for r in replies)
+        parents = [r.id for r in replies]
+
+    return result
+
+
+def sweep_board(board, limit):
+    """
+    Archives or deletes old or expired posts from a board, oldest first.
+
+    Args:
+        board (DefaultBoard): The board to sweep.
+        limit (int): Roughly the most posts to remove; a thread being removed is removed
+            whole, even if that goes over.
+
+    Returns:
+        A tuple of the number of posts deleted, and the number archived.
+
+    """
+    posts = _with_replies(_sweepable(board).order_by('db_sequence')[:limit])
+    if not posts:
+        return 0, 0
+
+    ids = [p.id for p in posts]
+    with transaction.atomic():
+        if board.db_archive_days:
+            ArchivedPost.objects.archive(board, posts)
+        else:
+            board.delete_posts(posts)
+
+        _prune_read_states(board, ids)
+
+    if board.db_archive_days:
+        return 0, len(ids)
+
+    return len(ids), 0
+
+
+def sweep(batch_size=None):
+    """
+    Removes one batch of old or expired posts, spread across every board which truncates
+    or archives.
+
+    Args:
+        batch_size (int): The most posts to remove in total, or None for the default.
+
+    Returns:
+        The number of posts removed.
+
+    """
+    remaining = batch_size or SWEEP_BATCH_SIZE
+    start = time.time()
+
+    deleted = 0
+    archived = 0
+    for board in _sweeping_boards():
+        if remaining <= 0:
+            break
+
+        board_deleted, board_archived = sweep_board(board, remaining)
+        deleted += board_deleted
+        archived += board_archived
+        remaining -= board_deleted + board_archived
+
+    progress["runs"] += 1
+    progress["deleted"] += deleted
+    progress["archived"] += archived
+    if profiling.enabled[0]:
+        progress["pending"] = sum(_sweepable(b).count() for b in _sweeping_boards())
+        progress["last_run"] = time.time()
+    progress["last_duration"] = time.time() - start
+
+    metrics.inc("paxboards_sweeper_runs_total")
+    metrics.inc("paxboards_sweeper_removed_total", deleted, action="deleted")
+    metrics.inc("paxboards_sweeper_removed_total", archived, action="archived")
+    metrics.set_gauge("paxboards_sweeper_pending", progress["pending"])
+
+    return deleted + archived
+
+
+class ExpirySweeper(DefaultScript):
+    """
+    Periodically deletes or archives expired and old posts, on boards set to do so.
+
+    """
+
+    def at_script_creation(self):
+        self.key = SWEEPER_KEY
+        self.desc = "Deletes or archives old board posts."
+        self.interval = SWEEP_INTERVAL
+        self.persistent = True
+
+    def at_repeat(self):
+        try:
+            sweep()
+        except Exception:
+            logger.log_trace("Error sweeping old board posts.")
+
+
+def ensure_sweeper():
+    """
+    Starts the sweeper script, if it isn't already running.
+
+    Returns:
+        The sweeper script.
+
+    """
+    found = search_script(SWEEPER_KEY)
+    if found:
+        return found[0]
+
+    return create_script(ExpirySweeper, key=SWEEPER_KEY, persistent=True)
@@ -0,0 +1,319 @@
+"""
+Full-text search for board posts.
+
+Posts are broken into lowercase word tokens, and each token is stored in an inverted
+index along with the field it came from (subject, poster, or text) and its positions
+within that field.  The index is kept up to date as posts are made, edited and deleted,
+and can be rebuilt from scratch with `rebuild`.
+
+Queries are made up of plain words, "quoted phrases" and prefix* words; a post has to
+match all of them.  Matches are ranked by how often the terms appear, weighted by the
+field they were found in and by how rare each term is.
+
+So that a search doesn't have to look at every posting of a word found in most posts,
+very common words (STOPWORDS) aren't indexed or searched for, prefixes have to be at
+least MIN_PREFIX_LENGTH letters long, and the rarest word in a query is looked up first,
+with the others only looked up among the posts it was found in.
+
+"""
+import math
+import re
+from collections import defaultdict
+
+from django.db import transaction
+from paxboards.managers import chunked
+from paxboards.models import Post, SearchPosting
+
+FIELD_SUBJECT = 0
+FIELD_POSTER = 1
+FIELD_TEXT = 2
+
+FIELD_WEIGHTS = {FIELD_SUBJECT: 3.0, FIELD_POSTER: 2.0, FIELD_TEXT: 1.0}
+
+MAX_TOKEN_LENGTH = 40
+BATCH_SIZE = 500
+
+# Words too common to be worth indexing.  In phrases, they still take up a position.
+STOPWORDS = frozenset(("a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "has", "have",
+                       "i", "if", "in", "is", "it", "its", "of", "on", "or", "so", "that", "the", "this",
+                       "to", "was", "were", "will", "with", "you"))
+
+# Shorter prefix* words are searched for as whole words.
+MIN_PREFIX_LENGTH = 3
+
+# The most postings looked at for the rarest word of a query; beyond this, only the
+# newest posts containing it are searched.
+MAX_CANDIDATES = 5000
+
+_RE_TOKEN = re.compile(r"\w+", re.UNICODE)
+_RE_QUERY = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Splits a string into lowercase word tokens.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        A list of tokens, in the order they appear.
+
+    """
+    if not text:
+        return []
+
+    return [t[:MAX_TOKEN_LENGTH] for t in _RE_TOKEN.findall(text.lower())]
+
+
+def _post_fields(post):
+    return ((FIELD_SUBJECT, post.db_subject),
+            (FIELD_POSTER, post.db_poster_name),
+            (FIELD_TEXT, post.plaintext))
+
+
+def _postings_for(post):
+    postings = []
+    for field, text in _post_fields(post):
+        positions = defaultdict(list)
+        for pos, token in enumerate(tokenize(text)):
+            positions[token].append(pos)
+
+        for token, where in positions.items():
+            if token in STOPWORDS:
+                continue
+            postings.append(SearchPosting(db_token=token, db_post_id=post.id, db_board_id=post.db_board_id,
+                                          db_field=field, db_positions=",".join(str(p) for p in where)))
+
+    return postings
+
+
+def index_post(post):
+    """
+    Adds a post to the search index, replacing anything previously indexed for it.  This
+    should be called whenever a post is made or edited; deleted posts drop out of the
+    index along with their database row.
+
+    Args:
+        post (Post): The post to index.
+
+    Returns:
+        None
+
+    """
+    index_posts([post])
+
+
+def index_posts(posts):
+    """
+    Adds several posts to the search index at once, replacing anything previously indexed
+    for them.
+
+    Args:
+        posts (list): The posts to index.
+
+    Returns:
+        None
+
+    """
+    postings = []
+    for post in posts:
+        postings.extend(_postings_for(post))
+
+    with transaction.atomic():
+        SearchPosting.objects.filter(db_post__in=[p.id for p in posts]).delete()
+        SearchPosting.objects.bulk_create(postings, batch_size=BATCH_SIZE)
+
+
+def rebuild(board=None):
+    """
+    Rebuilds the search index from scratch, for one board or for all of them.
+
+    Args:
+        board (BoardDB): The board to reindex, or None for every board.
+
+    Returns:
+        The number of posts indexed.
+
+    """
+    posts = Post.objects.all()
+    existing = SearchPosting.objects.all()
+    if board:
+        posts = posts.filter(db_board=board)
+        existing = existing.filter(db_board=board)
+
+    count = 0
+    with transaction.atomic():
+        existing.delete()
+
+        batch = []
+        for post in posts.order_by('id').iterator():
+            batch.extend(_postings_for(post))
+            count += 1
+            if len(batch) >= BATCH_SIZE:
+                SearchPosting.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+                batch = []
+
+        SearchPosting.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+
+    return count
+
+
+def parse_query(query):
+    """
+    Splits a search string into terms.  Each term is a tuple of (tokens, prefix), where
+    tokens is a list of the words which must appear in order, and prefix is True if the
+    last of them only needs to match the start of a word.  Stopwords are left in, as
+    they still take up a place in phrases, but a term made only of stopwords is dropped.
+
+    Args:
+        query (str): The search string.
+
+    Returns:
+        A list of terms.
+
+    """
+    terms = []
+    for phrase, word in _RE_QUERY.findall(query or ""):
+        if phrase:
+            tokens = tokenize(phrase)
+            prefix = False
+        else:
+            tokens = tokenize(word)
+            prefix = word.endswith("*") and len(tokens) == 1 and len(tokens[0]) >= MIN_PREFIX_LENGTH
+
+        if any(t not in STOPWORDS for t in tokens):
+            terms.append((tokens, prefix))
+
+    return terms
+
+
+def _postings(token, prefix, boards):
+    postings = SearchPosting.objects.all()
+    if prefix:
+        postings = postings.filter(db_token__startswith=token)
+    else:
+        postings = postings.filter(db_token=token)
+
+    if boards is not None:
+        postings = postings.filter(db_board__in=boards)
+
+    return postings
+
+
+def _fetch(token, prefix, boards, candidates=None):
+    """
+    Fetches the postings for a single token, as a dict of post id -> field -> positions.
+    If candidates is given, only postings for those posts are fetched; otherwise, only
+    the newest MAX_CANDIDATES postings are.
+
+    """
+    postings = _postings(token, prefix, boards).values_list('db_post_id', 'db_field', 'db_positions')
+    if candidates is None:
+        rows = postings.order_by('-db_post_id')[:MAX_CANDIDATES]
+    else:
+        rows = []
+        for chunk in chunked(candidates):
+            rows.extend(postings.filter(db_post__in=chunk))
+
+    result = defaultdict(lambda: defaultdict(set))
+    for post_id, field, positions in rows:
+        result[post_id][field].update(int(p) for p in positions.split(",") if p)
+
+    return result
+
+
+def phrase_hits(fields):
+    """
+    Counts how often a term appears in each field of a post.
+
+    Args:
+        fields (dict): Maps the place of each of the term's words within the term to the
+            positions of that word in each field, as {place: {field: set(positions)}}.
+            Places with no entry, such as those of stopwords, match any word.
+
+    Returns:
+        A dictionary mapping fields to the number of times the term appears in them.
+
+    """
+    places = sorted(fields)
+    first = places[0]
+    hits = {}
+    for field, positions in fields[first].items():
+        count = 0
+        for position in positions:
+            start = position - first
+            if all(start + place in fields[place].get(field, ()) for place in places[1:]):
+                count += 1
+        if count:
+            hits[field] = count
+
+    return hits
+
+
+def search(query, boards=None):
+    """
+    Searches the index.
+
+    Args:
+        query (str): The search string.
+        boards (list): The boards to search, or None to search every board.
+
+    Returns:
+        A list of (post id, score) tuples, best match first.
+
+    """
+    terms = []
+    for tokens, prefix in parse_query(query):
+        words = [(place, token, prefix and place == len(tokens) - 1) for place, token in enumerate(tokens)
+                 if token not in STOPWORDS]
+        terms.append(words)
+
+    if not terms:
+        return []
+
+    frequency = {}
+    for words in terms:
+        for place, token, prefix in words:
+            if (token, prefix) not in frequency:
+                frequency[(token, prefix)] = _postings(token, prefix, boards).count()
+                if not frequency[(token, prefix)]:
+                    return []
+
+    def rareness(word):
+        return frequency[(word[1], word[2])]
+
+    total = Post.objects.filter(db_board__in=boards).count() if boards is not None else Post.objects.count()
+
+    # Rarest first, so each lookup after the first only covers posts which could match.
+    candidates = None
+    scores = None
+    for words in sorted(terms, key=lambda w: min(rareness(word) for word in w)):
+        fetched = {}
+        for word in sorted(words, key=rareness):
+            place, token, prefix = word
+            fetched[place] = _fetch(token, prefix, boards, candidates)
+            candidates = set(fetched[place]) if candidates is None else candidates & set(fetched[place])
+            if not candidates:
+                return []
+
+        # Rarer terms count for more.
+        rarity = math.log(1.0 + float(total) / max(min(rareness(word) for word in words), 1))
+
+        term_scores = {}
+        for post_id in candidates:
+            hits = phrase_hits(dict((place, lookup[post_id]) for place, lookup in fetched.items()))
+            if hits:
+                term_scores[post_id] = rarity * sum(FIELD_WEIGHTS[f] * (1.0 + math.log(c)) for f, c in hits.items())
+
+        if scores is None:
+            scores = term_scores
+        else:
+            scores = dict((post_id, scores[post_id] + score) for post_id, score in term_scores.items()
+                          if post_id in scores)
+
+        candidates = set(scores)
+        if not scores:
+            return []
+
+    return sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=True)
@@ -0,0 +1,127 @@
+"""
+A log of slow board queries.
+
+When PAXBOARDS_SLOW_QUERY_MS is set, the board managers' lookups are timed, and any
+which take longer than that many milliseconds are written to a rotating log file, along
+with the command switch or web page that made them and the SQL of each query they ran,
+slowest first.  The slowest query's plan, as given by the database's EXPLAIN, is logged
+too, to show where an index isn't being used.
+
+Watching queries has a cost of its own, so this is off unless the setting is given.
+
+"""
+import logging
+import os
+import time
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+from django.db import connection
+from evennia.utils import logger
+
+from paxboards import profiling
+
+THRESHOLD_MS = getattr(settings, "PAXBOARDS_SLOW_QUERY_MS", None)
+LOG_FILE = getattr(settings, "PAXBOARDS_SLOW_QUERY_LOG",
+                   os.path.join(getattr(settings, "LOG_DIR", "."), "paxboards_slow_queries.log"))
+LOG_MAX_BYTES = 1000000
+LOG_BACKUPS = 5
+
+# How many of the slowest queries to log for each slow lookup.
+MAX_QUERIES = 5
+
+_logger = [None]
+
+
+def _log():
+    if not _logger[0]:
+        log = logging.getLogger("paxboards.slowlog")
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        log.addHandler(handler)
+        _logger[0] = log
+
+    return _logger[0]
+
+
+def explain(sql, params):
+    """
+    Asks the database how it would run a query.
+
+    Args:
+        sql (str): The query.
+        params (tuple): Its parameters.
+
+    Returns:
+        A list of lines describing the plan, or None if it can't be explained.
+
+    """
+    if not sql.lstrip().upper().startswith("SELECT"):
+        return None
+
+    if connection.vendor == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif connection.vendor in ("postgresql", "mysql"):
+        prefix = "EXPLAIN "
+    else:
+        return None
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return [" | ".join(unicode(c) for c in row) for row in cursor.fetchall()]
+    except Exception as e:
+        return ["(could not explain: %s)" % e]
+
+
+def _report(name, elapsed, frame):
+    queries = sorted(frame.log, key=lambda q: q[2], reverse=True)
+
+    lines = ["Slow board lookup: %s took %.1fms over %d queries (in %s)" %
+             (name, elapsed * 1000, len(queries), profiling.context() or "unknown")]
+    for sql, params, query_time, label in queries[:MAX_QUERIES]:
+        lines.append("  [%.1fms] %s: %s" % (query_time * 1000, label or name, sql))
+        lines.append("    params: %r" % (params,))
+
+    if queries:
+        plan = explain(queries[0][0], queries[0][1])
+        if plan:
+            lines.append("  plan of slowest query:")
+            lines.extend("    " + line for line in plan)
+
+    _log().info("\n".join(lines))
+
+
+def watched(func):
+    """
+    Decorates a manager method, so it is logged if it's slow.  Queries made by watched
+    methods it calls are logged under their own names, as part of the outermost one.
+
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if THRESHOLD_MS is None:
+            return func(self, *args, **kwargs)
+
+        name = self.__class__.__name__ + "." + func.__name__
+        if profiling.label():
+            with profiling.labelled(name):
+                return func(self, *args, **kwargs)
+
+        with profiling.watch(log=True) as frame, profiling.labelled(name):
+            start = time.time()
+            result = func(self, *args, **kwargs)
+            elapsed = time.time() - start
+
+        if elapsed * 1000 >= THRESHOLD_MS:
+            try:
+                _report(name, elapsed, frame)
+            except Exception:
+                logger.log_trace("Error logging slow board lookup.")
+
+        return result
+
+    return wrapper
@@ -1,3 +1,350 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import time
+from collections import deque
+from datetime import datetime
 
-# Create your tests here.
+from django.db.models import Q
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from evennia.utils.test_resources import EvenniaTest
+from mock import MagicMock, patch
+
+from paxboards import caches, events, paging, receipts, registry, search, transfer
+from paxboards.boards import DefaultBoard
+from paxboards.models import Post, ReadState, _format_id_set, _parse_id_set
+
+
+@patch("paxboards.models.receipts.record")
+class ReadStateTest(SimpleTestCase):
+
+    def test_id_sets(self, record):
+        self.assertEqual(_format_id_set([12, 3, 7]), "3,7,12")
+        self.assertEqual(_parse_id_set("3,7,12"), {3, 7, 12})
+        self.assertEqual(_parse_id_set(""), set())
+        self.assertEqual(_parse_id_set(_format_id_set([])), set())
+
+    def test_is_read(self, record):
+        state = ReadState(db_read_through=10, db_read_above="15", db_unread_below="4")
+        self.assertTrue(state.is_read(3))
+        self.assertFalse(state.is_read(4))
+        self.assertTrue(state.is_read(10))
+        self.assertFalse(state.is_read(11))
+        self.assertTrue(state.is_read(15))
+
+    def test_set_read(self, record):
+        state = ReadState(db_read_through=10)
+        state.set_read(4, False)
+        state.set_read(12, True)
+        self.assertEqual(state.db_unread_below, "4")
+        self.assertEqual(state.db_read_above, "12")
+        self.assertEqual(record.call_count, 2)
+
+        state.set_read(4, True)
+        state.set_read(12, False)
+        self.assertEqual(state.db_unread_below, "")
+        self.assertEqual(state.db_read_above, "")
+
+    def test_set_read_unchanged(self, record):
+        state = ReadState(db_read_through=10)
+        state.set_read(5, True)
+        state.set_read(11, False)
+        self.assertFalse(record.called)
+
+    def test_catch_up(self, record):
+        state = ReadState(db_read_through=10, db_read_above="12,20", db_unread_below="4")
+        state.catch_up(15)
+        self.assertEqual(state.db_read_through, 15)
+        self.assertEqual(state.db_read_above, "20")
+        self.assertEqual(state.db_unread_below, "")
+        self.assertTrue(state.is_read(4))
+        self.assertFalse(state.is_read(16))
+
+        # Catching up never moves the watermark back.
+        state.catch_up(5)
+        self.assertEqual(state.db_read_through, 15)
+
+    def test_set_read_posts(self, record):
+        posts = range(1, 11)
+        state = ReadState()
+        state.set_read_posts(posts, {1, 2, 3, 5, 6, 7, 9})
+        self.assertEqual(state.db_read_through, 7)
+        self.assertEqual(state.db_unread_below, "4")
+        self.assertEqual(state.db_read_above, "9")
+        self.assertEqual([p for p in posts if state.is_read(p)], [1, 2, 3, 5, 6, 7, 9])
+
+    def test_set_read_posts_mostly_unread(self, record):
+        state = ReadState()
+        state.set_read_posts(range(1, 11), {8})
+        self.assertEqual(state.db_read_through, 0)
+        self.assertEqual(state.db_read_above, "8")
+        self.assertEqual(state.db_unread_below, "")
+
+    def test_merge(self, record):
+        state = ReadState(db_read_through=3, db_unread_below="2", db_read_above="4,7")
+        other = ReadState(db_read_through=5, db_unread_below="2,4", db_read_above="9")
+        state.merge(other)
+        self.assertEqual(state.db_read_through, 5)
+        self.assertEqual(state.db_unread_below, "2")
+        self.assertEqual(state.db_read_above, "7,9")
+        self.assertEqual([p for p in range(1, 11) if state.is_read(p)], [1, 3, 4, 5, 7, 9])
+        self.assertFalse(record.called)
+
+
+class SearchQueryTest(SimpleTestCase):
+
+    def test_parse_query(self):
+        self.assertEqual(search.parse_query('Dragon "red wing" feath*'),
+                         [(["dragon"], False), (["red", "wing"], False), (["feath"], True)])
+
+    def test_short_prefixes_are_words(self):
+        self.assertEqual(search.parse_query("ab*"), [(["ab"], False)])
+
+    def test_stopwords(self):
+        self.assertEqual(search.parse_query('the "king of the hill"'),
+                         [(["king", "of", "the", "hill"], False)])
+        self.assertEqual(search.parse_query('"of the"'), [])
+
+    def test_phrase_hits(self):
+        fields = {0: {search.FIELD_TEXT: {1, 7}, search.FIELD_SUBJECT: {0}},
+                  3: {search.FIELD_TEXT: {4, 12}}}
+        self.assertEqual(search.phrase_hits(fields), {search.FIELD_TEXT: 1})
+
+    def test_phrase_hits_single_word(self):
+        fields = {0: {search.FIELD_TEXT: {1, 7}, search.FIELD_POSTER: {0}}}
+        self.assertEqual(search.phrase_hits(fields), {search.FIELD_TEXT: 2, search.FIELD_POSTER: 1})
+
+
+class _Row(object):
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+class PagingTest(SimpleTestCase):
+    ordering = [("db_pinned", True), ("db_last_post_on", True), ("id", True)]
+
+    @override_settings(USE_TZ=True)
+    def test_cursor_round_trip(self):
+        date = datetime(2017, 3, 4, 5, 6, 7, 891011, tzinfo=timezone.utc)
+        cursor = paging.encode_cursor(_Row(db_pinned=True, db_last_post_on=date, id=42), self.ordering)
+        self.assertEqual(paging.decode_cursor(cursor, self.ordering), [True, date, 42])
+
+    @override_settings(USE_TZ=False)
+    def test_cursor_round_trip_naive(self):
+        date = datetime(2017, 3, 4, 5, 6, 7, 891011)
+        cursor = paging.encode_cursor(_Row(db_pinned=False, db_last_post_on=date, id=7), self.ordering)
+        self.assertEqual(paging.decode_cursor(cursor, self.ordering), [False, date, 7])
+
+    def test_bad_cursors(self):
+        self.assertIsNone(paging.decode_cursor("i1_i2", self.ordering))
+        self.assertIsNone(paging.decode_cursor("b1_dnot-a-date_i2", self.ordering))
+        self.assertIsNone(paging.decode_cursor("", self.ordering))
+
+    def test_beyond(self):
+        ordering = [("db_pinned", True), ("id", False)]
+        self.assertEqual(str(paging._beyond(ordering, [True, 9], False)),
+                         str(Q(db_pinned__lt=True) | (Q(db_pinned=True) & Q(id__gt=9))))
+        self.assertEqual(str(paging._beyond(ordering, [True, 9], True)),
+                         str(Q(db_pinned__gt=True) | (Q(db_pinned=True) & Q(id__lt=9))))
+
+
+@override_settings(USE_TZ=True)
+class TransferTest(EvenniaTest):
+
+    def _import(self, records):
+        handle, path = tempfile.mkstemp(suffix=".jsonl")
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+        # Small batches, so replies are written after their threads' first posts.
+        return transfer.Importer(path, batch_size=2).import_all()
+
+    def test_round_trip(self):
+        account = self.account.username
+        records = [
+            {"type": "board", "key": "Imported", "maxposts": 100, "subscribers": [account]},
+            {"type": "post", "id": "t:1", "board": "Imported", "parent": None, "subject": "First",
+             "text": "Hello", "poster": "Alice", "poster_account": account,
+             "date": "2016-04-01T12:00:00+00:00", "pinned": True},
+            {"type": "post", "id": "t:2", "board": "Imported", "parent": "t:1", "subject": "Re: First",
+             "text": "Hi", "poster": "Bob", "poster_account": None,
+             "date": "2016-04-02T08:30:00+00:00", "pinned": False},
+            {"type": "post", "id": "t:3", "board": "Imported", "parent": None, "subject": "Second",
+             "text": "Again", "poster": "Alice", "poster_account": account,
+             "date": "2016-04-03T00:00:00+00:00", "pinned": False},
+            {"type": "read", "account": account, "board": "Imported", "through": "t:2",
+             "read": ["t:3"], "unread": ["t:1"]},
+        ]
+        counts = self._import(records)
+        self.assertEqual((counts["boards"], counts["posts"], counts["reads"], counts["errors"]), (1, 3, 1, 0))
+
+        # The posts keep their dates, and posts made meanwhile still get today's.
+        self.assertEqual(Post.objects.get(db_import_key="t:1").db_date_created,
+                         datetime(2016, 4, 1, 12, tzinfo=timezone.utc))
+        self.assertTrue(Post._meta.get_field('db_date_created').auto_now_add)
+
+        board = DefaultBoard.objects.get(db_key="Imported")
+        exported = list(transfer.export_records([board], read_receipts=True))
+        self.assertEqual(exported[1:], records[1:])
+
+        # Importing again skips what's already there.
+        counts = self._import(records)
+        self.assertEqual((counts["posts"], counts["skipped"]), (0, 3))
+
+    @override_settings(USE_TZ=False)
+    def test_dates_without_time_zones(self):
+        counts = self._import([
+            {"type": "board", "key": "Naive"},
+            {"type": "post", "id": "n:1", "board": "Naive", "date": "2016-04-01T12:00:00+00:00"},
+            {"type": "post", "id": "n:2", "board": "Naive", "date": "2016-04-02T12:00:00"}])
+        self.assertEqual((counts["posts"], counts["errors"]), (2, 0))
+
+        aware = datetime(2016, 4, 1, 12, tzinfo=timezone.utc)
+        self.assertEqual(Post.objects.get(db_import_key="n:1").db_date_created, timezone.make_naive(aware))
+        self.assertEqual(Post.objects.get(db_import_key="n:2").db_date_created, datetime(2016, 4, 2, 12))
+
+
+class MboxTest(SimpleTestCase):
+
+    def test_headers_are_one_line(self):
+        record = {"id": "t:1", "board": "News", "parent": None, "pinned": False,
+                  "poster": "Alice\r\nBcc: everyone@example.com", "subject": "Hi\n\nInjected body"}
+        message = transfer._mbox_message(record, datetime(2016, 4, 1, 12), "Text\nFrom here on")
+        headers, body = message.split("\n\n", 1)
+        self.assertIn("From: Alice Bcc: everyone@example.com", headers.split("\n"))
+        self.assertIn("Subject: Hi Injected body", headers.split("\n"))
+        self.assertEqual(body, "Text\n>From here on\n\n")
+
+
+class EventsTest(SimpleTestCase):
+
+    def setUp(self):
+        # A buffer of three events, and nothing waiting.
+        for name, value in (("_buffer", deque(maxlen=3)), ("_last_id", [0]), ("_clients", [0])):
+            patcher = patch.object(events, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _add(self, count):
+        for i in range(count):
+            post = _Row(id=i + 1, db_board_id=1, db_board=_Row(name="News"), db_parent_id=None,
+                        db_subject="Subject", db_poster_name="Alice", db_pinned=False, excerpt="",
+                        db_date_created=None)
+            events._add("post", post)
+
+    def test_events_after(self):
+        self.assertEqual(events.events_after(0), [])
+        self._add(2)
+        self.assertEqual([e.number for e in events.events_after(0)], [1, 2])
+        self.assertEqual([e.number for e in events.events_after(1)], [2])
+        self.assertEqual(events.events_after(2), [])
+
+    def test_events_after_gap(self):
+        self._add(5)
+        # Only the last three are kept.
+        self.assertIsNone(events.events_after(1))
+        self.assertEqual([e.number for e in events.events_after(2)], [3, 4, 5])
+
+    def test_ids(self):
+        self._add(2)
+        self.assertEqual(events.make_id(2), "%d-2" % caches.EPOCH)
+        self.assertEqual(events.parse_id(events.make_id(2)), 2)
+        self.assertEqual(events.parse_id(events.make_id(0)), 0)
+        # From the future, from before a restart, or not an ID at all.
+        self.assertIsNone(events.parse_id(events.make_id(3)))
+        self.assertIsNone(events.parse_id("%d-1" % (caches.EPOCH - 1)))
+        self.assertIsNone(events.parse_id("nonsense"))
+        self.assertIsNone(events.parse_id(None))
+
+    @patch.object(events, "MAX_CLIENTS", 2)
+    def test_max_clients(self):
+        self.assertTrue(events.join())
+        self.assertTrue(events.join())
+        self.assertFalse(events.join())
+        events.leave()
+        self.assertTrue(events.join())
+
+
+class RegistryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.boards = MagicMock()
+        self.boards.objects.order_by.return_value.values_list.return_value = [
+            (1, u"Announcements"), (2, u"announce-OOC"), (3, u"Ideas"), (4, u"IDEAS")]
+        for name, value in (("_BoardDB", self.boards), ("_registry", [None])):
+            patcher = patch.object(registry, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_exact(self):
+        self.assertEqual(registry.exact("announcements"), [1])
+        self.assertEqual(registry.exact("ideas"), [3, 4])
+        self.assertEqual(registry.exact("announce"), [])
+
+    def test_starting_with(self):
+        self.assertEqual(registry.starting_with("ANN"), [1, 2])
+        self.assertEqual(registry.starting_with("announce-"), [2])
+        self.assertEqual(registry.starting_with("i"), [3, 4])
+        self.assertEqual(registry.starting_with("x"), [])
+        self.assertEqual(registry.starting_with(""), [1, 2, 3, 4])
+
+    def test_rebuilt_when_boards_change(self):
+        registry.exact("ideas")
+        registry.starting_with("ann")
+        self.assertEqual(self.boards.objects.order_by.call_count, 1)
+
+        self.boards.objects.order_by.return_value.values_list.return_value = [(5, u"Ideas")]
+        caches.bump_registry()
+        self.assertEqual(registry.exact("ideas"), [5])
+        self.assertEqual(self.boards.objects.order_by.call_count, 2)
+
+    def test_rebuilt_when_old(self):
+        registry.exact("ideas")
+        # As if another process had changed the boards.
+        self.boards.objects.order_by.return_value.values_list.return_value = [(5, u"Ideas")]
+        self.assertEqual(registry.exact("ideas"), [3, 4])
+
+        with patch("paxboards.registry.time.time", return_value=time.time() + registry.REGISTRY_TTL):
+            self.assertEqual(registry.exact("ideas"), [5])
+
+
+class BoardLookupTest(EvenniaTest):
+
+    def test_get_boards_by_id(self):
+        boards = []
+        for key in ("First", "Second", "Third"):
+            board = DefaultBoard(db_key=key)
+            board.save()
+            boards.append(board)
+        ids = [boards[2].id, boards[0].id]
+
+        # Boards already in memory cost no queries.
+        with self.assertNumQueries(0):
+            self.assertEqual(DefaultBoard.objects.get_boards_by_id(ids), [boards[2], boards[0]])
+
+        # The rest are loaded together, and missing ones left out.
+        DefaultBoard.flush_cached_instance(boards[0])
+        with self.assertNumQueries(1):
+            self.assertEqual([b.id for b in DefaultBoard.objects.get_boards_by_id(ids + [ids[0] + 1000])], ids)
+
+
+class ReceiptsTest(EvenniaTest):
+
+    def test_concurrent_first_reads(self):
+        board = DefaultBoard(db_key="Reads")
+        board.save()
+
+        # Another thread wrote its first read state on the board while this one was
+        # making its own.
+        ReadState(db_account=self.account, db_board=board, db_read_through=5, db_unread_below="2,4",
+                  db_read_above="9").save()
+        state = ReadState(db_account=self.account, db_board=board, db_read_through=3, db_unread_below="2",
+                          db_read_above="4,7")
+        receipts._save(state)
+
+        rows = list(ReadState.objects.filter(db_account=self.account, db_board=board)
+                    .values_list('db_read_through', 'db_unread_below', 'db_read_above'))
+        self.assertEqual(rows, [(5, u"2", u"7,9")])
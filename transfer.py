@@ -0,0 +1,621 @@
+"""
+Bulk import and export of board data, as JSON Lines files.
+
+Each line of an import file is a JSON object with a "type", one of:
+
+- "board": {"type": "board", "key": "Announcements", "maxposts": 100, "maxdays": 30,
+  "truncate": false, "archive_days": null, "locks": "read:all();post:perm(Builders)",
+  "subscribers": ["alice", "bob"]}.  Only "key" is required.  The board is created if
+  it doesn't exist; the other fields are set if they are given.
+- "post": {"type": "post", "id": "arx:1234", "board": "Announcements", "parent": null,
+  "subject": "...", "text": "...", "poster": "Alice", "poster_account": "alice",
+  "date": "2016-04-01T12:00:00Z", "pinned": false}.  "id" is the post's id in the data
+  being imported, and must be unique across everything ever imported, so prefix ids from
+  different sources.  "parent" is the id of the first post of the thread, for replies.
+- "read": {"type": "read", "account": "alice", "board": "Announcements",
+  "through": "arx:1234", "read": ["arx:1300"], "unread": ["arx:1200"]}.  The account has
+  read every post up to "through", except those in "unread", and those in "read" too.
+
+Boards should come before their posts, posts before their replies and read states.
+
+Rather than going through DefaultBoard.create_post, posts are written with bulk inserts,
+a batch at a time, and no one is told about them.  Only one batch is held in memory, so
+files of any size can be imported.  How far an import has got is kept in a progress file
+beside the import file, and posts already imported are recognized by their ids, so an
+interrupted import can be run again and will pick up where it left off.
+
+Exports are written in the same format, so they can be imported again, or optionally as
+an mbox mailbox.  Posts are read a chunk at a time, in id order, as plain values rather
+than Post objects, so exporting even the largest board doesn't fill the memory or the
+idmapper cache.  Posts which weren't imported are given ids of the form "pax:<id>".
+
+"""
+import calendar
+import gzip
+import json
+import os
+import re
+import time
+import zlib
+from email.utils import formatdate
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from evennia.accounts.models import AccountDB
+from evennia.locks.lockhandler import LockException
+from evennia.utils import ansi
+
+from paxboards import caches, receipts, search
+from paxboards.boards import DefaultBoard
+from paxboards.managers import chunked
+from paxboards.models import Post, ReadState, _format_id_set
+
+BATCH_SIZE = getattr(settings, "PAXBOARDS_IMPORT_BATCH_SIZE", 500)
+
+# How many posts or read states an export reads at once.
+EXPORT_CHUNK_SIZE = 500
+
+_POST_FIELDS = ('id', 'db_import_key', 'db_parent_id', 'db_parent__db_import_key', 'db_subject', 'db_text',
+                'db_plaintext', 'db_poster_name', 'db_poster_player__username', 'db_date_created', 'db_pinned')
+
+# Where bbadmin/import and bbadmin/export read and write files.
+TRANSFER_DIR = getattr(settings, "PAXBOARDS_TRANSFER_DIR",
+                       os.path.join(getattr(settings, "GAME_DIR", "."), "server", "paxboards"))
+
+
+def create_posts(posts):
+    """
+    Writes new posts with bulk inserts, keeping the dates they were given.
+
+    db_date_created is set to 'now' whenever a post is first saved, bulk inserts included,
+    so the dates are put back afterwards with an update.  The field itself is left as it
+    is, so posts made meanwhile by anyone else still get the current date.  The posts'
+    ids are filled in, found by their boards and sequence numbers, which must be set.
+
+    Args:
+        posts (list): The unsaved Posts to write.
+
+    """
+    dates = [p.db_date_created for p in posts]
+    Post.objects.bulk_create(posts)
+
+    ids = {}
+    for board_id in set(p.db_board_id for p in posts):
+        sequences = [p.db_sequence for p in posts if p.db_board_id == board_id]
+        for chunk in chunked(sequences):
+            for sequence, post_id in Post.objects.filter(db_board_id=board_id, db_sequence__in=chunk) \
+                    .values_list('db_sequence', 'id'):
+                ids[(board_id, sequence)] = post_id
+
+    for post, date in zip(posts, dates):
+        post.id = ids[(post.db_board_id, post.db_sequence)]
+        post.db_date_created = date
+
+    # Three parameters a post, within SQLite's limit of 999.
+    for chunk in chunked(posts, 300):
+        dated = Case(*[When(pk=p.id, then=Value(p.db_date_created)) for p in chunk],
+                     output_field=DateTimeField())
+        Post.objects.filter(pk__in=[p.id for p in chunk]).update(db_date_created=dated)
+
+
+def transfer_path(name):
+    """
+    Returns the full path of a file in TRANSFER_DIR, or None if the name would lead
+    outside it.
+
+    """
+    path = os.path.normpath(os.path.join(TRANSFER_DIR, name))
+    if not path.startswith(os.path.normpath(TRANSFER_DIR) + os.sep):
+        return None
+
+    return path
+
+
+def open_file(path, mode="r"):
+    """
+    Opens a file for import or export, compressed with gzip if its name ends in .gz.
+
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "b")
+
+    return open(path, mode + "b")
+
+
+class Importer(object):
+    """
+    Imports a JSON Lines file.  Call run to get an iterator which imports a batch each
+    time it is advanced, or import_all to import everything at once.
+
+    Args:
+        path (str): The file to import.
+        batch_size (int): How many posts or read states to write at once.
+        restart (bool): Start from the top of the file, even if it was partly imported.
+
+    """
+
+    def __init__(self, path, batch_size=None, restart=False):
+        self.path = path
+        self.batch_size = batch_size or BATCH_SIZE
+        self.restart = restart
+        self.line = 0
+        self.counts = {"boards": 0, "posts": 0, "skipped": 0, "orphans": 0, "reads": 0, "errors": 0}
+
+        self._kind = None
+        self._pending = []
+        self._boards = {}
+
+    @property
+    def progress_path(self):
+        return self.path + ".progress"
+
+    def _resume_from(self):
+        if self.restart or not os.path.exists(self.progress_path):
+            return 0
+
+        with open(self.progress_path) as f:
+            return int(f.read().strip() or 0)
+
+    def _checkpoint(self):
+        with open(self.progress_path + ".tmp", "w") as f:
+            f.write(str(self.line))
+        os.rename(self.progress_path + ".tmp", self.progress_path)
+
+    def run(self):
+        """
+        Imports the file, a batch at a time.
+
+        Returns:
+            An iterator, which yields the running counts of what was imported after each
+            batch.
+
+        """
+        resume = self._resume_from()
+        with open_file(self.path) as f:
+            for number, line in enumerate(f, 1):
+                if number <= resume or not line.strip():
+                    continue
+
+                try:
+                    record = json.loads(line)
+                    kind = record["type"]
+                except (ValueError, KeyError, TypeError):
+                    self.counts["errors"] += 1
+                    continue
+
+                if kind != self._kind and self._pending:
+                    self._flush()
+                    yield self.counts
+
+                self.line = number
+                if kind == "board":
+                    self._import_board(record)
+                    self._checkpoint()
+                elif kind in ("post", "read"):
+                    self._kind = kind
+                    self._pending.append(record)
+                    if len(self._pending) >= self.batch_size:
+                        self._flush()
+                        yield self.counts
+                else:
+                    self.counts["errors"] += 1
+
+            if self._pending:
+                self._flush()
+
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+        yield self.counts
+
+    def import_all(self):
+        """
+        Imports the whole file.
+
+        Returns:
+            The counts of what was imported.
+
+        """
+        for counts in self.run():
+            pass
+        return self.counts
+
+    def _flush(self):
+        records, self._pending = self._pending, []
+        if self._kind == "post":
+            self._import_posts(records)
+        else:
+            self._import_reads(records)
+        self._kind = None
+        self._checkpoint()
+
+    def _board(self, key):
+        board = self._boards.get(key)
+        if not board:
+            board = DefaultBoard.objects.get_board_exact(key)
+            if board:
+                self._boards[key] = board
+        return board
+
+    def _accounts(self, names):
+        names = set(n for n in names if n)
+        if not names:
+            return {}
+        return dict(AccountDB.objects.filter(username__in=names).values_list('username', 'id'))
+
+    def _post_ids(self, keys):
+        keys = set(unicode(k) for k in keys if k is not None)
+        ids = {}
+        for chunk in chunked(keys):
+            ids.update(Post.objects.filter(db_import_key__in=chunk).values_list('db_import_key', 'id'))
+        return ids
+
+    def _import_board(self, record):
+        key = record.get("key")
+        if not key:
+            self.counts["errors"] += 1
+            return
+
+        board = self._board(key)
+        if not board:
+            board = DefaultBoard(db_key=key)
+            board.save()
+            self._boards[key] = board
+
+        if "maxposts" in record:
+            board.db_expiry_maxposts = record["maxposts"]
+        if "maxdays" in record:
+            board.db_expiry_duration = record["maxdays"]
+        if "truncate" in record:
+            board.db_truncate = bool(record["truncate"])
+        if "archive_days" in record:
+            board.db_archive_days = record["archive_days"]
+        board.save()
+
+        if record.get("locks"):
+            try:
+                board.locks.add(record["locks"])
+            except LockException:
+                self.counts["errors"] += 1
+            finally:
+                caches.invalidate_access(board.id)
+
+        accounts = self._accounts(record.get("subscribers", []))
+        if accounts:
+            board.db_subscriptions.add(*accounts.values())
+
+        self.counts["boards"] += 1
+
+    def _make_post(self, record, board, sequence, accounts, parent_id):
+        # Dates are stored as the database expects them: with a time zone if USE_TZ is on,
+        # and in the local time zone without one if it isn't.
+        date = parse_datetime(record.get("date") or "") or timezone.now()
+        if settings.USE_TZ and timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        elif not settings.USE_TZ and timezone.is_aware(date):
+            date = timezone.make_naive(date)
+
+        poster = record.get("poster") or record.get("poster_account") or "Unknown"
+        post = Post(db_import_key=unicode(record["id"]), db_board=board, db_sequence=sequence,
+                    db_poster_player_id=accounts.get(record.get("poster_account")),
+                    db_poster_name=poster[:40], db_subject=(record.get("subject") or "(No subject)")[:40],
+                    db_text=record.get("text") or "", db_date_created=date, db_pinned=bool(record.get("pinned")),
+                    db_parent_id=parent_id, db_last_post_on=date, db_last_poster_name=poster[:40])
+        post.update_renditions()
+        return post
+
+    def _import_posts(self, records):
+        valid = []
+        for r in records:
+            if r.get("id") is None or not self._board(r.get("board")):
+                self.counts["errors"] += 1
+            else:
+                valid.append(r)
+
+        existing = self._post_ids(r["id"] for r in valid)
+        records = [r for r in valid if unicode(r["id"]) not in existing]
+        self.counts["skipped"] += len(valid) - len(records)
+        if not records:
+            return
+
+        keys = set(unicode(r["id"]) for r in records)
+        ids = self._post_ids(r.get("parent") for r in records if unicode(r.get("parent")) not in keys)
+        accounts = self._accounts(r.get("poster_account") for r in records)
+
+        with transaction.atomic():
+            # Number the posts on each board in the order they appear in the file.
+            sequences = {}
+            for r in records:
+                board = self._board(r["board"])
+                sequences.setdefault(board.id, []).append(r)
+            for board_id, board_records in sequences.items():
+                first = DefaultBoard.objects.allocate_sequence(self._board(board_records[0]["board"]),
+                                                               len(board_records))
+                for i, r in enumerate(board_records):
+                    r["_sequence"] = first + i
+
+            # Replies can only be written once their thread's first post has an id.
+            created = []
+            remaining = records
+            while remaining:
+                ready = [r for r in remaining if r.get("parent") is None or unicode(r["parent"]) in ids]
+                if not ready:
+                    # Their threads are missing; they become threads of their own.
+                    self.counts["orphans"] += len(remaining)
+                    for r in remaining:
+                        r["parent"] = None
+                    continue
+
+                done = set(id(r) for r in ready)
+                remaining = [r for r in remaining if id(r) not in done]
+                posts = [self._make_post(r, self._board(r["board"]), r["_sequence"], accounts,
+                                         ids.get(unicode(r["parent"])) if r.get("parent") is not None else None)
+                         for r in ready]
+                create_posts(posts)
+                ids.update((p.db_import_key, p.id) for p in posts)
+                created.extend(posts)
+
+            for parent in Post.objects.filter(pk__in=set(p.db_parent_id for p in created if p.db_parent_id)):
+                parent.update_thread_stats()
+
+            search.index_posts(created)
+
+        for board_id in sequences:
+            caches.bump_board(board_id)
+
+        self.counts["posts"] += len(created)
+
+    def _import_reads(self, records):
+        accounts = self._accounts(r.get("account") for r in records)
+        ids = self._post_ids(k for r in records
+                             for k in [r.get("through")] + list(r.get("read", [])) + list(r.get("unread", [])))
+
+        # Anything waiting to be written would overwrite what's imported.
+        receipts.flush_and_wait()
+
+        states = {}
+        for r in records:
+            board = self._board(r.get("board"))
+            account_id = accounts.get(r.get("account"))
+            if not board or not account_id:
+                self.counts["errors"] += 1
+                continue
+            states[(account_id, board.id)] = r
+
+        existing = {}
+        for s in ReadState.objects.filter(db_account_id__in=set(a for a, b in states),
+                                          db_board_id__in=set(b for a, b in states)):
+            existing[(s.db_account_id, s.db_board_id)] = s
+
+        new = []
+        with transaction.atomic():
+            for (account_id, board_id), r in states.items():
+                state = existing.get((account_id, board_id)) or \
+                    ReadState(db_account_id=account_id, db_board_id=board_id)
+                through = ids.get(unicode(r.get("through")), 0) if r.get("through") is not None else 0
+                state.db_read_through = through
+                state.db_read_above = _format_id_set(ids[unicode(k)] for k in r.get("read", [])
+                                                     if ids.get(unicode(k), 0) > through)
+                state.db_unread_below = _format_id_set(ids[unicode(k)] for k in r.get("unread", [])
+                                                       if 0 < ids.get(unicode(k), 0) <= through)
+                if state.pk:
+                    state.save()
+                else:
+                    new.append(state)
+                caches.bump_reads(account_id, board_id)
+
+            ReadState.objects.bulk_create(new, batch_size=self.batch_size)
+
+        self.counts["reads"] += len(states)
+
+
+def _export_id(post_id, import_key):
+    return import_key or "pax:" + str(post_id)
+
+
+def _keyset_pages(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    # Walks a queryset in id order, a chunk at a time, as lists of dictionaries of values.
+    last = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last).order_by('id').values(*fields)[:chunk_size].iterator())
+        if not chunk:
+            return
+
+        yield chunk
+        last = chunk[-1]['id']
+
+
+def _keyset(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    # The same, a row at a time.
+    for chunk in _keyset_pages(queryset, fields, chunk_size):
+        for row in chunk:
+            yield row
+
+
+def _board_record(board):
+    return {"type": "board", "key": board.db_key, "maxposts": board.db_expiry_maxposts,
+            "maxdays": board.db_expiry_duration, "truncate": board.db_truncate,
+            "archive_days": board.db_archive_days, "locks": board.db_lock_storage,
+            "subscribers": list(board.db_subscriptions.values_list('username', flat=True))}
+
+
+def _post_record(board, row):
+    parent = None
+    if row['db_parent_id']:
+        parent = _export_id(row['db_parent_id'], row['db_parent__db_import_key'])
+
+    return {"type": "post", "id": _export_id(row['id'], row['db_import_key']), "board": board.db_key,
+            "parent": parent, "subject": row['db_subject'], "text": row['db_text'],
+            "poster": row['db_poster_name'], "poster_account": row['db_poster_player__username'],
+            "date": row['db_date_created'].isoformat(), "pinned": row['db_pinned']}
+
+
+def _read_records(board):
+    for chunk in _keyset_pages(ReadState.objects.filter(db_board=board),
+                               ('id', 'db_account__username', 'db_read_through', 'db_read_above',
+                                'db_unread_below')):
+        post_ids = set()
+        for row in chunk:
+            post_ids.add(row['db_read_through'])
+            post_ids.update(int(i) for i in (row['db_read_above'] + "," + row['db_unread_below']).split(",") if i)
+
+        keys = {}
+        for ids in chunked(post_ids):
+            keys.update(Post.objects.filter(pk__in=ids).values_list('id', 'db_import_key'))
+
+        def export_ids(string):
+            return [_export_id(int(i), keys[int(i)]) for i in string.split(",") if i and int(i) in keys]
+
+        for row in chunk:
+            through = row['db_read_through']
+            yield {"type": "read", "account": row['db_account__username'], "board": board.db_key,
+                   "through": _export_id(through, keys[through]) if through in keys else None,
+                   "read": export_ids(row['db_read_above']), "unread": export_ids(row['db_unread_below'])}
+
+
+def export_records(boards, read_receipts=False):
+    """
+    Generates the records of an export of some boards, in the import format.
+
+    Args:
+        boards (list): The boards to export.
+        read_receipts (bool): Whether to include everyone's read states.
+
+    Returns:
+        A generator of dictionaries.
+
+    """
+    # Anything waiting to be written would be missed.  This runs in a webserver thread
+    # when streamed from the web.
+    receipts.flush_and_wait()
+
+    for board in boards:
+        yield _board_record(board)
+        for row in _keyset(Post.objects.filter(db_board=board), _POST_FIELDS):
+            yield _post_record(board, row)
+
+        if read_receipts:
+            for record in _read_records(board):
+                yield record
+
+
+def _header(value):
+    # A line break in a header value would start a header, or the body, of its own.
+    return re.sub(r"[\r\n]+", " ", value or "")
+
+
+def _mbox_message(record, date, plaintext):
+    timestamp = calendar.timegm(date.utctimetuple())
+    lines = ["From paxboards " + time.asctime(time.gmtime(timestamp)),
+             "From: " + _header(record["poster"]),
+             "Subject: " + _header(record["subject"]),
+             "Date: " + formatdate(timestamp),
+             "Message-ID: <" + _header(record["id"]) + "@paxboards>",
+             "X-Board: " + _header(record["board"])]
+    if record["parent"]:
+        lines.append("In-Reply-To: <" + _header(record["parent"]) + "@paxboards>")
+    if record["pinned"]:
+        lines.append("X-Pinned: yes")
+    lines.append("")
+
+    for line in (plaintext or "").split("\n"):
+        lines.append(">" + line if line.lstrip(">").startswith("From ") else line)
+
+    return "\n".join(lines) + "\n\n"
+
+
+def export_lines(boards, read_receipts=False, mbox=False):
+    """
+    Generates an export of some boards, as lines of text.
+
+    Args:
+        boards (list): The boards to export.
+        read_receipts (bool): Whether to include everyone's read states.  Not available
+            in mbox format.
+        mbox (bool): Write an mbox mailbox of the posts, rather than JSON Lines.
+
+    Returns:
+        A generator of UTF-8 encoded strings.
+
+    """
+    if not mbox:
+        for record in export_records(boards, read_receipts=read_receipts):
+            yield json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        return
+
+    for board in boards:
+        for row in _keyset(Post.objects.filter(db_board=board), _POST_FIELDS):
+            text = row['db_plaintext'] or ansi.strip_ansi(row['db_text'] or "")
+            yield _mbox_message(_post_record(board, row), row['db_date_created'], text).encode("utf-8")
+
+
+def compressed(lines):
+    """
+    Gzips a stream of strings as it goes.
+
+    Args:
+        lines (iterable): The strings to compress.
+
+    Returns:
+        A generator of compressed strings.
+
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Exporter(object):
+    """
+    Exports boards to a file.  Call run to get an iterator which writes a chunk each time
+    it is advanced, or export_all to write everything at once.
+
+    Args:
+        path (str): The file to write.  It is gzipped if its name ends in .gz, and an mbox
+            mailbox if its name ends in .mbox or .mbox.gz.
+        boards (list): The boards to export.
+        read_receipts (bool): Whether to include everyone's read states.
+
+    """
+
+    def __init__(self, path, boards, read_receipts=False):
+        self.path = path
+        self.boards = boards
+        self.read_receipts = read_receipts
+        self.mbox = path.endswith(".mbox") or path.endswith(".mbox.gz")
+        self.lines = 0
+
+    def run(self):
+        """
+        Writes the export, a chunk at a time.
+
+        Returns:
+            An iterator, which yields the number of lines written so far after each chunk.
+
+        """
+        with open_file(self.path, "w") as f:
+            for line in export_lines(self.boards, read_receipts=self.read_receipts, mbox=self.mbox):
+                f.write(line)
+                self.lines += 1
+                if self.lines % EXPORT_CHUNK_SIZE == 0:
+                    yield self.lines
+
+        yield self.lines
+
+    def export_all(self):
+        """
+        Writes the whole export.
+
+        Returns:
+            The number of lines written.
+
+        """
+        for lines in self.run():
+            pass
+        return self.lines
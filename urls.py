@@ -1,12 +1,24 @@
 # URL patterns for the character app
 
 from django.conf.urls import url
-from paxboards.views import show_boardlist, show_board, show_thread, submit_post, submit_reply
+from paxboards.api import api_boards, api_board, api_post, api_events, api_poll_events
+from paxboards.views import show_boardlist, show_board, show_thread, submit_post, submit_reply, show_archive, \
+    show_archived_post, show_metrics, export_boards
 
 urlpatterns = [
     url(r'^$', show_boardlist, name="boardlist"),
+    url(r'^api/$', api_boards, name="api_boards"),
+    url(r'^api/events/$', api_events, name="api_events"),
+    url(r'^api/events/poll/$', api_poll_events, name="api_poll_events"),
+    url(r'^api/(?P<board_id>\d+)/$', api_board, name="api_board"),
+    url(r'^api/(?P<board_id>\d+)/(?P<post_id>\d+)/$', api_post, name="api_post"),
+    url(r'^metrics/$', show_metrics, name="metrics"),
+    url(r'^export/$', export_boards, name="export_all"),
+    url(r'^(?P<board_id>\d+)/export/$', export_boards, name="export"),
     url(r'^(?P<board_id>\d+)/$', show_board, name="board"),
     url(r'^(?P<board_id>\d+)/(?P<post_id>\d+)/$', show_thread, name="thread"),
     url(r'^(?P<board_id>\d+)/post/$', submit_post, name="post"),
     url(r'^(?P<board_id>\d+)/(?P<post_id>\d+)/reply/$', submit_reply, name="reply"),
+    url(r'^(?P<board_id>\d+)/archive/$', show_archive, name="archive"),
+    url(r'^(?P<board_id>\d+)/archive/(?P<archive_id>\d+)/$', show_archived_post, name="archived_post"),
 ]
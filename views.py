@@ -1,12 +1,26 @@
+from django.conf import settings
 from django.shortcuts import render
-from django.http import Http404, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from boards import DefaultBoard
-from models import Post
+from models import Post, ArchivedPost
+from paging import keyset_page
+import metrics
+import transfer
+from profiling import profiled_view
 from evennia.utils import ansi
 from forms import PostForm, ReplyForm
 
+THREADS_PER_PAGE = getattr(settings, "PAXBOARDS_THREADS_PER_PAGE", 25)
+REPLIES_PER_PAGE = getattr(settings, "PAXBOARDS_REPLIES_PER_PAGE", 20)
+
+ARCHIVE_ORDERING = [("db_date_created", True), ("id", True)]
+
+METRICS_ALLOWED_IPS = getattr(settings, "PAXBOARDS_METRICS_ALLOWED_IPS", ("127.0.0.1", "::1"))
+UPSTREAM_IPS = getattr(settings, "UPSTREAM_IPS", [])
+
 # Create your views here.
 
+@profiled_view
 def show_boardlist(request):
     if not request.user.is_authenticated or request.user.username == "":
         return render(request, 'login.html', {})
@@ -17,6 +31,7 @@ def show_boardlist(request):
     return render(request, 'boardlist.html', context)
 
 
+@profiled_view
 def show_board(request, board_id):
     if not request.user.is_authenticated or request.user.username == "":
         return render(request, 'login.html', {})
@@ -29,9 +44,10 @@ def show_board(request, board_id):
 
         can_post = board.access(request.user, access_type="post", default=False)
 
-        threads = board.threads(request.user)
+        page = Post.objects.thread_page(board, request.user, after=request.GET.get('after'),
+                                        before=request.GET.get('before'), limit=THREADS_PER_PAGE)
 
-        context = {'board': board, 'threads': threads, 'can_post': can_post,
+        context = {'board': board, 'threads': page.items, 'page': page, 'can_post': can_post,
                    'board_id': board.id, 'page_title': 'Forums - ' + board.name}
 
         return render(request, 'board.html', context)
@@ -40,6 +56,7 @@ def show_board(request, board_id):
         return render(request, 'board_noperm.html', {})
 
 
+@profiled_view
 def show_thread(request, board_id, post_id):
     if not request.user.is_authenticated or request.user.username == "":
         return render(request, 'login.html', {})
@@ -53,18 +70,15 @@ def show_thread(request, board_id, post_id):
 
         can_post = board.access(request.user, access_type="post", default=False)
 
-        plaintext = ansi.strip_ansi(post.db_text)
-        setattr(post, 'plaintext', plaintext)
         post.mark_read(request.user, True)
 
-        replies = Post.objects.filter(db_parent=post).order_by('db_date_created')
-        for r in replies:
-            plaintext = ansi.strip_ansi(r.db_text)
-            setattr(r, 'plaintext', plaintext)
+        page = Post.objects.reply_page(post, after=request.GET.get('after'), before=request.GET.get('before'),
+                                       limit=REPLIES_PER_PAGE)
+        for r in page.items:
             r.mark_read(request.user, True)
 
         form = ReplyForm()
-        context = {'board': board, 'post': post, 'replies': replies, 'can_post': can_post,
+        context = {'board': board, 'post': post, 'replies': page.items, 'page': page, 'can_post': can_post,
                    'board_id': board, 'post_id': post, 'form': form,
                   'page_title': 'Forums - ' + post.db_subject}
 
@@ -74,6 +88,54 @@ def show_thread(request, board_id, post_id):
         return Http404("Error accessing boards.")
 
 
+@profiled_view
+def show_archive(request, board_id):
+    if not request.user.is_authenticated or request.user.username == "":
+        return render(request, 'login.html', {})
+
+    try:
+        board = DefaultBoard.objects.get(pk=board_id)
+
+        if not board.access(request.user, access_type="read", default=False):
+            return render(request, 'board_noperm.html', {})
+
+        # Only the listing columns are loaded; the compressed text is left alone.
+        archived = ArchivedPost.objects.filter(db_board=board).defer('db_data')
+        page = keyset_page(archived, ARCHIVE_ORDERING, after=request.GET.get('after'),
+                           before=request.GET.get('before'), limit=THREADS_PER_PAGE)
+
+        context = {'board': board, 'posts': page.items, 'page': page,
+                   'board_id': board.id, 'page_title': 'Forums - ' + board.name + ' Archive'}
+
+        return render(request, 'archive.html', context)
+
+    except (DefaultBoard.DoesNotExist, DefaultBoard.MultipleObjectsReturned):
+        return render(request, 'board_noperm.html', {})
+
+
+@profiled_view
+def show_archived_post(request, board_id, archive_id):
+    if not request.user.is_authenticated or request.user.username == "":
+        return render(request, 'login.html', {})
+
+    try:
+        post = ArchivedPost.objects.get(pk=archive_id, db_board_id=board_id)
+        board = post.db_board
+
+        if not board.access(request.user, access_type="read", default=False):
+            return render(request, 'board_noperm.html', {})
+
+        setattr(post, 'plaintext', ansi.strip_ansi(post.text))
+
+        context = {'board': board, 'post': post, 'page_title': 'Forums - ' + post.db_subject}
+
+        return render(request, 'archived_post.html', context)
+
+    except (ArchivedPost.DoesNotExist, ArchivedPost.MultipleObjectsReturned):
+        return Http404("Error accessing boards.")
+
+
+@profiled_view
 def submit_post(request, board_id):
     if not request.user.is_authenticated or request.user.username == "":
         return render(request, 'login.html', {})
@@ -104,6 +166,7 @@ def submit_post(request, board_id):
         return Http404("Error accessing boards.")
 
 
+@profiled_view
 def submit_reply(request, board_id, post_id):
     if not request.user.is_authenticated or request.user.username == "":
         return render(request, 'login.html', {})
@@ -133,3 +196,63 @@ def submit_reply(request, board_id, post_id):
     except (Board.DoesNotExist, Board.MultipleObjectsReturned, Post.DoesNotExist, Post.MultipleObjectsReturned):
         return Http404("Error accessing boards.")
 
+
+def _client_address(request):
+    """
+    Works out the address a request came from.  X-Forwarded-For is only believed when the
+    request came through one of the proxies in UPSTREAM_IPS, and then only as far as the
+    first address which isn't one of them, since the client can put anything before that.
+
+    """
+    address = request.META.get('REMOTE_ADDR')
+    if address not in UPSTREAM_IPS:
+        return address
+
+    forwarded = [a.strip() for a in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if a.strip()]
+    for hop in reversed(forwarded):
+        if hop not in UPSTREAM_IPS:
+            return hop
+
+    return address
+
+
+def show_metrics(request):
+    # Only for a collector on the same machine, or for superusers.
+    if _client_address(request) not in METRICS_ALLOWED_IPS and not request.user.is_superuser:
+        raise Http404("No such page.")
+
+    return HttpResponse(metrics.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# The export is written as the response is streamed, after the view has returned, so
+# profiling the view would only time the permission checks.
+def export_boards(request, board_id=None):
+    if not request.user.is_authenticated or request.user.username == "":
+        return render(request, 'login.html', {})
+
+    # The same people who may use bbadmin.
+    if not request.user.locks.check_lockstring(request.user, "export:perm(Wizards) OR perm(bbadmin)"):
+        return render(request, 'board_noperm.html', {})
+
+    if board_id:
+        try:
+            boards = [DefaultBoard.objects.get(pk=board_id)]
+        except DefaultBoard.DoesNotExist:
+            raise Http404("No such board.")
+        filename = "board-" + str(board_id)
+    else:
+        boards = list(DefaultBoard.objects.get_all_boards())
+        filename = "boards"
+
+    mbox = request.GET.get('format') == "mbox"
+    lines = transfer.export_lines(boards, read_receipts=(request.GET.get('reads') == "1"), mbox=mbox)
+    filename += ".mbox" if mbox else ".jsonl"
+
+    if request.GET.get('gzip') == "1":
+        lines = transfer.compressed(lines)
+        filename += ".gz"
+
+    response = StreamingHttpResponse(lines, content_type="application/gzip" if filename.endswith(".gz") else
+                                     "application/mbox" if mbox else "application/x-ndjson")
+    response['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+    return response